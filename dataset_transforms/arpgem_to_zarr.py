@@ -4,6 +4,8 @@ import zarr
 import numcodecs
 import glob
 
+import chunk_tools
+
 source_path = "/home/k/k202186/wrcp-work/ARP-GEM"
 dataset_name = "ARPGEM2_2p6km"
 
@@ -113,11 +115,14 @@ def get_compressor():
     return numcodecs.Blosc("zstd", clevel=6)
 
 
-def rechunk_dataset(ds: xr.Dataset, chunks_per_dims: dict) -> xr.Dataset:
+def rechunk_dataset(ds: xr.Dataset, order: int, timechunk: int) -> xr.Dataset:
+    """Rechunk the (time, [level,] cell) variables as planned by chunk_tools."""
     for var in filter(
-        lambda x: x.dims in chunks_per_dims.keys(), ds.data_vars.values()
+        lambda x: "time" in x.dims and "cell" in x.dims, ds.data_vars.values()
     ):
-        _ = dict(zip(var.dims, chunks_per_dims[var.dims]))
+        _ = dict(
+            zip(var.dims, chunk_tools.get_chunksizes(ds, var.name, order, timechunk))
+        )
         print("Rechunking", var.name, _)
         ds[var.name] = ds[var.name].chunk(_)
     return ds
@@ -137,24 +142,9 @@ def run(time, method, name=dataset_name, dry=False):
     new = rename_dataset(new)
     new = add_crs(new)
 
-    if time == "PT6H":
-        chunks_per_dim = {
-            ("time"): -1,
-            ("cell"): -1,
-            ("level"): -1,
-            ("time", "cell"): (4 * 7, 4**7),
-            ("time", "level", "cell"): (4 * 7, 10, 4**7),
-        }
-    elif time == "PT1H":
-        chunks_per_dim = {
-            ("time"): -1,
-            ("cell"): -1,
-            ("level"): -1,
-            ("time", "cell"): (24, 4**7),
-            ("time", "level", "cell"): (24, 10, 4**7),
-        }
-
-    rechunk_dataset(new, chunks_per_dim)
+    # a week of 6-hourly or a day of hourly data per chunk
+    timechunk = {"PT6H": 4 * 7, "PT1H": 24}[time]
+    rechunk_dataset(new, order=8, timechunk=timechunk)
     print(new, flush=True)
     print("Writing to,", output_name)
     out_store = zarr.DirectoryStore(output_name, dimension_separator="/")
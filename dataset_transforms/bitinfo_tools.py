@@ -0,0 +1,143 @@
+import json
+import logging
+from statistics import NormalDist
+
+import numpy as np
+import xarray as xr
+from numcodecs import BitRound
+
+import chunk_tools
+import codec_tools
+
+logging.basicConfig()
+logger = logging.getLogger("bitinfo_tools")
+logger.setLevel(logging.INFO)
+
+# float32: 1 sign bit and 8 exponent bits in front of the 23 mantissa bits
+NONMANTISSA_BITS = 9
+MANTISSA_BITS = 23
+
+
+def _entropy(p):
+    p = np.asarray(p, dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return -np.nansum(p * np.log2(p), axis=0)
+
+
+def bitinformation(data, axis=-1, confidence=0.99):
+    """Real information content of every bit of float32 `data` (Klöwer et al. 2021).
+
+    The mutual information between the bits of neighbouring values along `axis`,
+    from the most significant (sign) to the least significant mantissa bit. Values
+    that are not significantly different from random bits are set to zero.
+    """
+    data = np.moveaxis(np.asarray(data, dtype="float32"), axis, -1)
+    ints = data.view("uint32")
+    valid = ~np.isnan(data)
+    valid = valid[..., :-1] & valid[..., 1:]
+    a, b = ints[..., :-1][valid], ints[..., 1:][valid]
+    n = a.size
+    info = np.zeros(32)
+    for i in range(32):
+        shift = np.uint32(31 - i)
+        x = ((a >> shift) & 1).astype(bool)
+        y = ((b >> shift) & 1).astype(bool)
+        joint = np.array(
+            [(~x & ~y).sum(), (~x & y).sum(), (x & ~y).sum(), (x & y).sum()]
+        ) / max(n, 1)
+        px = np.array([joint[0] + joint[1], joint[2] + joint[3]])
+        py = np.array([joint[0] + joint[2], joint[1] + joint[3]])
+        info[i] = _entropy(px) + _entropy(py) - _entropy(joint)
+    # information that random bits would have by chance at this sample size
+    p = 0.5 + NormalDist().inv_cdf(1 - (1 - confidence) / 2) / (2 * np.sqrt(max(n, 1)))
+    info[info <= 1 - _entropy([p, 1 - p])] = 0
+    return info
+
+
+def get_keepbits(info, inflevel=0.99):
+    """Mantissa bits needed to preserve `inflevel` of the real information."""
+    total = info.sum()
+    if total == 0:
+        return 0
+    cdf = np.cumsum(info) / total
+    last = int(np.argmax(cdf >= inflevel))
+    return int(np.clip(last + 1 - NONMANTISSA_BITS, 0, MANTISSA_BITS))
+
+
+def keepbits_for_variable(da, order, timechunk, inflevel=0.99, nsamples=3):
+    chunks = list(codec_tools.sample_chunks(da, order, timechunk, nsamples=nsamples))
+    info = np.mean([bitinformation(c) for c in chunks], axis=0)
+    return get_keepbits(info, inflevel), chunks
+
+
+def report(chunks, keepbits, compressor=None):
+    """Compression gain and maximum error of rounding `chunks` to `keepbits`."""
+    compressor = compressor or chunk_tools.get_compressor()
+    rounder = BitRound(keepbits)
+    raw = rounded = 0
+    abs_err = rel_err = 0.0
+    for chunk in chunks:
+        chunk = np.ascontiguousarray(chunk, dtype="float32")
+        r = np.frombuffer(rounder.encode(chunk), "float32").reshape(chunk.shape)
+        raw += len(compressor.encode(chunk))
+        rounded += len(compressor.encode(r))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            err = np.abs(r - chunk)
+            abs_err = max(abs_err, float(np.nanmax(err, initial=0)))
+            rel = err[chunk != 0] / np.abs(chunk[chunk != 0])
+            rel_err = max(rel_err, float(np.nanmax(rel, initial=0)))
+    return dict(
+        keepbits=keepbits,
+        gain=raw / rounded,
+        max_abs_error=abs_err,
+        max_rel_error=rel_err,
+    )
+
+
+def keepbits_for_dataset(
+    ds, order, timechunk, variables=None, inflevel=0.99, nsamples=3
+):
+    """Keepbits for every float variable, as accepted by `get_encodings`."""
+    keepbits, reports = {}, {}
+    for var in variables or list(ds.data_vars):
+        if not np.issubdtype(ds[var].dtype, np.floating):
+            continue
+        bits, chunks = keepbits_for_variable(
+            ds[var], order, timechunk, inflevel, nsamples
+        )
+        keepbits[var] = bits
+        reports[var] = report(chunks, bits)
+        logger.info(f"{var}: {reports[var]}")
+    return keepbits, reports
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description="Compute the mantissa bits to keep from the bit information"
+    )
+    parser.add_argument("dataset", help="any dataset xarray can open")
+    parser.add_argument("--order", type=int, required=True)
+    parser.add_argument("--timechunk", type=int, default=24)
+    parser.add_argument("--variables", nargs="*")
+    parser.add_argument("--inflevel", type=float, default=0.99)
+    parser.add_argument("--nsamples", type=int, default=3)
+    parser.add_argument("--output", default="keepbits.json")
+    parser.add_argument("--report", help="write gain and errors to this json file")
+    args = parser.parse_args()
+
+    ds = xr.open_dataset(args.dataset, chunks={})
+    keepbits, reports = keepbits_for_dataset(
+        ds,
+        args.order,
+        args.timechunk,
+        variables=args.variables,
+        inflevel=args.inflevel,
+        nsamples=args.nsamples,
+    )
+    with open(args.output, "w") as f:
+        json.dump(keepbits, f, indent=2)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(reports, f, indent=2)
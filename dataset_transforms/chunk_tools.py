@@ -1,26 +1,52 @@
-from numcodecs import Blosc
+import numcodecs
+from numcodecs import Blosc, BitRound
 import numpy as np
+import itertools
 import logging
 
 logging.basicConfig()
 logger = logging.getLogger("chunk_tools")
 # logger.setLevel(logging.DEBUG)
 
+# zarr 2 chunk keys with "/", so that chunks of a time step share a directory
+CHUNK_KEY_ENCODING = {"name": "v2", "separator": "/"}
 
-def get_encodings(outds, order, timechunk):
+
+def get_encodings(outds, order, timechunk, compressors=None, keepbits=None):
+    """Encodings for all variables of `outds`.
+
+    `compressors` optionally maps variable names to numcodecs codecs or their
+    configs, e.g. as recommended by `codec_tools`. `keepbits` maps variable
+    names to the number of mantissa bits to keep (see `bitinfo_tools`); these
+    variables are rounded before compression.
+    """
+    compressors = compressors or {}
+    keepbits = keepbits or {}
     encodings = {
         var: dict(
             dtype=get_dtype(outds[var]),
             chunks=get_chunksizes(
                 outds=outds, var=var, order=order, timechunk=timechunk
             ),
-            compressor=Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE),
+            compressors=[get_compressor(compressors.get(var))],
+            chunk_key_encoding=CHUNK_KEY_ENCODING,
         )
         for var in outds
     }
+    for var, bits in keepbits.items():
+        if var in encodings and get_dtype(outds[var]) == "float32":
+            encodings[var]["filters"] = [BitRound(keepbits=bits)]
     return encodings
 
 
+def get_compressor(config=None):
+    if config is None:
+        return Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE)
+    if isinstance(config, numcodecs.abc.Codec):
+        return config
+    return numcodecs.get_codec(dict(config))
+
+
 def get_dtype(da):
     if np.issubdtype(da.dtype, np.floating):
         return "float32"
@@ -29,33 +55,141 @@ def get_dtype(da):
 
 
 def get_chunksizes(outds, var, order, timechunk):
+    """Chunks of `var` planned by `plan_chunks`, with the time chunk fixed."""
     logger.debug(f"{outds=}, {var=}")
-    var_shape = outds[var].shape
-    if len(var_shape) == 0:
+    da = outds[var]
+    if da.ndim == 0:
         return tuple([])
-    logger.debug(f"{var_shape=}")
-    timechunk = min(timechunk, var_shape[0])
-    spacechunk = compute_chunksize(order=order)
-    if len(var_shape) == 1:
-        return min(var_shape[0], 1024**2)
-    elif len(var_shape) == 2:
-        chunksizes = (timechunk, spacechunk)
-        return chunksizes
-    elif len(var_shape) == 3:
-        chunksizes = (timechunk, 5, spacechunk)
-        return chunksizes
-    else:
-        raise Exception(
-            "can't compute chunking for variables that have more than 3 dimensions!"
+    logger.debug(f"{da.shape=}")
+    return plan_chunks(
+        shape=da.shape,
+        dims=da.dims,
+        dtype=get_dtype(da),
+        order=order,
+        fixed={"time": timechunk} if "time" in da.dims else None,
+    )
+
+
+DEFAULT_TARGET_BYTES = 16 * 1024**2
+# bytes that could have been read in the time it takes to issue one request
+REQUEST_OVERHEAD_BYTES = 1024**2
+ACCESS_WEIGHTS = {"map": 1.0, "timeseries": 0.0, "balanced": 0.5}
+
+
+def cell_chunk_candidates(order):
+    """Cell chunk sizes covering whole nested parent pixels of a zoom `order` grid."""
+    return [4**k for k in range(order + 1)] + [12 * 4**order]
+
+
+def _candidates(size):
+    sizes = {size}
+    n = 1
+    while n < size:
+        sizes.add(n)
+        if 3 * n < size:
+            sizes.add(3 * n)
+        n *= 2
+    return sorted(sizes)
+
+
+def read_cost(shape, dims, chunks, itemsize, overhead=REQUEST_OVERHEAD_BYTES):
+    """Bytes read and requests for one map and one time series.
+
+    A map is the full `cell` dimension at one index of all other dimensions, a
+    time series is the full `time` dimension at one index of all others.
+    """
+    cost = {}
+    chunk_bytes = int(np.prod(chunks)) * itemsize
+    for pattern, full in (("map", "cell"), ("timeseries", "time")):
+        if full not in dims:
+            continue
+        axis = dims.index(full)
+        requests = -(-shape[axis] // chunks[axis])
+        wanted = shape[axis] * itemsize
+        read = requests * chunk_bytes
+        cost[pattern] = dict(
+            requests=requests,
+            bytes=read,
+            amplification=(read + requests * overhead) / wanted,
         )
+    return cost
 
 
-def compute_chunksize(order):
-    start_split = 8
-    if order < start_split:
-        return 12 * 4**order
-    else:
-        return 4 ** (start_split + 1)
+def plan_chunks(
+    shape,
+    dims,
+    dtype,
+    order,
+    target_bytes=DEFAULT_TARGET_BYTES,
+    access="balanced",
+    compression_ratio=1.0,
+    fixed=None,
+):
+    """Chunk shape for a variable of any number of dimensions.
+
+    Chunks hold at most `target_bytes` after compression by `compression_ratio`,
+    and are no smaller than a quarter of that unless the whole variable is. The
+    `cell` dimension is chunked by whole nested parent pixels. Among the
+    candidates, the one with the lowest read cost (see `read_cost`) for the
+    `access` pattern ("map", "timeseries" or "balanced") is picked. `fixed` maps
+    dimension names to chunk sizes that must not be changed.
+    """
+    shape = tuple(shape)
+    dims = tuple(dims)
+    itemsize = np.dtype(dtype).itemsize
+    weight = ACCESS_WEIGHTS[access]
+    fixed = fixed or {}
+    budget = target_bytes * compression_ratio / itemsize
+
+    options = []
+    for dim, size in zip(dims, shape):
+        if dim in fixed:
+            options.append([min(fixed[dim], size)])
+        elif dim == "cell":
+            options.append([c for c in cell_chunk_candidates(order) if c <= size])
+        else:
+            options.append(_candidates(size))
+
+    lower = min(budget, np.prod(shape)) / 4
+    best, best_cost = None, np.inf
+    for chunks in itertools.product(*options):
+        n = np.prod(chunks)
+        cost = read_cost(shape, dims, chunks, itemsize)
+        total = weight * cost.get("map", {}).get("amplification", 0) + (
+            1 - weight
+        ) * cost.get("timeseries", {}).get("amplification", 0)
+        # prefer chunks within the budget, then ones that are not too small, or
+        # if there are none, the ones closest to that
+        key = (n > budget, max(lower - n, 0), total)
+        if best is None or key < best_cost:
+            best, best_cost = chunks, key
+    logger.debug(f"{dims=} {shape=} -> {best}")
+    return tuple(int(c) for c in best)
+
+
+def compute_chunksize(order, timechunk=1, dtype="float32"):
+    """Cell chunk of a (time, cell) variable with `timechunk` time steps."""
+    shape = (timechunk, 12 * 4**order)
+    fixed = {"time": timechunk}
+    return plan_chunks(shape, ("time", "cell"), dtype, order, fixed=fixed)[1]
+
+
+def healpix_chunks(order, timechunk, dtype="float32", **kwargs):
+    """Planned chunks for the shapes of (time, [level, ...] cell) variables.
+
+    Returns a function from a shape to its chunks (see `plan_chunks`), with the
+    time chunk fixed to `timechunk`. The cell dimension is the last one. It
+    returns None for variables with fewer than two dimensions.
+    """
+
+    def chunks(shape):
+        if len(shape) < 2:
+            return None
+        dims = ("time", *(f"dim_{i}" for i in range(1, len(shape) - 1)), "cell")
+        fixed = {"time": timechunk}
+        return plan_chunks(shape, dims, dtype, order, fixed=fixed, **kwargs)
+
+    return chunks
 
 
 def isPrime(number):
@@ -72,3 +206,52 @@ def isPrime(number):
         return True
     else:
         return False
+
+
+def benchmark(shape, dims, dtype, order, target_bytes, compression_ratio):
+    itemsize = np.dtype(dtype).itemsize
+    for access in ACCESS_WEIGHTS:
+        chunks = plan_chunks(
+            shape,
+            dims,
+            dtype,
+            order,
+            target_bytes=target_bytes,
+            access=access,
+            compression_ratio=compression_ratio,
+        )
+        cost = read_cost(shape, dims, chunks, itemsize)
+        chunk_mb = np.prod(chunks) * itemsize / 1024**2
+        print(f"{access:>10}: chunks {dict(zip(dims, chunks))} ({chunk_mb:.1f} MiB)")
+        for pattern, c in cost.items():
+            print(
+                f"{'':>12}{pattern:>10}: {c['requests']:>8} requests, "
+                f"{c['bytes'] / 1024**2:>10.1f} MiB, "
+                f"{c['amplification']:>8.1f}x amplification"
+            )
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Plan chunks and report their read cost")
+    parser.add_argument(
+        "shape", nargs="+", help="dimensions as name=size, e.g. time=8760 cell=786432"
+    )
+    parser.add_argument("--order", type=int, required=True)
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument(
+        "--target-mb", type=float, default=DEFAULT_TARGET_BYTES / 1024**2
+    )
+    parser.add_argument("--compression-ratio", type=float, default=1.0)
+    args = parser.parse_args()
+
+    dims, shape = zip(*((d, int(n)) for d, n in (s.split("=") for s in args.shape)))
+    benchmark(
+        shape,
+        dims,
+        args.dtype,
+        args.order,
+        int(args.target_mb * 1024**2),
+        args.compression_ratio,
+    )
@@ -0,0 +1,129 @@
+import logging
+import time
+import warnings
+
+import dask.array as dsa
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger("coarsen_tools")
+logger.setLevel(logging.INFO)
+
+
+def is_dask(data):
+    return isinstance(data, dsa.Array)
+
+
+def to_sums(data):
+    """Split healpix data into NaN-free float32 sums and int32 valid-counts."""
+    if is_dask(data):
+        return dsa.map_blocks(lambda b: to_sums(b)[0], data, dtype="float32"), (
+            dsa.map_blocks(lambda b: to_sums(b)[1], data, dtype="int32")
+        )
+    data = np.asarray(data, dtype="float32")
+    valid = ~np.isnan(data)
+    return np.where(valid, data, np.float32(0)), valid.astype("int32")
+
+
+def from_sums(sums, counts):
+    """Means from sums and valid-counts; NaN where no cell was valid."""
+    if is_dask(sums):
+        return dsa.map_blocks(from_sums, sums, counts, dtype="float32")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan).astype("float32")
+
+
+def _coarsen_block(block, factor):
+    # adding the four children explicitly is much faster than a sum over a
+    # trailing axis of length 4
+    while factor > 1:
+        children = block.reshape(*block.shape[:-1], block.shape[-1] // 4, 4)
+        block = children[..., 0] + children[..., 1]
+        block += children[..., 2]
+        block += children[..., 3]
+        factor //= 4
+    return block
+
+
+def coarsen_sums(sums, counts, levels=1):
+    """Coarsen sums and valid-counts by `levels` zoom levels along the last axis.
+
+    Works on N-D numpy and dask arrays. Dask arrays are coarsened block-wise;
+    their last-axis chunks are aligned to multiples of 4**levels first.
+    """
+    factor = 4**levels
+    if sums.shape[-1] % factor:
+        raise ValueError(
+            f"Cannot coarsen {sums.shape[-1]} cells by {levels} healpix levels"
+        )
+    if not is_dask(sums):
+        return _coarsen_block(sums, factor), _coarsen_block(counts, factor)
+
+    chunks = sums.chunks[-1]
+    if any(c % factor for c in chunks):
+        size = max(factor, max(chunks) // factor * factor)
+        sums = sums.rechunk({sums.ndim - 1: size})
+        counts = counts.rechunk({counts.ndim - 1: size})
+    new_chunks = sums.chunks[:-1] + (tuple(c // factor for c in sums.chunks[-1]),)
+    return (
+        sums.map_blocks(_coarsen_block, factor, chunks=new_chunks, dtype=sums.dtype),
+        counts.map_blocks(
+            _coarsen_block, factor, chunks=new_chunks, dtype=counts.dtype
+        ),
+    )
+
+
+def coarsen(data, levels=1):
+    """NaN-aware mean of `data` over blocks of 4**levels healpix cells (last axis)."""
+    return from_sums(*coarsen_sums(*to_sums(data), levels=levels))
+
+
+def coarsen_levels(data, levels):
+    """Coarsen `data` to several levels, reusing the sums of the finer ones.
+
+    `levels` are the numbers of zoom levels to coarsen by; the result maps each of
+    them to the NaN-aware mean over all finest cells it covers.
+    """
+    sums, counts = to_sums(data)
+    out = {}
+    done = 0
+    for level in sorted(levels):
+        if level > done:
+            sums, counts = coarsen_sums(sums, counts, level - done)
+            done = level
+        out[level] = data if level == 0 else from_sums(sums, counts)
+    return out
+
+
+def _loop_coarsen(data, levels):
+    # reference: per-field, per-level python loop with float64 intermediates
+    for _ in range(levels):
+        out = np.zeros(data.shape[:-1] + (data.shape[-1] // 4,))
+        for idx in np.ndindex(data.shape[:-1]):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                out[idx] = np.nanmean(data[idx].reshape(-1, 4), axis=1)
+        data = out
+    return data
+
+
+def benchmark(order=8, nfields=24, levels=4, repeat=3):
+    rng = np.random.default_rng(0)
+    data = rng.random((nfields, 12 * 4**order)).astype("float32")
+    data[data < 0.05] = np.nan
+    for name, func in (
+        ("loop", lambda: _loop_coarsen(data, levels)),
+        ("vectorized", lambda: coarsen_levels(data, range(1, levels + 1))),
+    ):
+        best = np.inf
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - t0)
+        logger.info(f"{name:>10}: {best:.3f}s for {nfields} fields, {levels} levels")
+
+
+if __name__ == "__main__":
+    # few large fields and many small ones (e.g. time x pressure levels)
+    benchmark(order=8, nfields=24)
+    benchmark(order=5, nfields=2000)
@@ -0,0 +1,160 @@
+import itertools
+import json
+import logging
+import time
+
+import numpy as np
+import xarray as xr
+from numcodecs import Blosc
+
+import chunk_tools
+
+logging.basicConfig()
+logger = logging.getLogger("codec_tools")
+logger.setLevel(logging.INFO)
+
+CNAMES = ("zstd", "lz4", "lz4hc", "blosclz", "zlib")
+CLEVELS = (1, 3, 5, 7, 9)
+SHUFFLES = (Blosc.NOSHUFFLE, Blosc.SHUFFLE, Blosc.BITSHUFFLE)
+
+
+def codec_matrix(cnames=CNAMES, clevels=CLEVELS, shuffles=SHUFFLES):
+    return [
+        Blosc(cname=cname, clevel=clevel, shuffle=shuffle)
+        for cname, clevel, shuffle in itertools.product(cnames, clevels, shuffles)
+    ]
+
+
+def sample_chunks(da, order, timechunk, nsamples=3, seed=0):
+    """Random chunks of `da` as stored by `chunk_tools.get_encodings`."""
+    chunks = chunk_tools.get_chunksizes(
+        outds=da.to_dataset(name="_"), var="_", order=order, timechunk=timechunk
+    )
+    chunks = np.atleast_1d(chunks)
+    nchunks = [-(-size // chunk) for size, chunk in zip(da.shape, chunks)]
+    rng = np.random.default_rng(seed)
+    for _ in range(nsamples):
+        index = [rng.integers(n) for n in nchunks]
+        sel = {
+            dim: slice(i * c, (i + 1) * c) for dim, i, c in zip(da.dims, index, chunks)
+        }
+        yield np.ascontiguousarray(
+            da.isel(sel).values.astype(chunk_tools.get_dtype(da))
+        )
+
+
+def measure(codec, chunks, repeat=3):
+    """Compression ratio and compress/decompress throughput in MB/s."""
+    nbytes = sum(c.nbytes for c in chunks)
+    encoded = [codec.encode(c) for c in chunks]
+    compressed = sum(len(e) for e in encoded)
+
+    def best_time(func, args):
+        best = np.inf
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for a in args:
+                func(a)
+            best = min(best, time.perf_counter() - t0)
+        return best
+
+    return dict(
+        ratio=nbytes / compressed,
+        compress_mbps=nbytes / best_time(codec.encode, chunks) / 1e6,
+        decompress_mbps=nbytes / best_time(codec.decode, encoded) / 1e6,
+    )
+
+
+def benchmark_variable(da, order, timechunk, codecs=None, nsamples=3):
+    chunks = list(sample_chunks(da, order, timechunk, nsamples=nsamples))
+    results = []
+    for codec in codecs or codec_matrix():
+        result = measure(codec, chunks)
+        result["codec"] = codec.get_config()
+        results.append(result)
+        logger.debug(f"{da.name}: {result}")
+    return results
+
+
+def recommend(results, min_compress_mbps=100, min_decompress_mbps=500):
+    """Best compression ratio among codecs that are fast enough.
+
+    Falls back to the fastest decompression if no codec meets both limits.
+    """
+    fast = [
+        r
+        for r in results
+        if r["compress_mbps"] >= min_compress_mbps
+        and r["decompress_mbps"] >= min_decompress_mbps
+    ]
+    if fast:
+        return max(fast, key=lambda r: r["ratio"])
+    return max(results, key=lambda r: r["decompress_mbps"])
+
+
+def benchmark_dataset(
+    ds,
+    order,
+    timechunk,
+    variables=None,
+    codecs=None,
+    nsamples=3,
+    min_compress_mbps=100,
+    min_decompress_mbps=500,
+):
+    """Benchmark all (or the given) variables and recommend a codec for each.
+
+    Returns the recommendation, mapping variable names to numcodecs configs as
+    accepted by `chunk_tools.get_encodings(compressors=...)`, and all results.
+    """
+    recommendation, report = {}, {}
+    for var in variables or list(ds.data_vars):
+        results = benchmark_variable(ds[var], order, timechunk, codecs, nsamples)
+        best = recommend(results, min_compress_mbps, min_decompress_mbps)
+        logger.info(
+            f"{var}: {best['codec']} ratio {best['ratio']:.2f}, "
+            f"{best['compress_mbps']:.0f} MB/s compress, "
+            f"{best['decompress_mbps']:.0f} MB/s decompress"
+        )
+        recommendation[var] = best["codec"]
+        report[var] = results
+    return recommendation, report
+
+
+def load_recommendation(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description="Measure Blosc codecs on sample chunks and recommend encodings"
+    )
+    parser.add_argument("dataset", help="any dataset xarray can open")
+    parser.add_argument("--order", type=int, required=True)
+    parser.add_argument("--timechunk", type=int, default=24)
+    parser.add_argument("--variables", nargs="*")
+    parser.add_argument("--nsamples", type=int, default=3)
+    parser.add_argument("--min-compress-mbps", type=float, default=100)
+    parser.add_argument("--min-decompress-mbps", type=float, default=500)
+    parser.add_argument("--output", default="codecs.json")
+    parser.add_argument("--report", help="write all measurements to this json file")
+    args = parser.parse_args()
+
+    ds = xr.open_dataset(args.dataset, chunks={})
+    recommendation, report = benchmark_dataset(
+        ds,
+        args.order,
+        args.timechunk,
+        variables=args.variables,
+        nsamples=args.nsamples,
+        min_compress_mbps=args.min_compress_mbps,
+        min_decompress_mbps=args.min_decompress_mbps,
+    )
+    with open(args.output, "w") as f:
+        json.dump(recommendation, f, indent=2)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,230 @@
+import ast
+import logging
+import operator
+import time
+import tracemalloc
+
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger("expression_tools")
+logger.setLevel(logging.INFO)
+
+BINARY = {
+    ast.Add: (np.add, operator.add),
+    ast.Sub: (np.subtract, operator.sub),
+    ast.Mult: (np.multiply, operator.mul),
+    ast.Div: (np.divide, operator.truediv),
+    ast.Pow: (np.power, operator.pow),
+}
+# float32 elements per block, small enough for the registers to stay in cache
+BLOCK_SIZE = 2**16
+
+
+def _fold(node):
+    """Fold constant subexpressions, also in chains like `x * 1000 / 3600`."""
+    if isinstance(node, ast.UnaryOp):
+        operand = _fold(node.operand)
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        if not isinstance(node.op, ast.USub):
+            raise ValueError(f"Unsupported operator {ast.dump(node.op)}")
+        if isinstance(operand, ast.Constant):
+            return ast.Constant(-operand.value)
+        return ast.BinOp(operand, ast.Mult(), ast.Constant(-1.0))
+    if isinstance(node, ast.BinOp):
+        if type(node.op) not in BINARY:
+            raise ValueError(f"Unsupported operator {ast.dump(node.op)}")
+        left, right = _fold(node.left), _fold(node.right)
+        apply = BINARY[type(node.op)][1]
+        if isinstance(left, ast.Constant) and isinstance(right, ast.Constant):
+            return ast.Constant(apply(float(left.value), float(right.value)))
+        scaling = (ast.Mult, ast.Div)
+        if (
+            isinstance(node.op, scaling)
+            and isinstance(right, ast.Constant)
+            and isinstance(left, ast.BinOp)
+            and isinstance(left.op, scaling)
+            and isinstance(left.right, ast.Constant)
+        ):
+            factor = float(left.right.value)
+            if isinstance(left.op, ast.Div):
+                factor = 1 / factor
+            factor = apply(factor, float(right.value))
+            return ast.BinOp(left.left, ast.Mult(), ast.Constant(factor))
+        return ast.BinOp(left, node.op, right)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node
+    if isinstance(node, ast.Name):
+        return node
+    raise ValueError(f"Unsupported expression {ast.unparse(node)!r}")
+
+
+def _names(node):
+    """Input names from left to right."""
+    if isinstance(node, ast.Name):
+        yield node.id
+    elif isinstance(node, ast.BinOp):
+        yield from _names(node.left)
+        yield from _names(node.right)
+
+
+class Expression:
+    """A derived variable, e.g. `Expression("(ssrd - ssr) / 3600")`.
+
+    The expression may use the names of input variables, numbers, `+ - * / **`
+    and parentheses. Calling it with the inputs, in the order of `inputs`,
+    returns a float32 array. It is evaluated in blocks of `block_size`
+    elements with ufuncs writing into a few float32 registers, so besides
+    the result no full-size temporaries are allocated, and nothing is
+    computed in float64.
+    """
+
+    def __init__(self, source, block_size=BLOCK_SIZE):
+        self.source = source
+        self.block_size = block_size
+        tree = _fold(ast.parse(source.strip(), mode="eval").body)
+        self.inputs = list(dict.fromkeys(_names(tree)))
+        self.program = []
+        self.nregisters = 0
+        self._free = []
+        self.result = self._compile(tree)
+
+    def __repr__(self):
+        return f"Expression({self.source!r})"
+
+    def _register(self):
+        if self._free:
+            return self._free.pop()
+        self.nregisters += 1
+        return self.nregisters - 1
+
+    def _compile(self, node):
+        """Append the instructions for `node`; returns where its value is.
+
+        Values are ("input", i), ("register", r) or ("constant", value).
+        """
+        if isinstance(node, ast.Name):
+            return ("input", self.inputs.index(node.id))
+        if isinstance(node, ast.Constant):
+            return ("constant", np.float32(node.value))
+        left = self._compile(node.left)
+        right = self._compile(node.right)
+        # reuse the register of an operand for the result
+        for operand in (right, left):
+            if operand[0] == "register":
+                self._free.append(operand[1])
+        out = ("register", self._register())
+        self.program.append((BINARY[type(node.op)][0], left, right, out))
+        return out
+
+    def __call__(self, *args):
+        if len(args) != len(self.inputs):
+            raise TypeError(f"{self!r} takes the inputs {self.inputs}")
+        args = [np.asarray(a) for a in args]
+        shape = np.broadcast_shapes(*(a.shape for a in args)) if args else ()
+        out = np.empty(shape, dtype="float32")
+        flat = [np.broadcast_to(a, shape).reshape(-1) for a in args]
+        out_flat = out.reshape(-1)
+        if self.result[0] == "constant":
+            out_flat[:] = self.result[1]
+            return out
+        if not self.program:
+            out_flat[:] = flat[self.result[1]]
+            return out
+
+        registers = [
+            np.empty(min(self.block_size, out.size), dtype="float32")
+            for _ in range(self.nregisters)
+        ]
+        last = len(self.program) - 1
+        for start in range(0, out.size, self.block_size):
+            stop = min(start + self.block_size, out.size)
+            n = stop - start
+            values = {
+                "input": [f[start:stop] for f in flat],
+                "register": [r[:n] for r in registers],
+            }
+            for k, (ufunc, left, right, result) in enumerate(self.program):
+                # the last instruction writes straight into the output
+                target = (
+                    out_flat[start:stop] if k == last else values[result[0]][result[1]]
+                )
+                ufunc(
+                    left[1] if left[0] == "constant" else values[left[0]][left[1]],
+                    right[1] if right[0] == "constant" else values[right[0]][right[1]],
+                    out=target,
+                    dtype="float32",
+                )
+        return out
+
+
+def _identity(x):
+    return x
+
+
+def get_inputs(op):
+    """Input names of a derived variable and the function computing it.
+
+    `op` is the name of an input variable, an `Expression`, or a function
+    taking the inputs as arguments of the same names.
+    """
+    if isinstance(op, str):
+        return [op], _identity
+    if isinstance(op, Expression):
+        return list(op.inputs), op
+    # co_varnames also lists the local variables after the arguments
+    code = op.__code__
+    return list(code.co_varnames[: code.co_argcount]), op
+
+
+def benchmark(shape=(24, 12 * 4**7), dtype="float32", repeat=5):
+    """Time and peak memory of the ifs2s3 lambdas against expressions."""
+    cases = {
+        "rsus": (lambda ssrd, ssr: (ssrd - ssr) / 3600, "(ssrd - ssr) / 3600"),
+        "pr": (lambda tp: tp * (1000 / 3600), "tp * 1000 / 3600"),
+        "mrso": (
+            lambda swvl1, swvl2, swvl3, swvl4: (
+                7 * swvl1 + 21 * swvl2 + 72 * swvl3 + 189 * swvl4
+            )
+            / (7 + 21 + 72 + 189),
+            "(7 * swvl1 + 21 * swvl2 + 72 * swvl3 + 189 * swvl4) / (7 + 21 + 72 + 189)",
+        ),
+    }
+    rng = np.random.default_rng(0)
+    results = {}
+    for name, (func, source) in cases.items():
+        expr = Expression(source)
+        inputs = {n: rng.random(shape).astype(dtype) for n in expr.inputs}
+        nbytes = inputs[expr.inputs[0]].nbytes
+        for label, f in (("lambda", func), ("expression", expr)):
+            args = [inputs[n] for n in get_inputs(f)[0]]
+            best = np.inf
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                f(*args)
+                best = min(best, time.perf_counter() - t0)
+            # numpy reports its allocations to tracemalloc
+            tracemalloc.start()
+            f(*args)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name, label] = (best, peak)
+            logger.info(
+                f"{name} {label}: {best * 1e3:.1f} ms, "
+                f"peak {peak / nbytes:.2f}x the size of one input"
+            )
+        expected = func(*(inputs[n] for n in get_inputs(func)[0]))
+        np.testing.assert_allclose(
+            expr(*args), expected, atol=1e-6 * np.abs(expected).max()
+        )
+    return results
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Benchmark derived-variable expressions")
+    parser.add_argument("--dtype", default="float32", help="dtype of the inputs")
+    args = parser.parse_args()
+    benchmark(dtype=args.dtype)
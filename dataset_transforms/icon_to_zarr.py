@@ -3,7 +3,8 @@ import xarray as xr
 import yaml
 import numpy as np
 import remap_tools  # local package to outsource the remap functions
-import zarr_tools
+import manifest_tools
+import weight_cache
 import logging
 from pathlib import Path
 import easygems.healpix as egh
@@ -28,11 +29,9 @@ infiles = {
 
 
 # %%
-def convert_files(zoom, subset, output_dir, config):
+def open_remapped(zoom, subset, config, cache=None):
     files = infiles[subset]
-    outfile = Path(f"{output_dir}/ICON_{subset}_z{zoom}.zarr")
     curr_conf = config[subset]
-    timechunk = curr_conf["chunks"]["time"]
 
     ds = xr.open_mfdataset(files, chunks=curr_conf["chunks"], use_cftime=True)
     if subset == "2d":
@@ -41,16 +40,37 @@ def convert_files(zoom, subset, output_dir, config):
         out_ds = process_3d(curr_conf, ds)
     else:
         raise RuntimeError("Unknown subset type")
-    out_ds = remap_tools.remap_delaunay(out_ds, zoom)
+    return remap_tools.remap_delaunay(out_ds, zoom, cache=cache)
+
+
+def convert_files(zoom, subset, output_dir, config, cache=None):
+    outfile = Path(f"{output_dir}/ICON_{subset}_z{zoom}.zarr")
+    timechunk = config[subset]["chunks"]["time"]
+    out_ds = open_remapped(zoom, subset, config, cache=cache)
     logger.info(f"Trying to write to {outfile}")
-    if not outfile.exists():
-        zarr_tools.create_zarr_structure(
-            path=outfile, outds=out_ds, timechunk=timechunk, order=zoom
-        )
-    zarr_tools.write_parts(outds=out_ds, path=outfile, time_chunk=24)
+    # safe to run from several processes at once, e.g. as a SLURM job array
+    manifest_tools.write_parts_cooperative(
+        outds=out_ds, path=outfile, time_chunk=24, timechunk=timechunk, order=zoom
+    )
     return out_ds, outfile
 
 
+def convert_files_pyramid(max_zoom, subset, output_dir, config, cache=None):
+    """Remap once to `max_zoom` and write it together with all coarser zooms."""
+    outfiles = {
+        zoom: Path(f"{output_dir}/ICON_{subset}_z{zoom}.zarr")
+        for zoom in range(max_zoom, -1, -1)
+    }
+    timechunk = config[subset]["chunks"]["time"]
+    out_ds = open_remapped(max_zoom, subset, config, cache=cache)
+    logger.info(f"Trying to write to {list(outfiles.values())}")
+    # safe to run from several processes at once, e.g. as a SLURM job array
+    manifest_tools.write_pyramid_cooperative(
+        outds=out_ds, paths=outfiles, timechunk=timechunk, time_chunk=24
+    )
+    return out_ds, outfiles
+
+
 def process_2d(curr_conf, ds):
     ds = ds.rename(curr_conf["renames"])
     ds = ds.isel(curr_conf["isel"])
@@ -71,14 +91,16 @@ def process_3d(curr_conf, ds):
 # %%
 output_dir = "/scratch/k/k202134/icon_remapped"
 config = yaml.safe_load(open("icon_to_zarr.yaml"))
+# weights are shared between subsets and runs on the same grid
+cache = weight_cache.WeightCache("/scratch/k/k202134/healpix_weights")
 #! rm -rf /scratch/k/k202134/icon_remapped/ICON_3d_z5.zarr
 #! rm -rf /scratch/k/k202134/icon_remapped/ICON_2d_z5.zarr
 
+# all zooms up to 5 are written in a single pass over the remapped data
 for subset in ("3d", "2d"):
-    for zoom in (5,):
-        out_ds, outfile = convert_files(
-            zoom=zoom, subset=subset, output_dir=output_dir, config=config
-        )
+    out_ds, outfiles = convert_files_pyramid(
+        max_zoom=5, subset=subset, output_dir=output_dir, config=config, cache=cache
+    )
 
 # %%
 egh.healpix_show(
@@ -1,6 +1,11 @@
 import sys
+import json
 import zarr
-from ifs_to_zarr import rechunk_dataset
+from ifs_to_zarr import rechunk_dataset, TaskLog
+from upload_tools import AsyncUploader
+from reference_tools import open_references
+from expression_tools import Expression
+from chunk_tools import healpix_chunks
 import numpy as np
 from argparse import ArgumentParser
 
@@ -18,9 +23,55 @@ parser.add_argument("nside", type=int, choices=[128, 512, 2048])
 parser.add_argument("freq", type=str)
 parser.add_argument("--only", type=str, nargs="*", default=None)
 parser.add_argument("--nprocs", type=int, default=64)
+parser.add_argument("--keepbits", type=str, default=None,
+                    help="json file with mantissa bits to keep per variable, "
+                         "see bitinfo_tools.py")
+parser.add_argument("--max-mem", type=float, default=2,
+                    help="memory budget per worker in GiB")
+parser.add_argument("--temp-dir", type=str, default=None,
+                    help="directory for intermediate stores of large rechunks")
+parser.add_argument("--state-dir", type=str, default=None,
+                    help="completion log and failed-task manifest, default "
+                         "ifs2s3_state/<freq>_healpix<nside>; tasks logged as "
+                         "done are skipped when restarting")
+parser.add_argument("--retry-failed", action="store_true",
+                    help="only rerun the tasks that failed in earlier runs")
+parser.add_argument("--reference-cache", type=str, default="reference_index",
+                    help="directory for the indexes built from the reference "
+                         "json files on first use, see reference_tools.py")
+parser.add_argument("--max-gap", type=int, default=2**16,
+                    help="merge reads of chunks at most this many bytes apart "
+                         "in the same file, negative to read chunk by chunk")
+parser.add_argument("--read-threads", type=int, default=4,
+                    help="threads decoding chunks in every worker")
+parser.add_argument("--staging-dir", type=str, default=None,
+                    help="write chunks to this local directory and upload them "
+                         "from a single process with many concurrent requests, "
+                         "instead of from every worker")
+parser.add_argument("--max-requests", type=int, default=256,
+                    help="concurrent requests of the uploader")
+parser.add_argument("--max-inflight", type=float, default=4,
+                    help="bytes held by the uploader in GiB")
 
 args = parser.parse_args()
 
+state_dir = args.state_dir or f"ifs2s3_state/{args.freq}_healpix{args.nside}"
+rechunk_options = {
+    "max_mem": int(args.max_mem * 2**30),
+    "log": TaskLog(state_dir),
+    "retry_failed": args.retry_failed,
+}
+if args.max_gap >= 0:
+    rechunk_options["read_options"] = {"max_gap": args.max_gap,
+                                       "nthreads": args.read_threads}
+if args.temp_dir is not None:
+    rechunk_options["temp_dir"] = args.temp_dir
+
+keepbits = None
+if args.keepbits is not None:
+    with open(args.keepbits) as f:
+        keepbits = json.load(f)
+
 
 def filter_vardict(vardict):
     if args.only is None:
@@ -38,11 +89,24 @@ storage_options = {
 }
 s3prefix = "s3://wrcp-hackathon/data/IFS-FESOM"
 
-zarr_out = zarr.open(s3prefix + f"/{args.freq}_healpix{args.nside}.zarr", mode="a",
-                     storage_options=storage_options,
-                     zarr_version=2)
+out_url = s3prefix + f"/{args.freq}_healpix{args.nside}.zarr"
+uploader = None
+if args.staging_dir is None:
+    zarr_out = zarr.open(out_url, mode="a",
+                         storage_options=storage_options,
+                         zarr_version=2)
+else:
+    uploader = AsyncUploader(out_url, storage_options,
+                             max_requests=args.max_requests,
+                             max_inflight_bytes=int(args.max_inflight * 2**30))
+    # chunks left behind by an interrupted run
+    uploader.upload_tree(args.staging_dir, delete=True)
+    zarr_out = zarr.open(args.staging_dir, mode="a", zarr_version=2)
+    rechunk_options["uploader"] = uploader
 
 add_crs(zarr_out, args.nside)
+# chunks of the outputs are planned per shape, see chunk_tools.plan_chunks
+order = int(np.log2(args.nside))
 
 if args.freq == "hourly":
     assert args.nside in [128, 2048]
@@ -51,9 +115,9 @@ if args.freq == "hourly":
         "time": "time",
         "lon": "lon",
         "lat": "lat",
-        "rlut": lambda ttr: ttr / -3600,  # 0 - net
-        "rsut": lambda tisr, tsr: (tisr - tsr) / 3600,  # incoming - net, for W/m2
-        "pr": lambda tp: tp * (1000 / 3600),  # pr: kg m-2 s-1
+        "rlut": Expression("ttr / -3600"),  # 0 - net
+        "rsut": Expression("(tisr - tsr) / 3600"),  # incoming - net, for W/m2
+        "pr": Expression("tp * (1000 / 3600)"),  # pr: kg m-2 s-1
         "psl": "msl",
         "ts": "skt",  # surface
         "uas": "10u",
@@ -61,25 +125,25 @@ if args.freq == "hourly":
         "tas": "2t",
         "clivi": "tciw",
         "clwvi": "tclw",
-        "hflsd": lambda slhf: slhf / 3600,  # we checked sign
-        "hfssd": lambda sshf: sshf / 3600,
-        "rlutcs": lambda ttrc: ttrc / -3600,
-        "rlus": lambda strd, str: (strd - str) / 3600,  # we checked sign
-        "rluscs": lambda strc: strc / -3600,
-        "rlds": lambda strd: strd / 3600,
-        "rsdt": lambda tisr: tisr / 3600,
-        "rsus": lambda ssrd, ssr: (ssrd - ssr) / 3600,
-        "rsuscs": lambda ssrdc, ssrc: (ssrdc - ssrc) / 3600,
-        "rsds": lambda ssrd: ssrd / 3600,
-        "rsdscs": lambda ssrdc: ssrdc / 3600,
-        "prs": lambda sf: sf * (1000 / 3600),
+        "hflsd": Expression("slhf / 3600"),  # we checked sign
+        "hfssd": Expression("sshf / 3600"),
+        "rlutcs": Expression("ttrc / -3600"),
+        "rlus": Expression("(strd - str) / 3600"),  # we checked sign
+        "rluscs": Expression("strc / -3600"),
+        "rlds": Expression("strd / 3600"),
+        "rsdt": Expression("tisr / 3600"),
+        "rsus": Expression("(ssrd - ssr) / 3600"),
+        "rsuscs": Expression("(ssrdc - ssrc) / 3600"),
+        "rsds": Expression("ssrd / 3600"),
+        "rsdscs": Expression("ssrdc / 3600"),
+        "prs": Expression("sf * (1000 / 3600)"),
         "prw": "tcwv",
         "ps": "sp",
-        "tauu": lambda ewss: ewss / 3600,
-        "tauv": lambda nsss: nsss / 3600,
+        "tauu": Expression("ewss / 3600"),
+        "tauv": Expression("nsss / 3600"),
         "clt": "tcc",
-        "swe": lambda sd: sd * 1000,
-        "mrso": lambda swvl1, swvl2, swvl3, swvl4: (7 * swvl1 + 21 * swvl2 + 72 * swvl3 + 189 * swvl4) / (7+21+72+189),
+        "swe": Expression("sd * 1000"),
+        "mrso": Expression("(7 * swvl1 + 21 * swvl2 + 72 * swvl3 + 189 * swvl4) / (7+21+72+189)"),
         "siconc": "ci",
         "10si": "10si",
         "2d": "2d",
@@ -131,7 +195,7 @@ if args.freq == "hourly":
         "ta" : "t",
         "hur": "r",
         "hus": "q",
-        "qall": lambda crwc, cswc, ciwc, clwc: crwc + cswc + ciwc + clwc,
+        "qall": Expression("crwc + cswc + ciwc + clwc"),
         "clwc": "clwc",
         "ciwc": "ciwc",
         "crwc": "crwc",
@@ -149,36 +213,31 @@ if args.freq == "hourly":
            }
     })
 
-    if args.nside <= 128:
-        chunks_per_dim = {
-            2: (7*24, 4**6),
-            3: (7*24, 5, 4**6),
-        }
-    else:
-        chunks_per_dim = {
-            2: (24, 4**8),
-            3: (24, 5, 4**8),
-        }
-
-    zarr_in = zarr.open(
-        f"reference::/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{args.nside}/jsons/sfc.dir/atm2d.json",
-        mode="r")
-    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables2d, args.nprocs)
-
-    zarr_in = zarr.open(
-        f"reference::/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{args.nside}/jsons/hl.dir/atm2d.json",
-        mode="r")
-    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables2d_hl, args.nprocs)
-
-    zarr_in = zarr.open(
-        f"reference::/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{args.nside}/jsons/pl.dir/atm3d.json"
-        , mode="r")
-    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables3d, args.nprocs)
-
-    zarr_in = zarr.open(
-        f"reference::/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{args.nside}/jsons/sol.dir/atm2d.json"
-        , mode="r")
-    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables3d_snow, args.nprocs)
+    chunks_per_dim = healpix_chunks(order, timechunk=7*24 if args.nside <= 128 else 24)
+
+    zarr_in = open_references(
+        f"/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{args.nside}/jsons/sfc.dir/atm2d.json",
+        args.reference_cache)
+    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables2d, args.nprocs, keepbits,
+                    **rechunk_options)
+
+    zarr_in = open_references(
+        f"/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{args.nside}/jsons/hl.dir/atm2d.json",
+        args.reference_cache)
+    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables2d_hl, args.nprocs, keepbits,
+                    **rechunk_options)
+
+    zarr_in = open_references(
+        f"/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{args.nside}/jsons/pl.dir/atm3d.json",
+        args.reference_cache)
+    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables3d, args.nprocs, keepbits,
+                    **rechunk_options)
+
+    zarr_in = open_references(
+        f"/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{args.nside}/jsons/sol.dir/atm2d.json",
+        args.reference_cache)
+    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables3d_snow, args.nprocs, keepbits,
+                    **rechunk_options)
 
     for vname in variables3d_snow:
         ad = zarr_out[vname].attrs["_ARRAY_DIMENSIONS"]
@@ -188,16 +247,7 @@ if args.freq == "hourly":
 if args.freq == "daily":
     assert args.nside in [128, 512]
 
-    if args.nside <= 128:
-        chunks_per_dim = {
-            2: (4*30, 4**6),
-            3: (4*30, 10, 4**6),
-        }
-    else:
-        chunks_per_dim = {
-            2: (30, 4**7),
-            3: (30, 10, 4**7),
-        }
+    chunks_per_dim = healpix_chunks(order, timechunk=4*30 if args.nside <= 128 else 30)
 
     variables2d = filter_vardict({
         v: v for v in
@@ -227,50 +277,43 @@ if args.freq == "daily":
 
     nside_in_filename_wtf = 2048 if args.nside == 512 else args.nside
 
-    zarr_in = zarr.open(
-        f"reference::/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{nside_in_filename_wtf}/jsons/o2d.dir/atm2d.json"
-        , mode="r")
-    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables2d, args.nprocs)
+    zarr_in = open_references(
+        f"/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{nside_in_filename_wtf}/jsons/o2d.dir/atm2d.json",
+        args.reference_cache)
+    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables2d, args.nprocs, keepbits,
+                    **rechunk_options)
 
-    zarr_in = zarr.open(
-        f"reference::/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{nside_in_filename_wtf}/jsons/o3d.dir/atm2d.json"
-        , mode="r")
-    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables3d, args.nprocs)
+    zarr_in = open_references(
+        f"/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_1h1d_2D_healpix{nside_in_filename_wtf}/jsons/o3d.dir/atm2d.json",
+        args.reference_cache)
+    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables3d, args.nprocs, keepbits,
+                    **rechunk_options)
 
 if args.freq == "monthly":
     assert args.nside in [128, 2048]
 
-    if args.nside <= 128:
-        chunks_per_dim = {
-            2: (4, 4**6),
-            3: (4, 10, 4**6),
-        }
-    else:
-        chunks_per_dim = {
-            2: (4, 4**8),
-            3: (4, 10, 4**8),
-        }
+    chunks_per_dim = healpix_chunks(order, timechunk=4)
 
     variables = {'time': 'time',
                  'lon': 'lon',
                  'lat': 'lat',
-                 "rlut": lambda ttr: ttr / -3600,  # 0 - net
-                 "rsut": lambda tisr, tsr: (tisr - tsr) / 3600,  # incoming - net, for W/m2
-                 "pr": lambda tp: tp * (1000 / 3600),  # pr: kg m-2 s-1
-                 "hflsd": lambda slhf: slhf / 3600,  # we checked sign
-                 "hfssd": lambda sshf: sshf / 3600,
-                 "rlutcs": lambda ttrc: ttrc / -3600,
-                 "rlus": lambda strd, str: (strd - str) / 3600,  # we checked sign
-                 "rluscs": lambda strc: strc / -3600,
-                 "rlds": lambda strd: strd / 3600,
-                 "rsdt": lambda tisr: tisr / 3600,
-                 "rsus": lambda ssrd, ssr: (ssrd - ssr) / 3600,
-                 "rsuscs": lambda ssrdc, ssrc: (ssrdc - ssrc) / 3600,
-                 "rsds": lambda ssrd: ssrd / 3600,
-                 "rsdscs": lambda ssrdc: ssrdc / 3600,
-                 "prs": lambda sf: sf * (1000 / 3600),
-                 "tauu": lambda ewss: ewss / 3600,
-                 "tauv": lambda nsss: nsss / 3600,
+                 "rlut": Expression("ttr / -3600"),  # 0 - net
+                 "rsut": Expression("(tisr - tsr) / 3600"),  # incoming - net, for W/m2
+                 "pr": Expression("tp * (1000 / 3600)"),  # pr: kg m-2 s-1
+                 "hflsd": Expression("slhf / 3600"),  # we checked sign
+                 "hfssd": Expression("sshf / 3600"),
+                 "rlutcs": Expression("ttrc / -3600"),
+                 "rlus": Expression("(strd - str) / 3600"),  # we checked sign
+                 "rluscs": Expression("strc / -3600"),
+                 "rlds": Expression("strd / 3600"),
+                 "rsdt": Expression("tisr / 3600"),
+                 "rsus": Expression("(ssrd - ssr) / 3600"),
+                 "rsuscs": Expression("(ssrdc - ssrc) / 3600"),
+                 "rsds": Expression("ssrd / 3600"),
+                 "rsdscs": Expression("ssrdc / 3600"),
+                 "prs": Expression("sf * (1000 / 3600)"),
+                 "tauu": Expression("ewss / 3600"),
+                 "tauv": Expression("nsss / 3600"),
                  **{v: v for v in
                     ('fdir',
                      'lsp',
@@ -283,11 +326,12 @@ if args.freq == "monthly":
                      )}
                  }
 
-    zarr_in = zarr.open(
-        f"reference::/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_monthly_healpix{args.nside}/jsons/sfc.dir/atm2d.json"
-        , mode="r")
+    zarr_in = open_references(
+        f"/work/bm1235/u233156/gribscan_cycle4_3999_RCBMF/gribscan_monthly_healpix{args.nside}/jsons/sfc.dir/atm2d.json",
+        args.reference_cache)
 
-    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables, args.nprocs)
+    rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables, args.nprocs, keepbits,
+                    **rechunk_options)
 
 
 # rename dimension `value` -> `cell`
@@ -296,5 +340,17 @@ for vname, var in zarr_out.arrays():
     var.attrs["_ARRAY_DIMENSIONS"] = [d if d != "value" else "cell"
                                       for d in ad]
 
+if uploader is not None:
+    failed = uploader.upload_tree(args.staging_dir, delete=True)
+    uploader.report()
+    uploader.close()
+    if failed:
+        # the metadata is only consolidated once all chunks are on S3
+        sys.exit(f"{failed} chunks could not be uploaded and stay in "
+                 f"{args.staging_dir}, rerun to upload them")
+    zarr_out = zarr.open(out_url, mode="a",
+                         storage_options=storage_options,
+                         zarr_version=2)
+
 # finally consolidate the dataset
 zarr.consolidate_metadata(zarr_out.store)
@@ -1,12 +1,22 @@
 import cloudpickle
+import itertools
+import json
+from pathlib import Path
 import zarr
 import numpy as np
 import multiprocessing
 import warnings
-from tqdm.contrib.concurrent import process_map
-from numcodecs import Blosc
+from tqdm import tqdm
+from numcodecs import Blosc, BitRound
 from tempfile import TemporaryDirectory
+from contextlib import ExitStack
 import math
+from functools import partial
+
+import rechunk_tools
+from chunk_tools import CHUNK_KEY_ENCODING
+from reference_tools import CoalescingReader
+from expression_tools import get_inputs
 
 warnings.filterwarnings(
     "ignore", "Found an empty list of filters in the array metadata document."
@@ -15,13 +25,19 @@ warnings.filterwarnings(
 temp_path = "/fastdata/k20200/k202160/tmp_ifs_remap"
 
 
-def gen_array(zarr_out, template, chunks, name=None, **kwargs):
+def gen_array(zarr_out, template, chunks, name=None, keepbits=None, **kwargs):
     name = name or template.basename
+    if name in zarr_out and zarr_out[name].chunks != tuple(chunks):
+        # require_array keeps the existing chunks, so tasks planned on the new
+        # ones would write partial chunks concurrently
+        raise ValueError(f"{name} exists with chunks {zarr_out[name].chunks}, "
+                         f"which differ from the planned {tuple(chunks)}")
+    if keepbits is not None:
+        # lossy: round away mantissa bits without real information before compression
+        kwargs["filters"] = [BitRound(keepbits=keepbits)]
     return zarr_out.require_array(
         name=name,
-        chunk_key_encoding=zarr.core.chunk_key_encodings.DefaultChunkKeyEncoding(
-            "v2", "/"
-        ),
+        chunk_key_encoding=CHUNK_KEY_ENCODING,
         shape=template.shape,
         chunks=chunks,
         dtype="float32",
@@ -37,30 +53,184 @@ def simple_remap(slice_to_process, in_vars, out_var, op=None):
     out_var[*slice_to_process] = op(*(v[*slice_to_process] for v in in_vars))
 
 
-def double_remap(slice_to_process, in_vars, out_var, op):
-    with TemporaryDirectory(dir=temp_path, suffix=".zarr") as tmpdir:
-        temp_zarr = zarr.open(tmpdir, mode="w", zarr_version=2)
-        # only rechunk last dimension first
-        temp_chunks = (*in_vars[0].chunks[:-1], max(in_vars[0].chunks[-1]//64, out_var.chunks[-1]))
-        temp_var = gen_array(temp_zarr, in_vars[0], temp_chunks,
-                             compressor=Blosc(cname='lz4', clevel=1, shuffle=0))
-        for sl in iter_slices(slice_to_process, tuple_max(*(v.chunks for v in in_vars), temp_chunks)):
-            simple_remap(sl, in_vars, temp_var, op)
-        for sl in iter_slices(slice_to_process, tuple_max(temp_chunks, out_var.chunks)):
-            simple_remap(sl, [temp_var], out_var)
+# per-worker state, set once by init_worker
+_worker = {}
+
+
+def init_worker(stores, jobs, read_options=None):
+    _worker["stores"] = stores
+    _worker["jobs"] = jobs
+    _worker["arrays"] = {}
+    _worker["reader"] = None
+    if read_options is not None:
+        _worker["reader"] = CoalescingReader(**read_options)
+
 
+def get_job(job_id):
+    # open the arrays and unpickle the ops only once per worker and job
+    if job_id not in _worker["arrays"]:
+        group_in, group_out, outputs, grid = _worker["jobs"][job_id]
+        group_in = _worker["stores"][group_in]
+        group_out = _worker["stores"][group_out]
+        names_in = dict.fromkeys(n for _, args, _ in outputs for n in args)
+        _worker["arrays"][job_id] = (
+            {n: group_in[n] for n in names_in},
+            [
+                (group_out[name], args, cloudpickle.loads(op))
+                for name, args, op in outputs
+            ],
+            grid,
+        )
+    return _worker["arrays"][job_id]
 
-def remap(t):
+
+def remap(task):
+    """Read every input of a job once for the slice and write all its outputs.
+
+    Returns the task, the errors of the outputs that failed and the read
+    statistics of the task, if the worker has a `CoalescingReader`.
+    """
+    job_id, index = task
+    inputs, outputs, grid = get_job(job_id)
+    slice_to_process = block_slice(index, grid, outputs[0][0].shape)
+    reader = _worker["reader"]
+    before = dict(reader.stats) if reader is not None else None
+    errors = {}
     try:
-        slice_to_process, in_vars, out_var, op = t
-        op = cloudpickle.loads(op)
-        if len(in_vars)*tuple_size(slice_to_process) > 1e9:
-            _remap = double_remap
+        if reader is None:
+            data = {name: v[*slice_to_process] for name, v in inputs.items()}
         else:
-            _remap = simple_remap
-        _remap(slice_to_process, in_vars, out_var, op)
+            data = reader.read(inputs, slice_to_process)
     except Exception as e:
-        warnings.warn("Failed: " + out_var.basename+": " + str(e))
+        warnings.warn("Failed reading: " + ", ".join(inputs)+": " + str(e))
+        return task, {out_var.basename: str(e) for out_var, _, _ in outputs}, None
+    io = None
+    if reader is not None:
+        io = {k: v - before[k] for k, v in reader.stats.items()}
+    for out_var, args, op in outputs:
+        try:
+            out_var[*slice_to_process] = op(*(data[a] for a in args))
+        except Exception as e:
+            warnings.warn("Failed: " + out_var.basename+": " + str(e))
+            errors[out_var.basename] = str(e)
+    return task, errors, io
+
+
+def block_slice(index, grid, shape):
+    return tuple(
+        slice(i * c, min((i + 1) * c, s)) for i, c, s in zip(index, grid, shape)
+    )
+
+
+def task_key(job, index):
+    """Key of a task that stays the same between runs with the same chunking."""
+    names = "+".join(name for name, _, _ in job[2])
+    return names + "/" + ".".join(str(i * c) for i, c in zip(index, job[3]))
+
+
+class TaskLog:
+    """Completion log and failed-task manifest of the tasks of a rechunk run.
+
+    Finished and failed tasks are appended to `done.jsonl` and `failed.jsonl`
+    in `state_dir`, so a restarted run can skip what is done, or only retry
+    what failed.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.done = set(r["key"] for r in self._read("done.jsonl"))
+        self.failed = {
+            r["key"]: r["errors"] for r in self._read("failed.jsonl")
+            if r["key"] not in self.done
+        }
+
+    def _read(self, name):
+        path = self.state_dir / name
+        if not path.exists():
+            return []
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _append(self, name, record):
+        with open(self.state_dir / name, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def record_done(self, key):
+        self.done.add(key)
+        self.failed.pop(key, None)
+        self._append("done.jsonl", {"key": key})
+
+    def record_failed(self, key, errors):
+        self.failed[key] = errors
+        self._append("failed.jsonl", {"key": key, "errors": errors})
+
+    def is_pending(self, key, retry_failed=False):
+        if key in self.done:
+            return False
+        return key in self.failed if retry_failed else True
+
+
+def iter_tasks(jobs, shapes):
+    """Compact (job id, block index) tasks, generated lazily."""
+    for job_id, (job, shape) in enumerate(zip(jobs, shapes)):
+        for index in iter_indices(job, shape):
+            yield job_id, index
+
+
+def output_layout(zarr_in, op, chunks_per_dim):
+    """Shape and chunks of an output, which has the shape of its first input."""
+    var_in = zarr_in[get_inputs(op)[0][0]]
+    if callable(chunks_per_dim):
+        chunks = chunks_per_dim(var_in.shape) or var_in.chunks
+    else:
+        chunks = chunks_per_dim.get(len(var_in.shape), var_in.chunks)
+    return var_in.shape, tuple(chunks)
+
+
+def group_variables(zarr_in, variables, chunks_per_dim):
+    """Outputs connected by shared inputs, as lists of names.
+
+    Only outputs of the same shape and chunks are grouped, as all outputs of a
+    job are written in the same blocks.
+    """
+    parent = {name: name for name in variables}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    users = {}
+    for name, op in variables.items():
+        layout = output_layout(zarr_in, op, chunks_per_dim)
+        for arg in get_inputs(op)[0]:
+            users.setdefault((arg, layout), []).append(name)
+    for names in users.values():
+        for other in names[1:]:
+            parent[find(other)] = find(names[0])
+
+    groups = {}
+    for name in variables:
+        groups.setdefault(find(name), []).append(name)
+    return list(groups.values())
+
+
+def bytes_read(zarr_in, variables, groups):
+    """Decoded input bytes read with one job per output and with one per group."""
+    def nbytes(name):
+        return zarr_in[name].nbytes
+
+    per_output = sum(
+        nbytes(arg) for op in variables.values() for arg in get_inputs(op)[0]
+    )
+    per_group = sum(
+        nbytes(arg)
+        for group in groups
+        for arg in dict.fromkeys(a for n in group for a in get_inputs(variables[n])[0])
+    )
+    return per_output, per_group
 
 
 def iter_slices(to_go, chunks, current=()):
@@ -87,29 +257,248 @@ def tuple_size(t):
                      (sl.indices(sl.stop) for sl in t))
 
 
+def identity(x):
+    return x
+
+
 def rechunk_dataset(zarr_in, zarr_out, chunks_per_dim, variables,
-                    nprocs=64):
-    for varname_out, op in variables.items():
-        if type(op) is str:
-            vars_in = [zarr_in[op]]
-            op = lambda x: x
+                    nprocs=64, keepbits=None, batch_size=None,
+                    max_mem=2**31, temp_dir=temp_path, log=None,
+                    retry_failed=False, uploader=None, read_options=None):
+    """Compute `variables` from `zarr_in` into `zarr_out` with new chunks.
+
+    Every worker holds at most about `max_mem` bytes. Outputs whose source
+    and target chunks cannot be matched within that budget go through an
+    intermediate store in `temp_dir` (see `rechunk_tools.plan_rechunk`).
+
+    With a `TaskLog`, tasks that are already done are skipped, and with
+    `retry_failed` only the tasks that failed before are run.
+
+    With an `upload_tools.AsyncUploader`, `zarr_out` is a local staging store
+    and the chunks of every finished task are uploaded and removed from it.
+    With `read_options`, every worker reads its inputs through a
+    `reference_tools.CoalescingReader` made with these options.
+
+    `chunks_per_dim` maps the number of dimensions to the output chunks, or is
+    a function from the shape to them (see `chunk_tools.healpix_chunks`).
+    Inputs it has no chunks for keep theirs.
+    """
+    keepbits = keepbits or {}
+    groups = group_variables(zarr_in, variables, chunks_per_dim)
+    before, after = bytes_read(zarr_in, variables, groups)
+    print(f"reading {after / 1e9:.3g} GB of inputs instead of {before / 1e9:.3g} GB "
+          f"({len(variables)} outputs in {len(groups)} jobs)")
+
+    with ExitStack() as stack:
+        temp_zarr = None
+        # two passes: the second copies from the intermediate store
+        passes = ([], []), ([], [])
+        moved = 0
+        for group in groups:
+            outputs = []
+            source, target, itemsize = [], [], 0
+            for varname_out in group:
+                names_in, op = get_inputs(variables[varname_out])
+                vars_in = [zarr_in[v] for v in names_in]
+
+                _, chunks = output_layout(zarr_in, variables[varname_out], chunks_per_dim)
+                var_out = gen_array(zarr_out, vars_in[0], chunks, varname_out,
+                                    keepbits=keepbits.get(varname_out),
+                                    compressor=Blosc(cname='lz4', clevel=5, shuffle=1))
+                print(f"processing {varname_out} {var_out.shape=}...")
+                source += [v.chunks for v in vars_in]
+                target.append(chunks)
+                itemsize += 4
+                outputs.append((varname_out, names_in, cloudpickle.dumps(op)))
+            itemsize += sum(
+                zarr_in[n].dtype.itemsize
+                for n in dict.fromkeys(a for _, args, _ in outputs for a in args)
+            )
+            plan = rechunk_tools.plan_rechunk(
+                var_out.shape, tuple_max(*source), tuple_max(*target), itemsize, max_mem
+            )
+            print(f"{group}: {plan}")
+            moved += plan["bytes_moved"]
+
+            if plan["strategy"] != "intermediate":
+                passes[0][0].append(("in", "out", outputs, plan["read_chunks"]))
+                passes[0][1].append(var_out.shape)
+                continue
+            if temp_zarr is None:
+                tmpdir = stack.enter_context(
+                    TemporaryDirectory(dir=temp_dir, suffix=".zarr"))
+                temp_zarr = zarr.open(tmpdir, mode="w", zarr_version=2)
+            for varname_out in group:
+                gen_array(temp_zarr, var_out, plan["intermediate_chunks"], varname_out,
+                          compressor=Blosc(cname='lz4', clevel=1, shuffle=0))
+            passes[0][0].append(("in", "tmp", outputs, plan["read_chunks"]))
+            passes[0][1].append(var_out.shape)
+            copies = [(n, [n], cloudpickle.dumps(identity)) for n in group]
+            passes[1][0].append(("tmp", "out", copies, plan["write_chunks"]))
+            passes[1][1].append(var_out.shape)
+        print(f"moving {moved / 1e9:.3g} GB in total")
+
+        # a stage-one job is only needed while its copy job has pending tasks
+        first, second = passes
+        if log is not None:
+            pending = [
+                any(log.is_pending(task_key(job, index), retry_failed)
+                    for index in iter_indices(job, shape))
+                for job, shape in zip(*second)
+            ]
+            copied = iter(pending)
+            keep = [job[1] != "tmp" or next(copied) for job in first[0]]
+            first = ([j for j, k in zip(first[0], keep) if k],
+                     [s for s, k in zip(first[1], keep) if k])
+            second = ([j for j, p in zip(second[0], pending) if p],
+                      [s for s, p in zip(second[1], pending) if p])
+        stage_one = dict(zip(
+            (i for i, job in enumerate(first[0]) if job[1] == "tmp"), second[0]
+        ))
+
+        upload = None
+        if uploader is not None:
+            upload = partial(upload_block, uploader, zarr_out)
+        all_jobs = first[0] + second[0]
+        stores = {"in": zarr_in, "out": zarr_out, "tmp": temp_zarr}
+        with multiprocessing.Pool(
+            nprocs, initializer=init_worker, initargs=(stores, all_jobs, read_options)
+        ) as pool:
+            failed = run_tasks(pool, *first, nprocs, batch_size, 0, log, retry_failed,
+                               stage_one=stage_one, upload=upload)
+            run_tasks(pool, *second, nprocs, batch_size, len(first[0]), log,
+                      retry_failed, skip=failed, upload=upload)
+        if uploader is not None and uploader.wait():
+            print(f"{uploader.stats['failed']} uploads failed, the chunks stay in "
+                  f"{zarr_out.store.root} and are uploaded on the next run")
+        if log is not None and log.failed:
+            print(f"{len(log.failed)} tasks failed, see {log.state_dir}/failed.jsonl; "
+                  "rerun with --retry-failed")
+
+
+def iter_indices(job, shape):
+    return itertools.product(*(range(-(-s // c)) for s, c in zip(shape, job[3])))
+
+
+def run_tasks(pool, jobs, shapes, nprocs, batch_size=None, offset=0, log=None,
+              retry_failed=False, stage_one=None, skip=(), upload=None):
+    """Run all pending tasks of `jobs` and return the keys of failed tasks.
+
+    Tasks of jobs writing into the intermediate store (`stage_one`, mapping
+    them to their copy job) are not logged; if one fails, the copy tasks it
+    feeds are marked failed instead. `upload` is called with the job, block
+    index and errors of every other finished task, and returns the upload
+    futures per output; such a task is only logged as done once all of them
+    succeeded.
+    """
+    stage_one = stage_one or {}
+
+    def pending(job_id, index):
+        if job_id in stage_one or log is None:
+            return True
+        key = task_key(jobs[job_id], index)
+        return key not in skip and log.is_pending(key, retry_failed)
+
+    ntasks = sum(
+        pending(job_id, index)
+        for job_id, index in iter_tasks(jobs, shapes)
+    )
+    # batches keep the scheduling overhead low without starving workers
+    batch_size = batch_size or max(1, min(64, ntasks // (4 * nprocs)))
+    # the pool would otherwise read the whole task generator up front
+    window = 16 * nprocs * batch_size
+    tasks = ((job_id + offset, index) for job_id, index in iter_tasks(jobs, shapes)
+             if pending(job_id, index))
+    failed = set()
+    io_total = {}
+    uploading = []
+    with tqdm(total=ntasks) as progress:
+        while batch := list(itertools.islice(tasks, window)):
+            for (job_id, index), errors, io in pool.imap_unordered(
+                    remap, batch, chunksize=batch_size):
+                progress.update()
+                for k, v in (io or {}).items():
+                    io_total[k] = io_total.get(k, 0) + v
+                job_id -= offset
+                if job_id in stage_one:
+                    if errors:
+                        failed.update(copy_keys(jobs[job_id], index,
+                                                stage_one[job_id], log, errors))
+                    continue
+                uploads = {}
+                if upload is not None:
+                    uploads = upload(jobs[job_id], index, errors)
+                if log is None:
+                    continue
+                key = task_key(jobs[job_id], index)
+                if errors:
+                    failed.add(key)
+                    log.record_failed(key, errors)
+                elif uploads:
+                    uploading.append((key, uploads))
+                else:
+                    log.record_done(key)
+            uploading = finish_uploads(uploading, log, failed)
+    finish_uploads(uploading, log, failed, wait=True)
+    if io_total.get("chunks"):
+        print(f"read {io_total['chunks']} chunks ({io_total['chunk_bytes'] / 1e9:.3g} GB) "
+              f"in {io_total['requests']} requests ({io_total['bytes'] / 1e9:.3g} GB)")
+    return failed
+
+
+def chunk_keys(array, slices):
+    """Store keys of the chunks of `array` covered by `slices`."""
+    ranges = [range(s.start // c, -(-s.stop // c))
+              for s, c in zip(slices, array.chunks)]
+    return [array.path + "/" + "/".join(map(str, i))
+            for i in itertools.product(*ranges)]
+
+
+def upload_block(uploader, zarr_out, job, index, errors):
+    # chunks are complete once their task is done, tasks never share chunks
+    futures = {}
+    for name, _, _ in job[2]:
+        if name in errors:
+            continue
+        array = zarr_out[name]
+        keys = chunk_keys(array, block_slice(index, job[3], array.shape))
+        futures[name] = uploader.upload_files(zarr_out.store.root, keys, delete=True)
+    return futures
+
+
+def finish_uploads(uploading, log, failed, wait=False):
+    """Log the tasks in `uploading` whose uploads are finished.
+
+    `uploading` holds (key, futures per output) of tasks that were computed;
+    returns those whose uploads are still running. With `wait`, waits for all.
+    """
+    running = []
+    for key, uploads in uploading:
+        futures = [f for fs in uploads.values() for f in fs]
+        if not wait and not all(f.done() for f in futures):
+            running.append((key, uploads))
+            continue
+        errors = {}
+        for name, fs in uploads.items():
+            for f in fs:
+                if f.exception() is not None:
+                    errors[name] = f"upload failed: {f.exception()}"
+        if errors:
+            failed.add(key)
+            log.record_failed(key, errors)
         else:
-            vars_in = [zarr_in[v] for v in op.__code__.co_varnames]
-
-        dim = len(vars_in[0].shape)
-        chunks = chunks_per_dim.get(dim, vars_in[0].chunks)
-        var_out = gen_array(zarr_out, vars_in[0], chunks, varname_out,
-                            compressor=Blosc(cname='lz4', clevel=5, shuffle=1))
-        print(f"processing {varname_out} {var_out.shape=}...")
-        whole_slice = tuple(slice(s) for s in var_out.shape)
-        op_pickle = cloudpickle.dumps(op)
-        todo_list = [
-            (slic, vars_in, var_out, op_pickle)
-            for slic in iter_slices(whole_slice,
-                                    tuple_max(chunks,
-                                              *(v.chunks for v in vars_in))
-                                    )
-        ]
-        process_map(remap,
-                    todo_list,
-                    max_workers=nprocs)
+            log.record_done(key)
+    return running
+
+
+def copy_keys(job, index, copy_job, log, errors):
+    """Keys of the copy tasks reading from a failed stage-one block."""
+    ranges = [
+        range(i * c // w, -(-(i + 1) * c // w))
+        for i, c, w in zip(index, job[3], copy_job[3])
+    ]
+    keys = [task_key(copy_job, i) for i in itertools.product(*ranges)]
+    if log is not None:
+        for key in keys:
+            log.record_failed(key, errors)
+    return keys
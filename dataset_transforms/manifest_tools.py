@@ -0,0 +1,337 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import xarray as xr
+
+import pyramid_tools
+import zarr_tools
+
+logging.basicConfig()
+logger = logging.getLogger("manifest_tools")
+logger.setLevel(logging.INFO)
+
+
+def get_rank():
+    """(rank, size) of this process within a SLURM job array or job step."""
+    env = os.environ
+    if "SLURM_ARRAY_TASK_ID" in env and "SLURM_ARRAY_TASK_COUNT" in env:
+        offset = int(env.get("SLURM_ARRAY_TASK_MIN", 0))
+        return (
+            int(env["SLURM_ARRAY_TASK_ID"]) - offset,
+            int(env["SLURM_ARRAY_TASK_COUNT"]),
+        )
+    if "SLURM_PROCID" in env and "SLURM_NTASKS" in env:
+        return int(env["SLURM_PROCID"]), int(env["SLURM_NTASKS"])
+    return 0, 1
+
+
+class Manifest:
+    """Per-task completion markers and claim locks on a shared filesystem.
+
+    A task is done once `<key>.done` exists; the marker is written to a temporary
+    file and renamed, so it is never seen half written. A task is claimed by
+    creating `<key>.lock` exclusively. While a task is held (see `holding`), a
+    heartbeat thread touches its lock every `heartbeat` seconds. Locks that have
+    not been touched for `stale_after` seconds are considered left behind by a
+    crashed writer and may be taken over.
+    """
+
+    def __init__(self, path, stale_after=600, heartbeat=None):
+        self.root = Path(f"{path}.manifest")
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.stale_after = stale_after
+        self.heartbeat = heartbeat or stale_after / 10
+        if self.heartbeat >= stale_after:
+            raise ValueError("The heartbeat must be shorter than stale_after")
+        self._tokens = {}
+
+    def _file(self, key, suffix):
+        return self.root / f"{key}.{suffix}"
+
+    def is_done(self, key):
+        return self._file(key, "done").exists()
+
+    def mark_done(self, key):
+        tmp = self._file(key, f"done.{uuid.uuid4().hex}.tmp")
+        tmp.write_text(f"{socket.gethostname()} {os.getpid()} {time.time()}\n")
+        os.replace(tmp, self._file(key, "done"))
+
+    def claim(self, key):
+        """Try to claim `key`; True if this process should write it."""
+        if self.is_done(key):
+            return False
+        lock = self._file(key, "lock")
+        token = uuid.uuid4().hex
+        for _ in range(2):
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._break_stale(lock):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{socket.gethostname()} {os.getpid()} {token}\n")
+            self._tokens[key] = token
+            # the task might have been finished between the check and the claim
+            if self.is_done(key):
+                self.release(key)
+                return False
+            return True
+        return False
+
+    def owns(self, key):
+        """Whether the lock of `key` is still the one this manifest created."""
+        try:
+            content = self._file(key, "lock").read_text().split()
+        except FileNotFoundError:
+            return False
+        return key in self._tokens and content[-1:] == [self._tokens[key]]
+
+    def touch(self, key):
+        """Refresh the lock of `key`; False if it was taken over meanwhile."""
+        if not self.owns(key):
+            return False
+        try:
+            os.utime(self._file(key, "lock"))
+        except FileNotFoundError:
+            return False
+        return True
+
+    @contextmanager
+    def holding(self, key):
+        """Keep the claim on `key` alive while the body runs, then release it.
+
+        Yields a function that tells whether the claim is still held, i.e. was
+        never taken over by another process.
+        """
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat):
+                if not self.touch(key):
+                    logger.error(f"Lost the lock on {key} in {self.root}")
+                    lost.set()
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield lambda: not lost.is_set() and self.owns(key)
+        finally:
+            stop.set()
+            thread.join()
+            self.release(key)
+
+    def _break_stale(self, lock):
+        try:
+            age = time.time() - lock.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self.stale_after:
+            return False
+        # rename first, so only one of several competing processes removes it
+        stale = lock.with_name(f"{lock.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(lock, stale)
+        except FileNotFoundError:
+            return True
+        logger.warning(f"Taking over stale lock {lock} (no heartbeat for {age:.0f}s)")
+        stale.unlink(missing_ok=True)
+        return True
+
+    def release(self, key):
+        # never remove a lock that another process has taken over
+        if self.owns(key):
+            self._file(key, "lock").unlink(missing_ok=True)
+        self._tokens.pop(key, None)
+
+    def wait_for(self, key, poll=10, timeout=None):
+        start = time.monotonic()
+        while not self.is_done(key):
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"{key} in {self.root} did not complete")
+            time.sleep(poll)
+
+
+def write_parts_cooperative(
+    outds: xr.Dataset,
+    path: Path,
+    time_chunk: int,
+    timechunk: int,
+    order: int,
+    split_variables=False,
+    rank=None,
+    size=None,
+    nthreads=None,
+    stale_after=600,
+):
+    """Write `outds` into `path` together with any number of other processes.
+
+    The work is split into tasks per block of `time_chunk` time steps (and per
+    variable if `split_variables`). Every process starts with its own share of
+    the tasks (by `rank` and `size`, taken from SLURM if not given) and then
+    helps with whatever is left unclaimed. Finished tasks are recorded in a
+    manifest next to the store, so a re-run only writes what is missing.
+
+    Returns the number of tasks that are not done yet, e.g. because they are
+    still being written by another process.
+    """
+    return _write_cooperative(
+        outds,
+        {order: (Path(path), outds)},
+        lambda block: [(order, block)],
+        time_chunk=time_chunk,
+        timechunk=timechunk,
+        split_variables=split_variables,
+        rank=rank,
+        size=size,
+        nthreads=nthreads,
+        stale_after=stale_after,
+    )
+
+
+def write_pyramid_cooperative(
+    outds: xr.Dataset,
+    paths: dict,
+    time_chunk: int,
+    timechunk: int,
+    split_variables=False,
+    rank=None,
+    size=None,
+    nthreads=None,
+    stale_after=600,
+):
+    """Like `pyramid_tools.write_pyramid`, but shared between processes.
+
+    Tasks are split as in `write_parts_cooperative`. A task computes its block
+    of `outds` once and writes it to the stores of all zooms in `paths`. The
+    manifest is kept next to the store of the finest zoom.
+    """
+    max_order = pyramid_tools.get_order(outds)
+    if max(paths) > max_order:
+        raise ValueError(f"Cannot write zooms finer than the input zoom {max_order}")
+    stores = {
+        order: (
+            Path(path),
+            (
+                outds
+                if order == max_order
+                else pyramid_tools.coarsen_template(outds, order)
+            ),
+        )
+        for order, path in paths.items()
+    }
+    return _write_cooperative(
+        outds,
+        stores,
+        lambda block: pyramid_tools.iter_pyramid(block, stores),
+        time_chunk=time_chunk,
+        timechunk=timechunk,
+        split_variables=split_variables,
+        rank=rank,
+        size=size,
+        nthreads=nthreads,
+        stale_after=stale_after,
+    )
+
+
+def _write_cooperative(
+    outds,
+    stores,
+    levels,
+    time_chunk,
+    timechunk,
+    split_variables,
+    rank,
+    size,
+    nthreads,
+    stale_after,
+):
+    """Write blocks of `outds` into `stores`, which map orders to (path, template).
+
+    `levels(block)` yields (order, dataset) to write for a computed block.
+    """
+    if rank is None or size is None:
+        rank, size = get_rank()
+    manifest = Manifest(stores[max(stores)][0], stale_after=stale_after)
+
+    # keep trying to claim while waiting, so the stale lock of a rank that
+    # crashed while creating the stores is taken over
+    while not manifest.is_done("structure"):
+        if not manifest.claim("structure"):
+            time.sleep(manifest.heartbeat)
+            continue
+        with manifest.holding("structure"):
+            for order, (path, template) in stores.items():
+                if not path.exists():
+                    zarr_tools.create_zarr_structure(
+                        path=path, outds=template, timechunk=timechunk, order=order
+                    )
+            manifest.mark_done("structure")
+
+    # coordinates and timeless variables are small and written by a single task
+    data_vars = [v for v in outds.data_vars if "time" in outds[v].dims]
+    groups = {order: zarr_tools.open_group(path) for order, (path, _) in stores.items()}
+    # concurrent writers must never share a chunk, in any of the stores
+    planned = {
+        order: zarr_tools.plan_time_slices(
+            group, data_vars, len(outds.time), time_chunk, strict=True
+        )[0]
+        for order, group in groups.items()
+    }
+    slices = planned.pop(max(stores))
+    if any(other != slices for other in planned.values()):
+        raise ValueError("The stores of all zooms must be written in the same slices")
+    timed = outds[data_vars].drop_vars(list(outds.coords))
+    variable_groups = [[v] for v in data_vars] if split_variables else [data_vars]
+    tasks = [("meta", None, None)]
+    for tslice in slices:
+        for variables in variable_groups:
+            name = f"t{tslice.start}"
+            name += f".{variables[0]}" if split_variables else ""
+            tasks.append((name, tslice, variables))
+    # legacy sequential status: everything before it has been written
+    start = min(zarr_tools.check_for_status(path)[1] for path, _ in stores.values())
+    for name, tslice, _ in tasks:
+        done = start > 0 and (tslice is None or tslice.stop <= start)
+        if done and not manifest.is_done(name):
+            manifest.mark_done(name)
+
+    ordered = [t for k, t in enumerate(tasks) if k % size == rank]
+    ordered += [t for k, t in enumerate(tasks) if k % size != rank]
+    written = 0
+    with ThreadPoolExecutor(nthreads or os.cpu_count()) as pool:
+        for name, tslice, variables in ordered:
+            if not manifest.claim(name):
+                continue
+            with manifest.holding(name) as held:
+                if tslice is None:
+                    for path, template in stores.values():
+                        template.drop_vars(data_vars).to_zarr(path, mode="r+")
+                else:
+                    block = zarr_tools.compute_block(timed[variables].isel(time=tslice))
+                    for order, wds in levels(block):
+                        path = stores[order][0]
+                        zarr_tools.write_region(wds, groups[order], path, tslice, pool)
+                if not held():
+                    # the process that took over writes it again
+                    logger.error(f"Rank {rank}/{size} lost {name} while writing it")
+                    continue
+                manifest.mark_done(name)
+                written += 1
+                logger.info(f"Rank {rank}/{size} wrote {name}")
+
+    missing = [name for name, _, _ in tasks if not manifest.is_done(name)]
+    logger.info(
+        f"Rank {rank}/{size} wrote {written} tasks, {len(missing)} of {len(tasks)} "
+        "still missing"
+    )
+    return len(missing)
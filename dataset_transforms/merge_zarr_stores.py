@@ -2,24 +2,47 @@
 # -*- coding: utf-8 -*-
 # BSD 3-Clause License
 
+import errno
+import fcntl
+import hashlib
 import os
 import shutil
 import glob
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List
-import filecmp
+import uuid
 import zarr
 import json
+from tqdm import tqdm
 
+LINK_MODES = ("copy", "hardlink", "reflink", "symlink")
+# zarr metadata is always copied, so it can be edited in the clone
+METADATA_FILES = (".zarray", ".zattrs", ".zgroup", ".zmetadata", "zarr.json")
+# ioctl cloning a whole file on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+# errors meaning that a link mode does not work on this filesystem at all
+UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS, errno.EINVAL)
 
-def clone_dataset(source_dirs: List[Path], target_dir: Path):
+
+def clone_dataset(
+    source_dirs: List[Path],
+    target_dir: Path,
+    link_mode: str = "symlink",
+    nthreads: int = 16,
+):
     target = Path(target_dir)
     target.mkdir(parents=True)
     source_dirs = [Path(d).resolve() for d in source_dirs]
     files, dirs = get_files(source_dirs)
-    files = sort_duplicates(files)
-    dirs = sort_duplicates(dirs)
-    do_cloning(target, files, dirs)
+    manifests = {d: StoreManifest(d, nthreads) for d in source_dirs}
+    files = sort_duplicates(files, manifests)
+    dirs = sort_duplicates(dirs, manifests)
+    for manifest in manifests.values():
+        manifest.save()
+    do_cloning(target, files, dirs, link_mode, nthreads)
     merge_zattrs(source_dirs, target)
     zarr.consolidate_metadata(target)
 
@@ -33,16 +56,109 @@ def merge_zattrs(source_dirs: List[Path], target_dir: Path):
         json.dump(attrs, f)
 
 
-def do_cloning(target, files, dirs):
-    [shutil.copy(f, target) for f in files]
+def do_cloning(target, files, dirs, link_mode="symlink", nthreads=16):
+    """Clone the top-level `files` and variable `dirs` into `target`.
+
+    Metadata files are copied. Chunks are cloned with `link_mode`; with
+    "symlink", directories below the variables are linked as a whole, the
+    other modes clone every file in them.
+    """
+    operations = [(Path(f), Path(target, os.path.basename(f)), "copy") for f in files]
     for d in dirs:
-        os.makedirs(Path(target, os.path.basename(d)))
-        ff, dd = get_source_files_and_dirs(d)
         t = Path(target, os.path.basename(d))
-        for f in ff:
-            shutil.copy(f, t)
+        os.makedirs(t)
+        ff, dd = get_source_files_and_dirs(d)
+        operations += [(Path(f), Path(t, os.path.basename(f)), None) for f in ff]
         for _d in dd:
-            os.symlink(_d, Path(t, os.path.basename(_d)))
+            if link_mode == "symlink":
+                operations.append((Path(_d), Path(t, os.path.basename(_d)), None))
+                continue
+            for root, _, names in os.walk(_d):
+                sub = Path(t, os.path.relpath(root, d))
+                sub.mkdir(exist_ok=True)
+                operations += [(Path(root, n), Path(sub, n), None) for n in names]
+    cloner = Cloner(link_mode, nthreads)
+    cloner.run(operations)
+    cloner.report()
+    return cloner
+
+
+def reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+class Cloner:
+    """Clone files with a pool of threads, using links where possible.
+
+    If `link_mode` fails for a file, the file is copied instead, and if the
+    filesystem does not support it at all, all remaining files are copied.
+    """
+
+    def __init__(self, link_mode="symlink", nthreads=16):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"link_mode must be one of {LINK_MODES}")
+        self.link_mode = link_mode
+        self.nthreads = nthreads
+        self.counts = {mode: 0 for mode in LINK_MODES}
+        self.nbytes = 0
+        self.copied_bytes = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def clone(self, src, dst, mode=None):
+        """Clone `src` to `dst`, returns the mode actually used."""
+        mode = mode or self.link_mode
+        if os.path.basename(src) in METADATA_FILES:
+            mode = "copy"
+        if mode != "copy":
+            try:
+                if mode == "symlink":
+                    os.symlink(src, dst)
+                elif mode == "hardlink":
+                    os.link(src, dst)
+                else:
+                    reflink(src, dst)
+            except OSError as e:
+                with self._lock:
+                    if e.errno in UNSUPPORTED and mode == self.link_mode:
+                        print(f"{mode} is not supported for {dst} ({e}), copying")
+                        self.link_mode = "copy"
+                mode = "copy"
+        if mode == "copy" and os.path.isdir(src):
+            shutil.copytree(src, dst)
+        elif mode == "copy":
+            shutil.copyfile(src, dst)
+        return mode
+
+    def _clone(self, operation):
+        src, dst, mode = operation
+        size = 0 if src.is_dir() else src.stat().st_size
+        mode = self.clone(src, dst, mode)
+        with self._lock:
+            self.counts[mode] += 1
+            self.nbytes += size
+            if mode == "copy":
+                self.copied_bytes += size
+        return size
+
+    def run(self, operations):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.nthreads) as pool, tqdm(
+            total=len(operations), unit="file"
+        ) as progress:
+            for _ in pool.map(self._clone, operations):
+                progress.update()
+        self.seconds += time.perf_counter() - start
+
+    def report(self):
+        modes = ", ".join(f"{n} {mode}" for mode, n in self.counts.items() if n)
+        rate = self.copied_bytes / self.seconds / 1e6 if self.seconds else 0.0
+        print(
+            f"cloned {sum(self.counts.values())} entries ({modes}) of "
+            f"{self.nbytes / 1e9:.3g} GB in {self.seconds:.1f}s, "
+            f"copied {self.copied_bytes / 1e9:.3g} GB at {rate:.0f} MB/s"
+        )
 
 
 def get_files(source_dirs: List[Path]):
@@ -60,7 +176,8 @@ def to_be_ignored(f):
     return False
 
 
-def sort_duplicates(items: dict):
+def sort_duplicates(items: dict, manifests: dict = None):
+    manifests = manifests if manifests is not None else {}
     new_names = {}
     for source_dir, source_files in items.items():
         for f in source_files:
@@ -69,26 +186,95 @@ def sort_duplicates(items: dict):
                 if f not in new_names:
                     new_names[f] = source_dir
                 else:
-                    check_duplicate(f"{source_dir}/{f}", f"{new_names[f]}/{f}")
+                    for d in (source_dir, new_names[f]):
+                        if d not in manifests:
+                            manifests[d] = StoreManifest(d)
+                    check_duplicate(f, manifests[source_dir], manifests[new_names[f]])
     return [Path(d) / Path(f) for f, d in new_names.items()]
 
 
-def check_duplicate(f1, f2):
-    if Path(f1).is_dir():
-        comp = run_dircomp(f1, f2)
-    else:
-        comp = filecmp.cmp
-    if not comp(f1, f2):
-        raise ValueError(f"Files {f1} and {f2} are different but should be the same.")
+def check_duplicate(key, manifest1, manifest2):
+    """Raise if the file or directory `key` differs between two stores."""
+    e1, e2 = manifest1.entries(key), manifest2.entries(key)
+    only = sorted(e1.keys() ^ e2.keys())
+    different = sorted(k for k in e1.keys() & e2.keys() if e1[k] != e2[k])
+    if only or different:
+        raise ValueError(
+            f"Files ['{manifest1.root}','{manifest2.root}']/{key}/{only + different} "
+            "are different but should be the same."
+        )
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(
+            f, lambda: hashlib.blake2b(digest_size=16)
+        ).hexdigest()
+
+
+class StoreManifest:
+    """(size, mtime, hash) of the files of a store, cached next to it.
+
+    The manifest is kept in `<store>.manifest.json` and reused by later
+    merges: only files whose size or mtime changed are hashed again. Only
+    the parts of a store that are compared are hashed, in a thread pool.
+    """
+
+    def __init__(self, root, nthreads=16):
+        self.root = Path(root)
+        self.path = Path(f"{self.root}.manifest.json")
+        self.nthreads = nthreads
+        self.files = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.files = json.load(f)
+        self.hashed = 0
+        self.reused = 0
+
+    def _stat(self, key):
+        st = os.stat(self.root / key)
+        return st.st_size, st.st_mtime_ns
 
+    def entries(self, key):
+        """{relative path: (size, hash)} of the files at or below `key`."""
+        path = self.root / key
+        if path.is_dir():
+            keys = [
+                os.path.relpath(os.path.join(d, n), self.root)
+                for d, _, names in os.walk(path, followlinks=True)
+                for n in names
+            ]
+        else:
+            keys = [key]
+        with ThreadPoolExecutor(self.nthreads) as pool:
+            stats = dict(zip(keys, pool.map(self._stat, keys)))
+            stale = [
+                k for k in keys if self.files.get(k, [None, None])[:2] != list(stats[k])
+            ]
+            hashes = pool.map(lambda k: file_hash(self.root / k), stale)
+            for k, h in zip(stale, hashes):
+                self.files[k] = [*stats[k], h]
+        self.hashed += len(stale)
+        self.reused += len(keys) - len(stale)
+        return {
+            os.path.relpath(k, key): (self.files[k][0], self.files[k][2]) for k in keys
+        }
 
-def run_dircomp(f1, f2):
-    dcmp = filecmp.dircmp(f1, f2)
-    for x in [dcmp.left_only, dcmp.right_only, dcmp.diff_files, dcmp.funny_files]:
-        if x:
-            raise ValueError(
-                f"Files ['{f1}','{f2}']/{x} are different but should be the same."
-            )
+    def save(self):
+        if not self.hashed + self.reused:
+            return
+        tmp = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            if self.hashed:
+                with open(tmp, "w") as f:
+                    json.dump(self.files, f)
+                os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Could not cache the manifest of {self.root}: {e}")
+        print(
+            f"{self.root}: hashed {self.hashed} files, "
+            f"{self.reused} unchanged since the last merge"
+        )
 
 
 def get_source_files_and_dirs(path: Path):
@@ -104,9 +290,16 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Clone a dataset to a new location")
     parser.add_argument("source_dirs", type=Path, help="Source directories", nargs="+")
     parser.add_argument("target_dir", type=Path, help="Target directory")
+    parser.add_argument(
+        "--link-mode",
+        choices=LINK_MODES,
+        default="symlink",
+        help="how chunks are cloned, falling back to copy where not supported",
+    )
+    parser.add_argument("--nthreads", type=int, default=16)
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
-    clone_dataset(args.source_dirs, args.target_dir)
+    clone_dataset(args.source_dirs, args.target_dir, args.link_mode, args.nthreads)
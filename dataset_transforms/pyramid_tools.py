@@ -0,0 +1,121 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+import coarsen_tools
+import zarr_tools
+
+logging.basicConfig()
+logger = logging.getLogger("pyramid_tools")
+logger.setLevel(logging.INFO)
+
+
+def get_order(ds):
+    npix = ds.sizes["cell"]
+    order = int(round(np.log(npix / 12) / np.log(4)))
+    if 12 * 4**order != npix:
+        raise ValueError(f"{npix} cells is not a healpix grid")
+    return order
+
+
+def coarsen_template(ds, order):
+    """Lazily coarsen every variable with a cell dimension to healpix `order`.
+
+    Means are taken over the valid (non-NaN) children only.
+    """
+    factor = 4 ** (get_order(ds) - order)
+    cell_vars = [v for v in ds.variables if "cell" in ds[v].dims and v != "cell"]
+    coarse = ds[cell_vars].coarsen(cell=factor, boundary="exact").mean(keep_attrs=True)
+    out = ds.drop_vars(cell_vars + (["cell"] if "cell" in ds.variables else []))
+    out = out.assign(coarse.data_vars).assign_coords(
+        {c: coarse[c] for c in coarse.coords if c != "cell"}
+    )
+    if "cell" in ds.variables:
+        out = out.assign_coords(cell=np.arange(12 * 4**order))
+    for v in out.variables:
+        if "healpix_zoom" in out[v].attrs:
+            out[v].attrs["healpix_zoom"] = order
+    return out
+
+
+def iter_pyramid(block, orders):
+    """Yield (order, dataset) for the in-memory finest-zoom `block` and all coarser
+    `orders`, in descending order. Coarse values are exact NaN-aware means of the
+    finest cells; variables without a cell dimension are the same at every zoom."""
+    max_order = get_order(block)
+    orders = sorted(orders, reverse=True)
+    cell_vars = [v for v in block.data_vars if "cell" in block[v].dims]
+    other_vars = {v: block[v] for v in block.data_vars if v not in cell_vars}
+    state = {}
+    for v in cell_vars:
+        da = block[v].transpose(..., "cell")
+        state[v] = (da.dims, *coarsen_tools.to_sums(da.values))
+
+    order = max_order
+    for target in orders:
+        if target == max_order:
+            yield target, block
+            continue
+        state = {
+            v: (dims, *coarsen_tools.coarsen_sums(sums, counts, order - target))
+            for v, (dims, sums, counts) in state.items()
+        }
+        order = target
+        data_vars = {
+            v: (dims, coarsen_tools.from_sums(sums, counts))
+            for v, (dims, sums, counts) in state.items()
+        }
+        coords = {c: block[c] for c in block.coords if "cell" not in block[c].dims}
+        yield target, xr.Dataset({**data_vars, **other_vars}, coords=coords)
+
+
+def write_pyramid(
+    outds: xr.Dataset, paths: dict, timechunk: int, time_chunk: int, nthreads=None
+):
+    """Write `outds` and all its coarser healpix zooms in a single pass.
+
+    `outds` is at the finest zoom, `paths` maps every zoom to write (including
+    the finest one) to its Zarr store. Each time block of `outds` is computed
+    once and written to all stores before the next block is read. Stores are
+    created with the chunking of `chunk_tools` for their zoom.
+    """
+    max_order = get_order(outds)
+    paths = {order: Path(p) for order, p in paths.items()}
+    if max(paths) > max_order:
+        raise ValueError(f"Cannot write zooms finer than the input zoom {max_order}")
+    starts = []
+    for order, path in paths.items():
+        template = outds if order == max_order else coarsen_template(outds, order)
+        if not path.exists():
+            zarr_tools.create_zarr_structure(
+                path=path, outds=template, timechunk=timechunk, order=order
+            )
+        _, start = zarr_tools.check_for_status(path)
+        zarr_tools.handle_timeless_variables(template, path, start)
+        starts.append(start)
+
+    timed = outds.drop_vars([v for v in outds.variables if "time" not in outds[v].dims])
+    groups = {order: zarr_tools.open_group(path) for order, path in paths.items()}
+    slices, _ = zarr_tools.plan_time_slices(
+        groups[max(paths)],
+        list(timed.data_vars),
+        len(outds.time),
+        time_chunk,
+        min(starts),
+    )
+    with ThreadPoolExecutor(nthreads or os.cpu_count()) as pool:
+        for tslice in slices:
+            block = zarr_tools.compute_block(timed.isel(time=tslice))
+            for order, wds in iter_pyramid(block, paths):
+                zarr_tools.write_region(wds, groups[order], paths[order], tslice, pool)
+            for path in paths.values():
+                with open(path / Path(".write_status"), mode="w") as status:
+                    status.write(str(tslice.stop))
+            logger.info(
+                f"Processed time steps starting at {tslice.start} "
+                f"for zooms {sorted(paths)}"
+            )
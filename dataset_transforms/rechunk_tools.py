@@ -0,0 +1,87 @@
+import logging
+import math
+
+logging.basicConfig()
+logger = logging.getLogger("rechunk_tools")
+logger.setLevel(logging.INFO)
+
+
+def read_amplification(shape, chunks, region):
+    """Elements decoded per element wanted when reading `region`-sized blocks
+    (aligned to multiples of `region`) from an array stored with `chunks`."""
+    factor = 1.0
+    for size, chunk, reg in zip(shape, chunks, region):
+        touched = 0
+        for start in range(0, size, reg):
+            stop = min(start + reg, size)
+            first, last = start // chunk, (stop - 1) // chunk
+            touched += min((last + 1) * chunk, size) - first * chunk
+        factor *= touched / size
+    return factor
+
+
+def consolidate(chunks, limit, max_elems):
+    """Grow `chunks` by integer multiples towards `limit` within `max_elems`."""
+    chunks = list(chunks)
+    # grow the dimensions that need it most first
+    order = sorted(range(len(chunks)), key=lambda d: chunks[d] / limit[d])
+    for d in order:
+        others = math.prod(chunks) // chunks[d]
+        factor = max(1, min(limit[d] // chunks[d], max_elems // (others * chunks[d])))
+        chunks[d] = min(chunks[d] * factor, limit[d])
+    return tuple(chunks)
+
+
+def _largest_divisor(n, at_most):
+    return max(d for d in range(1, min(n, at_most) + 1) if n % d == 0)
+
+
+def plan_rechunk(shape, source_chunks, target_chunks, itemsize, max_mem):
+    """Plan copying an array from `source_chunks` to `target_chunks`.
+
+    `itemsize` is the number of bytes held in memory per element (summed over
+    all arrays processed together) and `max_mem` the memory budget of a worker.
+    Following the rechunker algorithm, the plan is one of
+
+    - "direct": source and target chunks coincide, copy chunk by chunk
+    - "memory": blocks covering whole source and target chunks fit in memory,
+      read and write each chunk exactly once
+    - "intermediate": read large blocks of whole source chunks into an
+      intermediate store, and write whole target chunks from it
+
+    Returns a dict with the strategy, the block shapes of the copy stages, the
+    intermediate chunks and the predicted bytes moved (read plus written).
+    """
+    shape = tuple(shape)
+    source = tuple(min(c, s) for c, s in zip(source_chunks, shape))
+    target = tuple(min(c, s) for c, s in zip(target_chunks, shape))
+    max_elems = max(1, int(max_mem // itemsize))
+    nbytes = math.prod(shape) * itemsize
+    common = tuple(min(math.lcm(a, b), s) for a, b, s in zip(source, target, shape))
+
+    if source == target:
+        plan = dict(strategy="direct", read_chunks=target, write_chunks=target)
+    elif math.prod(common) <= max_elems:
+        plan = dict(strategy="memory", read_chunks=common, write_chunks=common)
+    else:
+        read = consolidate(source, common, max_elems)
+        write = consolidate(target, common, max_elems)
+        # intermediate chunks tile the read blocks, so stage one never shares a chunk
+        inter = tuple(_largest_divisor(r, w) for r, w in zip(read, write))
+        plan = dict(
+            strategy="intermediate",
+            read_chunks=read,
+            write_chunks=write,
+            intermediate_chunks=inter,
+        )
+
+    moved = nbytes * read_amplification(shape, source, plan["read_chunks"])
+    if plan["strategy"] == "intermediate":
+        moved += nbytes  # write intermediate
+        moved += nbytes * read_amplification(
+            shape, plan["intermediate_chunks"], plan["write_chunks"]
+        )
+    moved += nbytes * read_amplification(shape, target, plan["write_chunks"])
+    plan["bytes_moved"] = int(moved)
+    plan["nbytes"] = nbytes
+    return plan
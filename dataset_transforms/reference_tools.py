@@ -0,0 +1,391 @@
+import base64
+import bisect
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import shutil
+import uuid
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import fsspec
+import numpy as np
+import zarr
+from fsspec.utils import merge_offset_ranges
+from numcodecs.compat import ensure_ndarray_like
+
+logging.basicConfig()
+logger = logging.getLogger("reference_tools")
+logger.setLevel(logging.INFO)
+
+# one row per chunk: index into the urls, byte offset and size
+REF_DTYPE = np.dtype([("url", "<i4"), ("offset", "<i8"), ("size", "<i8")])
+MISSING = -1
+WHOLE_FILE = -1
+META_KEYS = (".zarray", ".zattrs", ".zgroup", ".zmetadata")
+
+
+def load_references(path):
+    """Reference dict (version 0 layout) from a kerchunk/gribscan json file."""
+    with fsspec.open(path, "rb") as f:
+        refs = json.load(f)
+    if refs.get("version") != 1:
+        return refs
+    if refs.get("gen"):
+        raise ValueError(f"{path}: generated references are not supported")
+    templates = refs.get("templates", {})
+    out = {}
+    for key, ref in refs["refs"].items():
+        if isinstance(ref, list) and "{{" in ref[0]:
+            url = ref[0].replace("{{", "{").replace("}}", "}").format(**templates)
+            ref = [url, *ref[1:]]
+        out[key] = ref
+    return out
+
+
+def _array_name(key):
+    name, _, last = key.rpartition("/")
+    return name, last
+
+
+def build_index(refs, index_dir):
+    """Write `refs` as a reference index into `index_dir`.
+
+    Metadata and inlined data go into `meta.json`. The chunk references of
+    every array become a table of (url, offset, size) rows in C order of the
+    chunk grid, stored as `.npy` files that are memory-mapped when opened.
+    """
+    index_dir = Path(index_dir)
+    meta, inline = {}, {}
+    arrays = {}
+    for key, ref in refs.items():
+        name, last = _array_name(key)
+        if last in META_KEYS or last == "zarr.json":
+            meta[key] = ref if isinstance(ref, str) else json.dumps(ref)
+        if last == ".zarray":
+            zarray = json.loads(meta[key])
+            arrays[name] = dict(
+                grid=[-(-s // c) for s, c in zip(zarray["shape"], zarray["chunks"])],
+                separator=zarray.get("dimension_separator") or ".",
+            )
+
+    urls = {}
+    rows = {name: [] for name in arrays}
+    for key, ref in refs.items():
+        if key in meta:
+            continue
+        name, index = _chunk_index(key, arrays)
+        if name is None:
+            logger.warning(f"Skipping reference {key} outside of any array")
+            continue
+        if isinstance(ref, str):
+            inline[key] = ref
+            continue
+        url = urls.setdefault(ref[0], len(urls))
+        if len(ref) == 1:
+            rows[name].append((index, (url, 0, WHOLE_FILE)))
+        else:
+            rows[name].append((index, (url, ref[1], ref[2])))
+
+    tables = {}
+    for name, a in arrays.items():
+        tables[name] = np.zeros(math.prod(a["grid"]), dtype=REF_DTYPE)
+        tables[name]["url"] = MISSING
+        if rows[name]:
+            indices, values = zip(*rows[name])
+            row = np.ravel_multi_index(np.array(indices).T, a["grid"])
+            tables[name][row] = np.array(list(values), dtype=REF_DTYPE)
+
+    # write to a temporary directory first, so readers never see half an index
+    tmp = index_dir.with_name(f"{index_dir.name}.{uuid.uuid4().hex}.tmp")
+    tmp.mkdir(parents=True)
+    for i, (name, table) in enumerate(tables.items()):
+        arrays[name]["file"] = f"{i}.npy"
+        np.save(tmp / arrays[name]["file"], table)
+    with open(tmp / "meta.json", "w") as f:
+        json.dump(dict(meta=meta, inline=inline, urls=list(urls), arrays=arrays), f)
+    if index_dir.exists():
+        shutil.rmtree(index_dir)
+    os.replace(tmp, index_dir)
+    return index_dir
+
+
+def _chunk_index(key, arrays):
+    parts = key.split("/")
+    for i in range(len(parts) - 1, 0, -1):
+        name = "/".join(parts[:i])
+        if name in arrays:
+            rest = "/".join(parts[i:])
+            try:
+                return name, tuple(
+                    int(i) for i in rest.split(arrays[name]["separator"])
+                )
+            except ValueError:
+                return None, None
+    return None, None
+
+
+class ReferenceIndex(Mapping):
+    """Read-only reference mapping backed by an index from `build_index`.
+
+    Only the small metadata is read when opening. The chunk table of an array
+    is memory-mapped on first access, so processes on a node share it through
+    the page cache. Pickling only transfers the path.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / "meta.json") as f:
+            info = json.load(f)
+        self.meta = info["meta"]
+        self.inline = info["inline"]
+        self.urls = info["urls"]
+        self.arrays = info["arrays"]
+        self._tables = {}
+
+    def __getstate__(self):
+        return {"index_dir": self.index_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["index_dir"])
+
+    def __repr__(self):
+        return f"ReferenceIndex({str(self.index_dir)!r})"
+
+    def table(self, name):
+        if name not in self._tables:
+            self._tables[name] = np.load(
+                self.index_dir / self.arrays[name]["file"], mmap_mode="r"
+            )
+        return self._tables[name]
+
+    def __getitem__(self, key):
+        if key in self.meta:
+            return self.meta[key]
+        if key in self.inline:
+            ref = self.inline[key]
+            if ref.startswith("base64:"):
+                return base64.b64decode(ref[7:])
+            return ref
+        name, index = _chunk_index(key, self.arrays)
+        if name is None:
+            raise KeyError(key)
+        grid = self.arrays[name]["grid"]
+        if len(index) != len(grid) or any(not 0 <= i < n for i, n in zip(index, grid)):
+            raise KeyError(key)
+        url, offset, size = self.table(name)[np.ravel_multi_index(index, grid)]
+        if url == MISSING:
+            raise KeyError(key)
+        if size == WHOLE_FILE:
+            return [self.urls[url]]
+        return [self.urls[url], int(offset), int(size)]
+
+    def _chunk_keys(self, name):
+        a = self.arrays[name]
+        table = self.table(name)
+        for row in np.flatnonzero(table["url"] != MISSING):
+            index = np.unravel_index(row, a["grid"])
+            yield f"{name}/" + a["separator"].join(str(i) for i in index)
+
+    def __iter__(self):
+        yield from self.meta
+        yield from self.inline
+        for name in self.arrays:
+            yield from self._chunk_keys(name)
+
+    def __len__(self):
+        return (
+            len(self.meta)
+            + len(self.inline)
+            + sum(int((self.table(n)["url"] != MISSING).sum()) for n in self.arrays)
+        )
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+
+def index_path(path, cache_dir):
+    """Index directory for the reference file `path` within `cache_dir`."""
+    path = os.path.abspath(path)
+    digest = hashlib.sha1(path.encode()).hexdigest()[:16]
+    return Path(cache_dir) / f"{Path(path).stem}-{digest}"
+
+
+def get_index(path, cache_dir="reference_index"):
+    """Reference index of the json file `path`, built on first use.
+
+    The index is rebuilt when the json file is newer than the index.
+    """
+    index_dir = index_path(path, cache_dir)
+    meta = index_dir / "meta.json"
+    if not meta.exists() or meta.stat().st_mtime < os.path.getmtime(path):
+        logger.info(f"Building reference index {index_dir} from {path}")
+        build_index(load_references(path), index_dir)
+    return ReferenceIndex(index_dir)
+
+
+def open_references(path, cache_dir="reference_index", remote_options=None):
+    """Open the references in `path` as a read-only zarr group through an index.
+
+    A drop-in replacement for `zarr.open("reference::" + path, mode="r")`.
+    """
+    refs = get_index(path, cache_dir)
+    protocol = "file"
+    if refs.urls:
+        protocol = fsspec.core.split_protocol(refs.urls[0])[0] or "file"
+    fs = fsspec.filesystem(
+        "reference",
+        fo=refs,
+        remote_protocol=protocol,
+        remote_options=remote_options,
+        asynchronous=True,
+        skip_instance_cache=True,
+    )
+    store = zarr.storage.FsspecStore(fs, read_only=True, path="")
+    return zarr.open_group(store, mode="r")
+
+
+def _references(array):
+    """References behind `array`, if it is a zarr 2 array in a reference store."""
+    refs = getattr(getattr(array.store, "fs", None), "references", None)
+    if refs is None or array.metadata.zarr_format != 2:
+        return None
+    return refs
+
+
+def _chunk_selections(array, selection):
+    """(chunk coords, selection within the chunk, selection in the output)."""
+    ranges = []
+    for sl, c in zip(selection, array.chunks):
+        ranges.append(range(sl.start // c, -(-sl.stop // c)))
+    for coords in itertools.product(*ranges):
+        chunk_sel, out_sel = [], []
+        for i, sl, c in zip(coords, selection, array.chunks):
+            start, stop = max(sl.start, i * c), min(sl.stop, (i + 1) * c)
+            chunk_sel.append(slice(start - i * c, stop - i * c))
+            out_sel.append(slice(start - sl.start, stop - sl.start))
+        yield coords, tuple(chunk_sel), tuple(out_sel)
+
+
+def decode_chunk(array, buf):
+    meta = array.metadata
+    if meta.compressor is not None:
+        buf = meta.compressor.decode(buf)
+    for f in reversed(meta.filters or ()):
+        buf = f.decode(buf)
+    chunk = ensure_ndarray_like(buf).view(array.dtype)
+    return chunk.reshape(array.chunks, order=meta.order)
+
+
+class CoalescingReader:
+    """Read blocks of reference-backed zarr arrays with few, large requests.
+
+    The byte ranges of all chunks needed for a selection of several arrays
+    are collected first. Ranges in the same file that are at most `max_gap`
+    bytes apart are merged into requests of up to `max_block` bytes, and the
+    chunks are decoded from the fetched buffers in a thread pool. Arrays that
+    are not backed by references are read as usual.
+
+    `stats` counts the requests and bytes fetched and the chunks and bytes
+    that were actually referenced.
+    """
+
+    def __init__(self, max_gap=2**16, max_block=2**28, nthreads=4, remote_options=None):
+        self.max_gap = max_gap
+        self.max_block = max_block
+        self.remote_options = remote_options or {}
+        self.pool = ThreadPoolExecutor(nthreads)
+        self.stats = dict(requests=0, bytes=0, chunks=0, chunk_bytes=0)
+
+    def read(self, arrays, selection):
+        """Read `selection`, a tuple of slices, from every array in `arrays`."""
+        out, plan = {}, []
+        for name, array in arrays.items():
+            refs = _references(array)
+            sel = tuple(selection) + (slice(None),) * (array.ndim - len(selection))
+            sel = tuple(slice(*sl.indices(n)[:2]) for sl, n in zip(sel, array.shape))
+            if refs is None:
+                out[name] = array[sel]
+                continue
+            fill = array.fill_value
+            if fill is None:
+                fill = np.nan if array.dtype.kind == "f" else 0
+            out[name] = np.full(
+                tuple(sl.stop - sl.start for sl in sel), fill, array.dtype
+            )
+            prefix = f"{array.path}/" if array.path else ""
+            for coords, chunk_sel, out_sel in _chunk_selections(array, sel):
+                try:
+                    ref = refs[prefix + array.metadata.encode_chunk_key(coords)]
+                except KeyError:
+                    continue
+                plan.append((array, ref, chunk_sel, out[name], out_sel))
+
+        buffers = self.fetch([ref for _, ref, _, _, _ in plan])
+
+        def decode(item, buf):
+            array, _, chunk_sel, target, out_sel = item
+            target[out_sel] = decode_chunk(array, buf)[chunk_sel]
+
+        list(self.pool.map(decode, plan, buffers))
+        return out
+
+    def _filesystem(self, url):
+        protocol = fsspec.core.split_protocol(url)[0] or "file"
+        return fsspec.filesystem(protocol, **self.remote_options)
+
+    def fetch(self, refs):
+        """Bytes of every reference, fetched in merged byte ranges."""
+        buffers = [None] * len(refs)
+        ranged = []
+        for i, ref in enumerate(refs):
+            if isinstance(ref, str):
+                ref = ref.encode()
+            if isinstance(ref, bytes):
+                if ref.startswith(b"base64:"):
+                    ref = base64.b64decode(ref[7:])
+                buffers[i] = ref
+            elif len(ref) == 1:
+                buffers[i] = self._filesystem(ref[0]).cat_file(ref[0])
+                self.stats["requests"] += 1
+                self.stats["bytes"] += len(buffers[i])
+            else:
+                ranged.append(i)
+
+        paths = [refs[i][0] for i in ranged]
+        starts = [refs[i][1] for i in ranged]
+        ends = [refs[i][1] + refs[i][2] for i in ranged]
+        requests = {}
+        for path, start, end in zip(
+            *merge_offset_ranges(
+                paths, starts, ends, max_gap=self.max_gap, max_block=self.max_block
+            )
+        ):
+            requests.setdefault(self._filesystem(path), []).append((path, start, end))
+        blocks = {}
+        for fs, ranges in requests.items():
+            data = fs.cat_ranges(*map(list, zip(*ranges)))
+            for (path, start, _), buf in zip(ranges, data):
+                blocks.setdefault(path, []).append((start, memoryview(buf)))
+            self.stats["requests"] += len(ranges)
+            self.stats["bytes"] += sum(len(buf) for buf in data)
+        block_starts = {}
+        for path in blocks:
+            blocks[path].sort(key=lambda b: b[0])
+            block_starts[path] = [start for start, _ in blocks[path]]
+
+        for i, path, start, end in zip(ranged, paths, starts, ends):
+            k = bisect.bisect_right(block_starts[path], start) - 1
+            block_start, buf = blocks[path][k]
+            buffers[i] = buf[start - block_start : end - block_start]
+        self.stats["chunks"] += len(refs)
+        self.stats["chunk_bytes"] += sum(len(b) for b in buffers)
+        return buffers
@@ -1,44 +1,281 @@
+import concurrent.futures
+import logging
+import os
 import numpy as np
 import xarray as xr
 import healpix as hp
 import easygems.remap as egr
+import scipy.sparse
+import weight_cache
 
+logging.basicConfig()
+logger = logging.getLogger("remap_tools")
+logger.setLevel(logging.INFO)
 
-def gen_weights(ds, order):
+
+def healpix_centers(order):
     nside = hp.order2nside(order)
     npix = hp.nside2npix(nside)
+    return hp.pix2ang(nside=nside, ipix=np.arange(npix), lonlat=True, nest=True)
+
+
+def compute_weights(lon, lat, order):
+    """Delaunay weights from the points lon/lat to the healpix grid of `order`.
 
-    hp_lon, hp_lat = hp.pix2ang(
-        nside=nside, ipix=np.arange(npix), lonlat=True, nest=True
+    easygems triangulates in a stereographic projection of the sphere, which has
+    no seam at the dateline, so no periodic extension of the source is needed.
+    """
+    hp_lon, hp_lat = healpix_centers(order)
+    return egr.compute_weights_delaunay(points=(lon, lat), xi=(hp_lon, hp_lat))
+
+
+def _lonlat2xyz(lon, lat):
+    lon = np.deg2rad(lon)
+    lat = np.deg2rad(lat)
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1
     )
-    lon_periodic = np.hstack((ds.lon - 360, ds.lon, ds.lon + 360))
-    lat_periodic = np.hstack((ds.lat, ds.lat, ds.lat))
-    weights = egr.compute_weights_delaunay((ds.lon, ds.lat), (hp_lon, hp_lat))
 
-    # Compute weights
+
+def _rotate_to_pole(lon, lat, center):
+    """Rotate lon/lat such that the unit vector `center` becomes the north pole."""
+    xyz = _lonlat2xyz(lon, lat)
+    clon = np.arctan2(center[1], center[0])
+    colat = np.arccos(np.clip(center[2], -1, 1))
+    rot_z = np.array(
+        [[np.cos(clon), np.sin(clon), 0], [-np.sin(clon), np.cos(clon), 0], [0, 0, 1]]
+    )
+    rot_y = np.array(
+        [
+            [np.cos(colat), 0, -np.sin(colat)],
+            [0, 1, 0],
+            [np.sin(colat), 0, np.cos(colat)],
+        ]
+    )
+    x, y, z = (xyz @ (rot_y @ rot_z).T).T
+    return np.rad2deg(np.arctan2(y, x)), np.rad2deg(np.arcsin(np.clip(z, -1, 1)))
+
+
+def _tile_weights(task):
+    src_idx, lon, lat, tgt_lon, tgt_lat, center = task
+    # The triangulation is done in a stereographic projection, which is least
+    # distorted around the north pole, so every tile is rotated there first. The
+    # barycentric weights are invariant under the rotation.
     weights = egr.compute_weights_delaunay(
-        points=(lon_periodic, lat_periodic), xi=(hp_lon, hp_lat)
+        points=_rotate_to_pole(lon, lat, center),
+        xi=_rotate_to_pole(tgt_lon, tgt_lat, center),
+    )
+    return weights.assign(src_idx=(weights.src_idx.dims, src_idx[weights.src_idx]))
+
+
+def _iter_tiles(lon, lat, order, tile_order, pad):
+    """Yield one triangulation task per nested tile of the target grid.
+
+    Each task contains the targets of one tile at `tile_order` and the source
+    points within a spherical cap around the tile, padded by `pad` radians.
+    """
+    ntiles = hp.nside2npix(hp.order2nside(tile_order))
+    tile_size = 4 ** (order - tile_order)
+    hp_lon, hp_lat = healpix_centers(order)
+
+    # sort the source points by the tile they fall into
+    src_tile = hp.ang2pix(hp.order2nside(tile_order), lon, lat, lonlat=True, nest=True)
+    src_order = np.argsort(src_tile, kind="stable")
+    bounds = np.searchsorted(src_tile[src_order], np.arange(ntiles + 1))
+    del src_tile
+
+    centers = np.stack(
+        hp.pix2vec(hp.order2nside(tile_order), np.arange(ntiles), nest=True), axis=-1
+    )
+    # angular radius of the source points and targets of each tile
+    src_radius = np.zeros(ntiles)
+    tgt_radius = np.zeros(ntiles)
+    for t in range(ntiles):
+        idx = src_order[bounds[t] : bounds[t + 1]]
+        if idx.size:
+            cos = _lonlat2xyz(lon[idx], lat[idx]) @ centers[t]
+            src_radius[t] = np.arccos(np.clip(cos.min(), -1, 1))
+        tgt = slice(t * tile_size, (t + 1) * tile_size)
+        cos = _lonlat2xyz(hp_lon[tgt], hp_lat[tgt]) @ centers[t]
+        tgt_radius[t] = np.arccos(np.clip(cos.min(), -1, 1))
+
+    center_dist = np.arccos(np.clip(centers @ centers.T, -1, 1))
+    for t in range(ntiles):
+        radius = tgt_radius[t] + pad
+        near = np.flatnonzero(center_dist[t] <= radius + src_radius)
+        idx = np.concatenate([src_order[bounds[n] : bounds[n + 1]] for n in near])
+        cos = _lonlat2xyz(lon[idx], lat[idx]) @ centers[t]
+        idx = np.sort(idx[cos >= np.cos(radius)])
+        tgt = slice(t * tile_size, (t + 1) * tile_size)
+        yield idx, lon[idx], lat[idx], hp_lon[tgt], hp_lat[tgt], centers[t]
+
+
+def compute_weights_tiled(lon, lat, order, tile_order=2, nprocs=None, pad=None):
+    """Compute the weights of `compute_weights` tile by tile in a process pool.
+
+    The healpix target is split into its nested pixels at `tile_order`. Each tile
+    is triangulated against the source points within `pad` radians of it only,
+    which bounds the memory per tile. `pad` defaults to four times the mean
+    source point spacing. No periodic extension is needed, as every tile is
+    triangulated around its own center.
+    """
+    tile_order = min(tile_order, order)
+    if pad is None:
+        pad = 4 * np.sqrt(4 * np.pi / lon.size)
+    tasks = _iter_tiles(lon, lat, order, tile_order, pad)
+    ntiles = hp.nside2npix(hp.order2nside(tile_order))
+
+    nprocs = nprocs or os.cpu_count()
+    if nprocs == 1:
+        return xr.concat(list(map(_tile_weights, tasks)), dim="tgt_idx")
+
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nprocs) as pool:
+        # Only keep a few tiles in flight, so the source subsets of all tiles are
+        # never held in memory at the same time.
+        max_pending = 2 * nprocs
+        pending = {}
+        for t, task in enumerate(tasks):
+            pending[pool.submit(_tile_weights, task)] = t
+            if len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+                logger.debug(f"Computed weights for {len(results)}/{ntiles} tiles")
+        for future in concurrent.futures.as_completed(pending):
+            results[pending[future]] = future.result()
+    return xr.concat([results[t] for t in range(ntiles)], dim="tgt_idx")
+
+
+def compute_weights_bilinear(lon, lat, tgt_lon, tgt_lat):
+    """Bilinear weights from a regular lat/lon grid to the points tgt_lon/tgt_lat.
+
+    lon and lat are the 1D (ascending, or descending for lat) grid coordinates in
+    degree. Source indices refer to the grid flattened with the longitude as the
+    outer dimension, i.e. `da.stack(cell=(lon, lat))`. The longitude is treated as
+    cyclic; a grid that already contains a cyclic column is handled as well.
+    Targets beyond the outermost latitudes take the values of that row.
+
+    Returns the weights in the format of `egr.compute_weights_delaunay`, with the
+    four corners of the enclosing cell along the "tri" dimension.
+    """
+    lon = np.asarray(lon, dtype="float64")
+    lat = np.asarray(lat, dtype="float64")
+    nlon, nlat = lon.size, lat.size
+    lat_idx = np.arange(nlat)
+    if lat[0] > lat[-1]:
+        lat = lat[::-1]
+        lat_idx = lat_idx[::-1]
+
+    x = lon[0] + (np.asarray(tgt_lon) - lon[0]) % 360
+    if np.isclose(lon[-1] - lon[0], 360):
+        # the grid already has a cyclic column
+        i0 = np.clip(np.searchsorted(lon, x, side="right") - 1, 0, nlon - 2)
+        i1 = i0 + 1
+    else:
+        i0 = np.searchsorted(lon, x, side="right") - 1
+        i1 = (i0 + 1) % nlon
+    wx = (x - lon[i0]) / ((lon[i1] - lon[i0]) % 360)
+
+    y = np.asarray(tgt_lat)
+    j0 = np.clip(np.searchsorted(lat, y, side="right") - 1, 0, nlat - 2)
+    j1 = j0 + 1
+    wy = np.clip((y - lat[j0]) / (lat[j1] - lat[j0]), 0, 1)
+
+    src_idx = np.stack(
+        [
+            i0 * nlat + lat_idx[j0],
+            i1 * nlat + lat_idx[j0],
+            i0 * nlat + lat_idx[j1],
+            i1 * nlat + lat_idx[j1],
+        ],
+        axis=-1,
+    )
+    weights = np.stack(
+        [(1 - wx) * (1 - wy), wx * (1 - wy), (1 - wx) * wy, wx * wy], axis=-1
+    )
+    return xr.Dataset(
+        data_vars={
+            "src_idx": (("tgt_idx", "tri"), src_idx),
+            "weights": (("tgt_idx", "tri"), weights),
+            "valid": (("tgt_idx",), np.ones(len(x), dtype=bool)),
+        }
     )
 
-    # Remap the source indices back to their valid range
-    weights = weights.assign(src_idx=weights.src_idx % ds.lat.size)
-    return weights
+
+def gen_weights(ds, order, cache=None, tile_order=None, nprocs=None):
+    """Delaunay weights from the ds.lon/ds.lat cells to the healpix grid of `order`.
+
+    With a `weight_cache.WeightCache` as `cache`, weights are looked up on disk
+    and only computed on a miss. The default None uses the cache in
+    `$HEALPIX_WEIGHT_CACHE_DIR` if that is set; `cache=False` always recomputes.
+    With `tile_order`, the weights are computed tile by tile on `nprocs`
+    processes (see `compute_weights_tiled`).
+    """
+    lon = np.asarray(ds.lon)
+    lat = np.asarray(ds.lat)
+
+    def compute():
+        if tile_order is None:
+            return compute_weights(lon, lat, order)
+        return compute_weights_tiled(
+            lon, lat, order, tile_order=tile_order, nprocs=nprocs
+        )
+
+    if cache is None:
+        cache = weight_cache.default_cache()
+    if cache is None or cache is False:
+        return compute()
+    if tile_order is None:
+        method = "delaunay"
+    else:
+        method = f"delaunay_tiled{tile_order}"
+    return cache.get_or_compute(compute, lon, lat, order=order, method=method)
+
+
+def weights_to_csr(weights, nsrc):
+    """Turn remapping weights into a sparse (ntgt, nsrc) float32 CSR operator.
+
+    Returns the operator and the boolean mask of valid target cells.
+    """
+    src_idx = np.asarray(weights["src_idx"])
+    w = np.asarray(weights["weights"], dtype="float32")
+    valid = np.asarray(weights["valid"], dtype=bool)
+    ntgt, nvert = src_idx.shape
+    # Explicit zeros are kept on purpose: a NaN in a source cell with zero weight
+    # propagates like in egr.apply_weights.
+    op = scipy.sparse.csr_matrix(
+        (w.ravel(), src_idx.ravel(), np.arange(0, ntgt * nvert + 1, nvert)),
+        shape=(ntgt, nsrc),
+    )
+    return op, valid
+
+
+def apply_csr(data, op, valid):
+    """Apply a CSR operator to the last axis of data, batched over all other axes."""
+    lead = data.shape[:-1]
+    block = np.asarray(data, dtype="float32").reshape(-1, data.shape[-1])
+    out = np.asarray((op @ block.T).T, dtype="float32")
+    out[:, ~valid] = np.nan
+    return out.reshape(*lead, op.shape[0])
 
 
-def remap_delaunay(ds: xr.Dataset, order: int) -> xr.Dataset:
+def remap_delaunay(ds: xr.Dataset, order: int, cache=None) -> xr.Dataset:
     """Expects the cell dimension of the dataset to be named ncells, and lat/lon to be named lat and lon, and to be in degree."""
-    weights = gen_weights(ds, order)
-    npix = len(weights.tgt_idx)
+    weights = gen_weights(ds, order, cache=cache)
+    op, valid = weights_to_csr(weights, ds.sizes["ncells"])
+    npix = op.shape[0]
     ds_remap = xr.apply_ufunc(
-        egr.apply_weights,
+        apply_csr,
         ds,
-        kwargs=weights,
+        kwargs=dict(op=op, valid=valid),
         keep_attrs=True,
         input_core_dims=[["ncells"]],
         output_core_dims=[["cell"]],
         on_missing_core_dim="copy",
         output_dtypes=["f4"],
-        vectorize=True,
         dask="parallelized",
         dask_gufunc_kwargs={
             "output_sizes": {"cell": npix},
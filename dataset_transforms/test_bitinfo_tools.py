@@ -0,0 +1,24 @@
+import numpy as np
+import xarray as xr
+import bitinfo_tools
+import chunk_tools
+
+
+def test_keepbits():
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 20, 12 * 4**4)
+    smooth = np.stack([10 + np.sin(x + t) for t in range(4)])
+    noise = smooth + rng.normal(scale=1e-2, size=smooth.shape)
+    ds = xr.Dataset(
+        {"smooth": (("time", "cell"), smooth), "noise": (("time", "cell"), noise)}
+    )
+
+    keepbits, reports = bitinfo_tools.keepbits_for_dataset(ds, order=4, timechunk=4)
+    assert 0 < keepbits["smooth"] <= bitinfo_tools.MANTISSA_BITS
+    # noise below 1e-2 carries no real information
+    assert keepbits["noise"] < keepbits["smooth"]
+    assert reports["noise"]["gain"] > 1
+    assert reports["noise"]["max_rel_error"] <= 2.0 ** -(keepbits["noise"] + 1)
+
+    encodings = chunk_tools.get_encodings(ds, 4, 4, keepbits=keepbits)
+    assert encodings["noise"]["filters"][0].keepbits == keepbits["noise"]
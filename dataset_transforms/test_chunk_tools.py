@@ -1,3 +1,5 @@
+import numpy as np
+import xarray as xr
 import chunk_tools
 
 
@@ -6,5 +8,51 @@ def test_chunk_size():
     assert chunk_tools.compute_chunksize(1) == 48
     assert chunk_tools.compute_chunksize(6) == 12 * 4**6
     assert chunk_tools.compute_chunksize(7) == 12 * 4**7
-    assert chunk_tools.compute_chunksize(8) == 4**9
-    assert chunk_tools.compute_chunksize(9) == 4**9
+    # no fixed cap, chunks follow the byte budget and the dtype
+    assert chunk_tools.compute_chunksize(9) == 12 * 4**9
+    for order in (8, 9, 11):
+        for dtype in ("float32", "float64"):
+            cells = chunk_tools.compute_chunksize(order, timechunk=24, dtype=dtype)
+            assert (12 * 4**order) % cells == 0
+            itemsize = np.dtype(dtype).itemsize
+            assert 24 * cells * itemsize <= chunk_tools.DEFAULT_TARGET_BYTES
+
+
+def test_get_chunksizes():
+    ds = xr.Dataset(
+        {
+            "tas": (("time", "cell"), np.zeros((48, 12 * 4**8), dtype="float32")),
+            "ta": (("time", "level", "cell"), np.zeros((48, 13, 12 * 4**8))),
+            "orog": (("cell",), np.zeros(12 * 4**8)),
+        }
+    )
+    for var in ds:
+        chunks = chunk_tools.get_chunksizes(ds, var, order=8, timechunk=24)
+        assert len(chunks) == ds[var].ndim
+        assert (12 * 4**8) % chunks[-1] == 0
+        assert np.prod(chunks) * 4 <= chunk_tools.DEFAULT_TARGET_BYTES
+    assert chunk_tools.get_chunksizes(ds, "ta", order=8, timechunk=24)[0] == 24
+
+    plan = chunk_tools.healpix_chunks(order=8, timechunk=24)
+    assert plan((48, 13, 12 * 4**8)) == chunk_tools.get_chunksizes(
+        ds.astype("float32"), "ta", order=8, timechunk=24
+    )
+    assert plan((48,)) is None
+
+
+def test_plan_chunks():
+    shape, dims = (8760, 10, 4, 12 * 4**6), ("time", "member", "soil", "cell")
+    for access in ("map", "timeseries", "balanced"):
+        chunks = chunk_tools.plan_chunks(shape, dims, "float32", order=6, access=access)
+        assert len(chunks) == 4
+        assert (12 * 4**6) % chunks[-1] == 0
+        assert np.prod(chunks) * 4 <= chunk_tools.DEFAULT_TARGET_BYTES
+
+    maps = chunk_tools.plan_chunks(shape, dims, "float32", order=6, access="map")
+    series = chunk_tools.plan_chunks(
+        shape, dims, "float32", order=6, access="timeseries"
+    )
+    assert maps[0] < series[0] and maps[-1] > series[-1]
+
+    fixed = chunk_tools.plan_chunks(shape, dims, "float64", order=6, fixed={"time": 24})
+    assert fixed[0] == 24
@@ -0,0 +1,20 @@
+import dask.array as dsa
+import numpy as np
+import coarsen_tools
+
+
+def test_coarsen_levels():
+    rng = np.random.default_rng(0)
+    data = rng.random((2, 3, 12 * 4**3)).astype("float32")
+    data[data < 0.4] = np.nan
+
+    levels = coarsen_tools.coarsen_levels(data, [1, 3])
+    for level, coarse in levels.items():
+        blocks = data.reshape(2, 3, -1, 4**level)
+        with np.errstate(invalid="ignore"):
+            expected = np.nansum(blocks, -1) / (~np.isnan(blocks)).sum(-1)
+        assert coarse.dtype == np.float32
+        np.testing.assert_allclose(coarse, expected, rtol=1e-6)
+
+    lazy = coarsen_tools.coarsen(dsa.from_array(data, chunks=(1, 3, 100)), 2)
+    np.testing.assert_allclose(lazy.compute(), coarsen_tools.coarsen(data, 2))
@@ -0,0 +1,26 @@
+import numpy as np
+import xarray as xr
+import chunk_tools
+import codec_tools
+
+
+def test_recommendation_feeds_get_encodings():
+    rng = np.random.default_rng(0)
+    ds = xr.Dataset(
+        {"pr": (("time", "cell"), np.maximum(rng.normal(size=(4, 12 * 4**3)), 0))}
+    )
+    codecs = codec_tools.codec_matrix(cnames=("zstd", "lz4"), clevels=(1,))
+    recommendation, report = codec_tools.benchmark_dataset(
+        ds, order=3, timechunk=2, codecs=codecs, min_compress_mbps=0
+    )
+    assert len(report["pr"]) == len(codecs)
+    assert recommendation["pr"]["cname"] in ("zstd", "lz4")
+
+    encodings = chunk_tools.get_encodings(ds, 3, 2, compressors=recommendation)
+    compressor = encodings["pr"]["compressors"][0]
+    assert compressor.get_config() == recommendation["pr"]
+    data = ds["pr"].values.astype("float32")
+    np.testing.assert_array_equal(
+        np.frombuffer(compressor.decode(compressor.encode(data)), "float32"),
+        data.ravel(),
+    )
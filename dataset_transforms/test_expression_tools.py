@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from expression_tools import Expression, get_inputs
+
+
+def test_expression():
+    rng = np.random.default_rng(0)
+    # not a multiple of the block size
+    shape = (3, 1000)
+    x = {n: rng.random(shape) for n in ("swvl1", "swvl2", "swvl3", "swvl4")}
+
+    mrso = Expression(
+        "(7 * swvl1 + 21 * swvl2 + 72 * swvl3 + 189 * swvl4) / (7+21+72+189)",
+        block_size=256,
+    )
+    assert mrso.inputs == ["swvl1", "swvl2", "swvl3", "swvl4"]
+    out = mrso(*(x[n] for n in mrso.inputs))
+    assert out.dtype == np.float32
+    expected = (
+        7 * x["swvl1"] + 21 * x["swvl2"] + 72 * x["swvl3"] + 189 * x["swvl4"]
+    ) / 289
+    np.testing.assert_allclose(out, expected, rtol=1e-6)
+    # registers are reused
+    assert mrso.nregisters == 2
+
+    pr = Expression("tp * 1000 / 3600")
+    # folded into a single multiplication
+    assert len(pr.program) == 1
+    np.testing.assert_allclose(pr(x["swvl1"]), x["swvl1"] / 3.6, rtol=1e-6)
+
+    rlus = Expression("(strd - str) / -3600")
+    np.testing.assert_allclose(
+        rlus(x["swvl1"], x["swvl2"]),
+        (x["swvl1"] - x["swvl2"]) / -3600,
+        atol=1e-10,
+    )
+    np.testing.assert_array_equal(
+        Expression("ci")(x["swvl1"]), x["swvl1"].astype("float32")
+    )
+
+    with pytest.raises(ValueError):
+        Expression("abs(ci)")
+    with pytest.raises(TypeError):
+        pr(x["swvl1"], x["swvl2"])
+
+
+def test_get_inputs():
+    names, func = get_inputs("tas")
+    assert names == ["tas"] and func(1.0) == 1.0
+
+    expr = Expression("(ssrd - ssr) / 3600")
+    assert get_inputs(expr) == (["ssrd", "ssr"], expr)
+
+    def rsus(ssrd, ssr):
+        net = ssrd - ssr
+        return net / 3600
+
+    # local variables are not inputs
+    assert get_inputs(rsus) == (["ssrd", "ssr"], rsus)
@@ -0,0 +1,203 @@
+import json
+import multiprocessing
+from concurrent.futures import Future
+
+import cloudpickle
+import numpy as np
+import pytest
+import zarr
+from numcodecs import Blosc
+
+import ifs_to_zarr
+from expression_tools import Expression
+
+zarr3 = pytest.mark.skipif(
+    int(zarr.__version__.split(".")[0]) < 3, reason="ifs_to_zarr uses the zarr 3 API"
+)
+
+
+def make_inputs(path, **chunks):
+    """A store with a random (8, 64) input of the given chunks per name."""
+    group = zarr.open_group(path, mode="w", zarr_format=2)
+    rng = np.random.default_rng(0)
+    for name, c in chunks.items():
+        array = group.create_array(name, shape=(8, 64), chunks=c, dtype="f4")
+        array[:] = rng.random((8, 64))
+    return group
+
+
+def failing_on(value, flag=None):
+    """An op that raises on the blocks holding `value`, while `flag` exists."""
+
+    def op(x):
+        if (flag is None or flag.exists()) and (x == value).any():
+            raise RuntimeError("injected")
+        return x
+
+    return op
+
+
+def finished(exception=None):
+    future = Future()
+    if exception is None:
+        future.set_result(0)
+    else:
+        future.set_exception(exception)
+    return future
+
+
+def test_finish_uploads(tmp_path):
+    log = ifs_to_zarr.TaskLog(tmp_path)
+    failed = set()
+    running = Future()
+    uploading = [
+        ("a", {"tas": [finished(), finished()]}),
+        ("b", {"tas": [finished()], "pr": [finished(ConnectionError("down"))]}),
+        ("c", {"tas": [running]}),
+    ]
+    uploading = ifs_to_zarr.finish_uploads(uploading, log, failed)
+    assert [key for key, _ in uploading] == ["c"]
+    assert log.done == {"a"}
+    # a task is only done once all its chunks are uploaded
+    assert failed == {"b"}
+    assert list(log.failed["b"]) == ["pr"]
+
+    running.set_result(0)
+    assert ifs_to_zarr.finish_uploads(uploading, log, failed, wait=True) == []
+    assert ifs_to_zarr.TaskLog(tmp_path).done == {"a", "c"}
+
+
+@zarr3
+def test_gen_array_keeps_planned_chunks(tmp_path):
+    group = zarr.open_group(tmp_path / "out.zarr", mode="w", zarr_format=2)
+    source = group.create_array("src", shape=(8, 16), chunks=(2, 4), dtype="f4")
+    compressor = Blosc(cname="lz4", clevel=5, shuffle=1)
+    out = ifs_to_zarr.gen_array(group, source, (4, 8), "out", compressor=compressor)
+    out[:] = np.ones(out.shape)
+    assert ifs_to_zarr.gen_array(group, source, (4, 8), "out").chunks == (4, 8)
+    # a resumed run must not plan its tasks on other chunks than the store has
+    with pytest.raises(ValueError):
+        ifs_to_zarr.gen_array(group, source, (8, 16), "out")
+
+
+@zarr3
+def test_grouped_jobs_match_per_output(tmp_path, capsys):
+    zarr_in = make_inputs(tmp_path / "in.zarr", x=(1, 32), y=(1, 32), z=(2, 16))
+    variables = {"a": "x", "b": Expression("x + y"), "c": "y"}
+    chunks = {2: (8, 16)}
+    groups = ifs_to_zarr.group_variables(zarr_in, variables, chunks)
+    assert groups == [["a", "b", "c"]]
+    # x and y are read once instead of twice
+    nbytes = zarr_in["x"].nbytes
+    assert ifs_to_zarr.bytes_read(zarr_in, variables, groups) == (
+        4 * nbytes,
+        2 * nbytes,
+    )
+
+    grouped = zarr.open_group(tmp_path / "grouped.zarr", mode="w", zarr_format=2)
+    ifs_to_zarr.rechunk_dataset(
+        zarr_in, grouped, chunks, variables, nprocs=2, temp_dir=tmp_path
+    )
+    assert "(3 outputs in 1 jobs)" in capsys.readouterr().out
+    for name, op in variables.items():
+        single = zarr.open_group(tmp_path / f"{name}.zarr", mode="w", zarr_format=2)
+        ifs_to_zarr.rechunk_dataset(
+            zarr_in, single, chunks, {name: op}, nprocs=2, temp_dir=tmp_path
+        )
+        np.testing.assert_array_equal(grouped[name][:], single[name][:])
+    np.testing.assert_allclose(grouped["b"][:], zarr_in["x"][:] + zarr_in["y"][:])
+
+    # outputs keeping the chunks of their inputs are only grouped if these match
+    variables = {"a": Expression("x + y"), "d": Expression("z + y")}
+    assert ifs_to_zarr.group_variables(zarr_in, variables, {}) == [["a"], ["d"]]
+
+
+@zarr3
+def test_run_tasks_reports_errors(tmp_path):
+    zarr_in = make_inputs(tmp_path / "in.zarr", x=(2, 16))
+    zarr_out = zarr.open_group(tmp_path / "out.zarr", mode="w", zarr_format=2)
+    for name in "ab":
+        ifs_to_zarr.gen_array(zarr_out, zarr_in["x"], (2, 16), name)
+    x = zarr_in["x"][:]
+    outputs = [
+        ("a", ["x"], cloudpickle.dumps(ifs_to_zarr.identity)),
+        ("b", ["x"], cloudpickle.dumps(failing_on(x[2, 20]))),
+    ]
+    jobs = [("in", "out", outputs, (2, 16))]
+    stores = {"in": zarr_in, "out": zarr_out}
+    log = ifs_to_zarr.TaskLog(tmp_path / "state")
+    with multiprocessing.Pool(
+        2, initializer=ifs_to_zarr.init_worker, initargs=(stores, jobs)
+    ) as pool:
+        failed = ifs_to_zarr.run_tasks(pool, jobs, [x.shape], 2, log=log)
+
+    # the error is reported for its output of the failing task only
+    assert failed == {"a+b/2.16"}
+    assert log.failed == {"a+b/2.16": {"b": "injected"}}
+    assert len(log.done) == 15
+    np.testing.assert_array_equal(zarr_out["a"][:], x)
+    expected = x.copy()
+    expected[2:4, 16:32] = np.nan
+    np.testing.assert_array_equal(zarr_out["b"][:], expected)
+
+
+def read_keys(path):
+    with open(path) as f:
+        return {json.loads(line)["key"] for line in f}
+
+
+@zarr3
+@pytest.mark.parametrize(
+    "source, target, max_mem, strategy, failed",
+    [
+        ((2, 16), (2, 16), 2**20, "direct", {"a/0.0"}),
+        ((1, 32), (8, 16), 1500, "intermediate", {"a/0.0", "a/0.16"}),
+    ],
+)
+def test_rechunk_restart(tmp_path, capsys, source, target, max_mem, strategy, failed):
+    zarr_in = make_inputs(tmp_path / "in.zarr", x=source)
+    zarr_out = zarr.open_group(tmp_path / "out.zarr", mode="w", zarr_format=2)
+    x = zarr_in["x"][:]
+    flag = tmp_path / "fail"
+    flag.touch()
+    variables = {"a": failing_on(x[0, 0], flag)}
+    state = tmp_path / "state"
+
+    def run(**kwargs):
+        log = ifs_to_zarr.TaskLog(state)
+        ifs_to_zarr.rechunk_dataset(
+            zarr_in,
+            zarr_out,
+            {2: target},
+            variables,
+            nprocs=2,
+            max_mem=max_mem,
+            temp_dir=tmp_path,
+            log=log,
+            **kwargs,
+        )
+        return log
+
+    run()
+    assert f"'strategy': '{strategy}'" in capsys.readouterr().out
+    keys = {
+        f"a/{i}.{j}" for i in range(0, 8, target[0]) for j in range(0, 64, target[1])
+    }
+    assert read_keys(state / "failed.jsonl") == failed
+    assert read_keys(state / "done.jsonl") == keys - failed
+
+    # a rerun skips the done tasks, so a done block cleared meanwhile stays empty
+    done = (slice(8 - target[0], 8), slice(64 - target[1], 64))
+    zarr_out["a"][done] = np.nan
+    log = run()
+    assert set(log.failed) == failed
+    assert np.isnan(zarr_out["a"][done]).all()
+
+    # only the failed tasks are run again
+    flag.unlink()
+    log = run(retry_failed=True)
+    assert not log.failed
+    assert log.done == keys
+    expected = x.copy()
+    expected[done] = np.nan
+    np.testing.assert_array_equal(zarr_out["a"][:], expected)
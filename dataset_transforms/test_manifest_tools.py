@@ -0,0 +1,106 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import zarr
+import manifest_tools
+import pyramid_tools
+
+pytestmark = pytest.mark.skipif(
+    int(zarr.__version__.split(".")[0]) < 3, reason="zarr_tools uses the zarr 3 API"
+)
+
+
+def test_claim(tmp_path):
+    manifest = manifest_tools.Manifest(tmp_path / "out.zarr", stale_after=60)
+    assert manifest.claim("t0")
+    assert not manifest.claim("t0")
+    manifest.mark_done("t0")
+    manifest.release("t0")
+    assert not manifest.claim("t0")
+
+    # a lock left behind by a crashed writer is taken over once stale
+    assert manifest.claim("t1")
+    old = time.time() - 120
+    os.utime(manifest.root / "t1.lock", (old, old))
+    assert manifest.claim("t1")
+
+
+def test_heartbeat(tmp_path):
+    path = tmp_path / "out.zarr"
+    manifest = manifest_tools.Manifest(path, stale_after=0.5, heartbeat=0.05)
+    other = manifest_tools.Manifest(path, stale_after=0.5, heartbeat=0.05)
+    assert manifest.claim("t0")
+    with manifest.holding("t0") as held:
+        # a task running for longer than stale_after is not taken over
+        time.sleep(1)
+        assert not other.claim("t0")
+        assert held()
+    assert not (manifest.root / "t0.lock").exists()
+
+    # without a heartbeat the lock goes stale, and the first owner notices
+    assert manifest.claim("t1")
+    time.sleep(0.6)
+    assert other.claim("t1")
+    assert not manifest.owns("t1")
+    manifest.release("t1")
+    assert other.owns("t1")
+
+
+def test_write_parts_cooperative(tmp_path):
+    ncell = 12 * 4**2
+    ds = xr.Dataset(
+        {
+            "tas": (("time", "cell"), np.random.random((8, ncell)).astype("float32")),
+            "pr": (("time", "cell"), np.random.random((8, ncell)).astype("float32")),
+        },
+        coords={"time": pd.date_range("2020", periods=8, freq="h")},
+    ).chunk(time=2)
+    path = tmp_path / "out.zarr"
+    kwargs = dict(time_chunk=2, timechunk=2, order=2, split_variables=True, size=2)
+
+    # a rank crashed while creating the stores, and rank 1 crashes after
+    # claiming a task; rank 0 takes over the structure and writes everything else
+    manifest = manifest_tools.Manifest(path)
+    assert manifest.claim("structure")
+    old = time.time() - 1200
+    os.utime(manifest.root / "structure.lock", (old, old))
+    manifest.claim("t2.tas")
+    assert manifest_tools.write_parts_cooperative(ds, path, rank=0, **kwargs) == 1
+    manifest.release("t2.tas")
+    assert manifest_tools.write_parts_cooperative(ds, path, rank=1, **kwargs) == 0
+    xr.testing.assert_allclose(xr.open_zarr(path).load(), ds.load())
+
+    with pytest.raises(ValueError):
+        manifest_tools.write_parts_cooperative(
+            ds, path, rank=0, **{**kwargs, "time_chunk": 3}
+        )
+
+
+def test_write_pyramid_cooperative(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.random((4, 12 * 4**2)).astype("float32")
+    data[data < 0.2] = np.nan
+    ds = xr.Dataset(
+        {
+            "tas": (("time", "cell"), data),
+            "orog": (("cell",), rng.random(12 * 4**2).astype("float32")),
+            "co2": (("time",), rng.random(4).astype("float32")),
+        },
+        coords={"time": pd.date_range("2020", periods=4, freq="h")},
+    ).chunk(time=2)
+    paths = {order: tmp_path / f"out_z{order}.zarr" for order in (2, 1, 0)}
+    kwargs = dict(time_chunk=2, timechunk=2, size=2)
+
+    # rank 0 leaves the second block to rank 1
+    manifest = manifest_tools.Manifest(paths[2])
+    manifest.claim("t2")
+    assert manifest_tools.write_pyramid_cooperative(ds, paths, rank=0, **kwargs) == 1
+    manifest.release("t2")
+    assert manifest_tools.write_pyramid_cooperative(ds, paths, rank=1, **kwargs) == 0
+    for order, path in paths.items():
+        expected = pyramid_tools.coarsen_template(ds, order).load()
+        xr.testing.assert_allclose(xr.open_zarr(path).load(), expected)
@@ -0,0 +1,82 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+import zarr
+
+import merge_zarr_stores
+
+pytestmark = pytest.mark.skipif(
+    int(zarr.__version__.split(".")[0]) < 3,
+    reason="the test stores are written with the zarr 3 API",
+)
+
+
+def make_store(path, variables, nested=False):
+    group = zarr.open_group(path, mode="w", zarr_format=2)
+    data = {}
+    for name in variables:
+        rng = np.random.default_rng(sum(map(ord, name)))
+        data[name] = rng.random((4, 6)).astype("float32")
+        array = group.create_array(
+            name,
+            shape=(4, 6),
+            chunks=(1, 3),
+            dtype="float32",
+            chunk_key_encoding={"name": "v2", "separator": "/" if nested else "."},
+        )
+        array[:] = data[name]
+    return data
+
+
+@pytest.mark.parametrize("link_mode", merge_zarr_stores.LINK_MODES)
+def test_clone_dataset(tmp_path, link_mode):
+    data = make_store(tmp_path / "a.zarr", ["tas"])
+    data.update(make_store(tmp_path / "b.zarr", ["pr"], nested=True))
+    target = tmp_path / "merged.zarr"
+
+    merge_zarr_stores.clone_dataset(
+        [tmp_path / "a.zarr", tmp_path / "b.zarr"], target, link_mode, nthreads=4
+    )
+
+    merged = zarr.open_group(target, mode="r")
+    for name, values in data.items():
+        np.testing.assert_array_equal(merged[name][:], values)
+    # metadata is never linked
+    assert not os.path.islink(target / "tas" / ".zarray")
+    assert os.stat(target / "tas" / ".zarray").st_nlink == 1
+    chunk = target / "tas" / "0.0"
+    if link_mode == "symlink":
+        assert os.path.islink(chunk)
+        assert os.path.islink(target / "pr" / "0")
+    elif link_mode == "hardlink":
+        assert os.stat(chunk).st_nlink == 2
+        assert os.stat(target / "pr" / "0" / "0").st_nlink == 2
+    else:
+        # reflinks fall back to copies on filesystems without support
+        assert not os.path.islink(chunk)
+        assert os.stat(chunk).st_nlink == 1
+
+
+def test_duplicates(tmp_path):
+    stores = [tmp_path / "a.zarr", tmp_path / "b.zarr"]
+    make_store(stores[0], ["tas", "lat"])
+    make_store(stores[1], ["pr", "lat"])
+
+    merge_zarr_stores.clone_dataset(stores, tmp_path / "m1.zarr")
+    for store in stores:
+        assert Path(f"{store}.manifest.json").exists()
+
+    # the second merge only checks sizes and mtimes
+    manifest = merge_zarr_stores.StoreManifest(stores[1])
+    assert len(manifest.entries("lat")) == 10
+    assert manifest.hashed == 0
+
+    chunk = stores[1] / "lat" / "0.0"
+    chunk.write_bytes(bytes(len(chunk.read_bytes())))
+    # changes are noticed by their size or mtime
+    mtime = chunk.stat().st_mtime_ns + 10**9
+    os.utime(chunk, ns=(mtime, mtime))
+    with pytest.raises(ValueError, match="0.0"):
+        merge_zarr_stores.clone_dataset(stores, tmp_path / "m2.zarr")
@@ -0,0 +1,21 @@
+import numpy as np
+import xarray as xr
+import pyramid_tools
+
+
+def test_iter_pyramid_nan_weighting():
+    rng = np.random.default_rng(0)
+    data = rng.random((3, 12 * 4**3)).astype("float32")
+    data[data < 0.3] = np.nan
+    block = xr.Dataset(
+        {"tas": (("time", "cell"), data), "co2": (("time",), [1.0, 2.0, 3.0])},
+        coords={"time": [0, 1, 2]},
+    )
+
+    levels = dict(pyramid_tools.iter_pyramid(block, [3, 2, 0]))
+    assert list(levels) == [3, 2, 0]
+    for order, ds in levels.items():
+        expected = pyramid_tools.coarsen_template(block, order)["tas"]
+        np.testing.assert_allclose(ds["tas"], expected, rtol=1e-6)
+        assert ds.sizes["cell"] == 12 * 4**order
+        xr.testing.assert_equal(ds["co2"], block["co2"])
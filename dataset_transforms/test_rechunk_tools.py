@@ -0,0 +1,25 @@
+import rechunk_tools
+
+
+def test_plan_rechunk():
+    shape = (8760, 12 * 4**6)
+    nbytes = 8760 * 12 * 4**6 * 4
+
+    plan = rechunk_tools.plan_rechunk(shape, (1, 12 * 4**6), (24, 4**6), 4, 2**30)
+    assert plan["strategy"] == "memory"
+    assert plan["read_chunks"] == (24, 12 * 4**6)
+    assert plan["bytes_moved"] == 2 * nbytes
+
+    plan = rechunk_tools.plan_rechunk(shape, (1, 12 * 4**6), (8760, 4**4), 4, 2**24)
+    assert plan["strategy"] == "intermediate"
+    assert plan["read_chunks"][1] == 12 * 4**6
+    assert plan["write_chunks"][0] == 8760
+    # intermediate chunks tile the read blocks
+    assert all(
+        r % i == 0 for r, i in zip(plan["read_chunks"], plan["intermediate_chunks"])
+    )
+    assert plan["bytes_moved"] >= 4 * nbytes
+
+    plan = rechunk_tools.plan_rechunk(shape, (24, 4**6), (24, 4**6), 4, 2**20)
+    assert plan["strategy"] == "direct"
+    assert plan["bytes_moved"] == 2 * nbytes
@@ -0,0 +1,100 @@
+import json
+import pickle
+
+import numpy as np
+import pytest
+import zarr
+from numcodecs import Blosc
+
+import reference_tools
+
+pytestmark = pytest.mark.skipif(
+    int(zarr.__version__.split(".")[0]) < 3,
+    reason="reference_tools uses the zarr 3 API",
+)
+
+
+def make_references(tmp_path):
+    """Uncompressed zarr 2 store and references to its chunks in one file."""
+    rng = np.random.default_rng(0)
+    data = {
+        "tas": rng.random((6, 48)).astype("float32"),
+        "ta": rng.random((6, 3, 48)).astype("float32"),
+    }
+    store = tmp_path / "src.zarr"
+    group = zarr.open_group(store, mode="w", zarr_format=2)
+    for name, values in data.items():
+        array = group.create_array(
+            name,
+            shape=values.shape,
+            chunks=(1,) * (values.ndim - 1) + (48,),
+            dtype="float32",
+            compressors=Blosc() if name == "ta" else None,
+            fill_value=np.nan,
+        )
+        array[:] = values
+    # leave out one chunk, which then reads as missing
+    (store / "tas" / "5.0").unlink()
+
+    blob = tmp_path / "data.bin"
+    refs = {}
+    with open(blob, "wb") as f:
+        for path in sorted(store.rglob("*")):
+            if path.is_dir():
+                continue
+            key = path.relative_to(store).as_posix()
+            content = path.read_bytes()
+            if path.name.startswith("."):
+                refs[key] = content.decode()
+            else:
+                refs[key] = ["{{u}}", f.tell(), len(content)]
+                f.write(content)
+    path = tmp_path / "refs.json"
+    path.write_text(
+        json.dumps({"version": 1, "templates": {"u": str(blob)}, "refs": refs})
+    )
+    return path, data
+
+
+def test_open_references(tmp_path):
+    path, data = make_references(tmp_path)
+    cache = tmp_path / "cache"
+    group = reference_tools.open_references(path, cache)
+    assert reference_tools.index_path(path, cache).exists()
+
+    np.testing.assert_array_equal(group["ta"][:], data["ta"])
+    np.testing.assert_array_equal(group["tas"][:5], data["tas"][:5])
+    assert np.isnan(group["tas"][5]).all()
+
+    refs = reference_tools.get_index(path, cache)
+    expected = reference_tools.load_references(path)
+    assert refs["tas/0.0"] == expected["tas/0.0"]
+    assert "tas/5.0" not in refs
+    assert sorted(refs) == sorted(expected)
+
+    # workers receive only the path to the index
+    group = pickle.loads(pickle.dumps(group))
+    np.testing.assert_array_equal(group["ta"][2:4], data["ta"][2:4])
+
+
+def test_coalescing_reader(tmp_path):
+    path, data = make_references(tmp_path)
+    group = reference_tools.open_references(path, tmp_path / "cache")
+    reader = reference_tools.CoalescingReader(max_gap=0)
+
+    selection = (slice(1, 6), slice(10, 40))
+    out = reader.read({"tas": group["tas"]}, selection)
+    np.testing.assert_array_equal(out["tas"][:4], data["tas"][1:5, 10:40])
+    assert np.isnan(out["tas"][4]).all()
+    # the chunks of tas are stored back to back
+    assert reader.stats["requests"] == 1
+    assert reader.stats["chunks"] == 4
+    assert reader.stats["bytes"] == reader.stats["chunk_bytes"] == 4 * 48 * 4
+
+    reader.stats.update(requests=0, bytes=0, chunks=0, chunk_bytes=0)
+    out = reader.read({"ta": group["ta"], "tas": group["tas"]}, (slice(2, 3),))
+    np.testing.assert_array_equal(out["ta"], data["ta"][2:3])
+    np.testing.assert_array_equal(out["tas"], data["tas"][2:3])
+    assert reader.stats["chunks"] == 4
+    # the levels of ta in one request, tas in another
+    assert reader.stats["requests"] == 2
@@ -0,0 +1,103 @@
+import numpy as np
+import xarray as xr
+import easygems.remap as egr
+import remap_tools
+
+
+def random_cells(n, seed=0):
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-180, 180, n)
+    lat = np.rad2deg(np.arcsin(rng.uniform(-1, 1, n)))
+    return xr.Dataset(coords=dict(lon=("ncells", lon), lat=("ncells", lat)))
+
+
+def test_apply_csr_matches_apply_weights():
+    ds = random_cells(5000)
+    weights = remap_tools.gen_weights(ds, 4, cache=False)
+    data = np.random.default_rng(1).standard_normal((3, 5000)).astype("float32")
+    data[1, 10] = np.nan
+
+    op, valid = remap_tools.weights_to_csr(weights, 5000)
+    remapped = remap_tools.apply_csr(data, op, valid)
+
+    expected = np.stack(
+        [
+            egr.apply_weights(d, **{k: v.values for k, v in weights.items()})
+            for d in data
+        ]
+    )
+    assert remapped.dtype == np.float32
+    np.testing.assert_allclose(remapped, expected, atol=1e-5)
+
+
+def test_weights_across_dateline():
+    # a regular 0..355 grid, so targets between 355 and 360 lie across the seam of
+    # the source longitudes
+    lon, lat = np.meshgrid(np.arange(0, 360, 5.0), np.arange(-87.5, 90, 5.0))
+    lon, lat = lon.ravel(), lat.ravel()
+    weights = remap_tools.compute_weights(lon, lat, 5)
+
+    def field(lon, lat):
+        lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+        return np.cos(lat) * (np.cos(lon) + 2 * np.sin(lon)) + 3 * np.sin(lat)
+
+    hp_lon, hp_lat = remap_tools.healpix_centers(5)
+    seam = (hp_lon % 360 > 355) & (np.abs(hp_lat) < 80)
+    assert seam.sum() > 0
+    assert weights.valid[seam].all()
+
+    # all vertices of a target across the seam are next to it
+    vertex_lon = lon[weights.src_idx.values[seam]]
+    assert np.all((vertex_lon <= 10) | (vertex_lon >= 345))
+
+    remapped = (field(lon, lat)[weights.src_idx] * weights.weights).sum("tri")
+    np.testing.assert_allclose(
+        remapped[seam], field(hp_lon[seam], hp_lat[seam]), atol=0.02
+    )
+
+
+def test_tiled_weights():
+    ds = random_cells(5000)
+    lon, lat = ds.lon.values, ds.lat.values
+    serial = remap_tools.compute_weights_tiled(lon, lat, 4, tile_order=1, nprocs=1)
+    parallel = remap_tools.compute_weights_tiled(lon, lat, 4, tile_order=1, nprocs=2)
+    xr.testing.assert_equal(serial, parallel)
+    assert serial.valid.all()
+
+    def field(lon, lat):
+        lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+        return np.cos(lat) * np.sin(2 * lon) + np.sin(lat)
+
+    hp_lon, hp_lat = remap_tools.healpix_centers(4)
+    remapped = (field(lon, lat)[serial.src_idx] * serial.weights).sum("tri")
+    np.testing.assert_allclose(remapped, field(hp_lon, hp_lat), atol=0.1)
+
+
+def test_bilinear_weights():
+    lon = np.arange(0, 360, 2.5)
+    lat = np.arange(88.75, -90, -2.5)
+    hp_lon, hp_lat = remap_tools.healpix_centers(4)
+    weights = remap_tools.compute_weights_bilinear(lon, lat, hp_lon, hp_lat)
+
+    # a function that is linear in lat and periodic and linear in lon except
+    # across the dateline, flattened like da.stack(cell=(lon, lat))
+    lon2d, lat2d = np.meshgrid(lon, lat, indexing="ij")
+    data = (np.sin(np.deg2rad(lon2d)) + 3 * lat2d).ravel()
+    remapped = (data[weights.src_idx] * weights.weights).sum("tri")
+
+    inner = np.abs(hp_lat) < 88.75
+    expected = 3 * hp_lat
+    assert weights.valid.all()
+    np.testing.assert_allclose(weights.weights.sum("tri"), 1)
+    np.testing.assert_allclose(
+        remapped[inner] - np.sin(np.deg2rad(hp_lon[inner])), expected[inner], atol=3e-4
+    )
+
+    # the same weights (up to index layout) for a grid with a cyclic column
+    cyclic = remap_tools.compute_weights_bilinear(
+        np.append(lon, 360), lat, hp_lon, hp_lat
+    )
+    data_cyclic = np.concatenate([data, data[: lat.size]])
+    np.testing.assert_allclose(
+        (data_cyclic[cyclic.src_idx] * cyclic.weights).sum("tri"), remapped
+    )
@@ -0,0 +1,66 @@
+import easygems.remap as egr
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import zarr
+
+import um_latlon_pp_to_healpix_nc as um
+
+
+def make_field():
+    rng = np.random.default_rng(0)
+    lon = np.arange(0, 360, 30.0)
+    lat = np.arange(-82.5, 83, 15.0)
+    return xr.DataArray(
+        rng.random((3, len(lat), len(lon))),
+        dims=("time", "latitude", "longitude"),
+        coords={
+            "time": pd.date_range("2020", periods=3, freq="h"),
+            "latitude": lat,
+            "longitude": lon,
+        },
+        name="tas",
+    )
+
+
+def apply_weights_per_field(da, weights):
+    """The previous path: add the cyclic column, then regrid field by field."""
+    flat = um._xr_add_cyclic_point(da, "longitude").stack(cell=("longitude", "latitude"))
+    return np.stack([egr.apply_weights(flat[i].values, **weights) for i in range(len(da))])
+
+
+def test_regrid_matches_apply_weights():
+    da = make_field()
+    weights = um.gen_weights(da.isel(time=0), zoom=2, add_cyclic=True, weights_path=None, cache=False)
+    # the weights refer to the cyclic column
+    assert int(weights.src_idx.max()) >= da.sizes["latitude"] * da.sizes["longitude"]
+    expected = apply_weights_per_field(da, weights)
+
+    # two fields per batch, so the last batch is partial
+    regridder = um.UMLatLon2HealpixRegridder(zoom_level=2, add_cyclic=True, weights_path=None, cache=False,
+                                             batch_bytes=2 * 4 * 12 * 12)
+    out = regridder.regrid(da, "longitude", "latitude")
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out.values, expected, rtol=1e-5)
+
+    lazy = regridder.regrid_lazy(da.chunk(time=1), "longitude", "latitude")
+    assert lazy.chunks is not None
+    np.testing.assert_allclose(lazy.values, expected, rtol=1e-5)
+
+    # the operator belongs to the grid of the weights
+    with pytest.raises(ValueError):
+        regridder.operator(6, 12)
+
+
+@pytest.mark.skipif(int(zarr.__version__.split(".")[0]) < 3, reason="zarr_tools uses the zarr 3 API")
+def test_regrid_to_zarr(tmp_path):
+    da = make_field()
+    regridder = um.UMLatLon2HealpixRegridder(zoom_level=2, weights_path=None, cache=False)
+    path = tmp_path / "tas.zarr"
+    regridder.regrid_to_zarr(da, "longitude", "latitude", path, timechunk=2, write_chunk=2)
+
+    expected = apply_weights_per_field(da, regridder.weights)
+    out = xr.open_zarr(path)["tas"]
+    assert out.dims == ("time", "cell")
+    np.testing.assert_allclose(out.values, expected, rtol=1e-5)
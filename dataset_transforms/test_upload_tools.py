@@ -0,0 +1,95 @@
+import socket
+
+import numpy as np
+import pytest
+
+pytest.importorskip("moto")
+s3fs = pytest.importorskip("s3fs")
+
+from moto.server import ThreadedMotoServer  # noqa: E402
+
+import upload_tools  # noqa: E402
+
+
+@pytest.fixture
+def endpoint():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    yield f"http://127.0.0.1:{port}"
+    server.stop()
+
+
+def test_upload_tree(tmp_path, endpoint):
+    options = dict(endpoint_url=endpoint, key="test", secret="test")
+    fs = s3fs.S3FileSystem(**options)
+    fs.mkdir("bucket")
+
+    rng = np.random.default_rng(0)
+    files = {
+        "x/.zarray": b"{}",
+        "x/0/0": rng.bytes(1000),
+        "x/0/1": rng.bytes(1000),
+        # three parts
+        "big": rng.bytes(11 * 2**20),
+    }
+    for key, data in files.items():
+        (tmp_path / key).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / key).write_bytes(data)
+
+    with upload_tools.AsyncUploader(
+        "s3://bucket/out.zarr",
+        dict(options),
+        max_requests=4,
+        max_inflight_bytes=2**23,
+        multipart_threshold=2**23,
+        part_size=upload_tools.MIN_PART_SIZE,
+    ) as uploader:
+        # a failing request is retried
+        call_s3 = uploader.fs._call_s3
+        failures = [ConnectionError("flaky")]
+
+        async def flaky(method, **kwargs):
+            if failures:
+                raise failures.pop()
+            return await call_s3(method, **kwargs)
+
+        uploader.fs._call_s3 = flaky
+        uploader.backoff = 0.01
+        uploader.upload_tree(tmp_path, delete=True)
+        stats = uploader.report()
+
+    for key, data in files.items():
+        assert fs.cat(f"bucket/out.zarr/{key}") == data
+    assert stats["objects"] == 4
+    assert stats["bytes"] == sum(len(d) for d in files.values())
+    assert stats["retries"] == 1
+    assert stats["failed"] == 0
+    # chunks are removed once uploaded, metadata stays
+    assert (tmp_path / "x/.zarray").exists()
+    assert not (tmp_path / "x/0/0").exists()
+    assert not (tmp_path / "big").exists()
+
+
+def test_failed_upload(tmp_path, endpoint):
+    options = dict(endpoint_url=endpoint, key="test", secret="test")
+    # moto keeps its buckets across servers in one process
+    s3fs.S3FileSystem(**options).mkdir("failed")
+    (tmp_path / "x/0").mkdir(parents=True)
+    (tmp_path / "x/0/0").write_bytes(b"chunk")
+
+    with upload_tools.AsyncUploader(
+        "s3://failed/out.zarr", dict(options), retries=1, backoff=0.01
+    ) as uploader:
+
+        async def down(method, **kwargs):
+            raise ConnectionError("down")
+
+        uploader.fs._call_s3 = down
+        assert uploader.upload_tree(tmp_path, delete=True) == 1
+        assert uploader.wait() == 1
+        assert uploader.report()["failed"] == 1
+    # the chunk stays for the next attempt
+    assert (tmp_path / "x/0/0").exists()
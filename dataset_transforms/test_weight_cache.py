@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import xarray as xr
+import weight_cache
+
+
+def _weights(n):
+    return xr.Dataset({"weights": (("tgt_idx", "tri"), np.ones((n, 3)))})
+
+
+def test_get_or_compute(tmp_path):
+    cache = weight_cache.WeightCache(tmp_path)
+    lon, lat = np.arange(10.0), np.arange(10.0)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return _weights(5)
+
+    w1 = cache.get_or_compute(compute, lon, lat, order=3, method="delaunay")
+    w2 = cache.get_or_compute(compute, lon, lat, order=3, method="delaunay")
+    cache.get_or_compute(compute, lon, lat, order=4, method="delaunay")
+    xr.testing.assert_equal(w1, w2)
+    assert len(calls) == 2
+
+
+def test_lru_eviction(tmp_path):
+    cache = weight_cache.WeightCache(tmp_path, max_bytes=0)
+    cache.put("a", _weights(5))
+    # do not rely on the mtime resolution of the filesystem
+    old = cache.path("a").stat().st_mtime - 60
+    os.utime(cache.path("a"), (old, old))
+    cache.put("b", _weights(5))
+    assert [p.name for p, _, _ in cache.entries()] == ["b.nc"]
+
+
+def test_default_cache_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.delenv("HEALPIX_WEIGHT_CACHE_DIR", raising=False)
+    assert weight_cache.default_cache() is None
+    monkeypatch.setenv("HEALPIX_WEIGHT_CACHE_DIR", str(tmp_path))
+    assert weight_cache.default_cache().cache_dir == tmp_path
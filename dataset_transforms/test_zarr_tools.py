@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import zarr
+import zarr_tools
+
+pytestmark = pytest.mark.skipif(
+    int(zarr.__version__.split(".")[0]) < 3, reason="zarr_tools uses the zarr 3 API"
+)
+
+
+def test_write_parts(tmp_path):
+    rng = np.random.default_rng(0)
+    ncell = 12 * 4**2
+    ds = xr.Dataset(
+        {
+            "tas": (("time", "cell"), rng.random((10, ncell)).astype("float32")),
+            "ta": (("time", "level", "cell"), rng.random((10, 3, ncell))),
+            "orog": (("cell",), rng.random(ncell).astype("float32")),
+        },
+        coords={
+            "time": pd.date_range("2020", periods=10, freq="h"),
+            "level": [1, 2, 3],
+        },
+    ).chunk(time=2)
+    ds["tas"][3, :5] = np.nan
+    path = tmp_path / "out.zarr"
+    zarr_tools.create_zarr_structure(path=path, outds=ds, timechunk=2, order=2)
+    zarr_tools.write_parts(outds=ds, path=path, time_chunk=4, nthreads=2)
+
+    xr.testing.assert_allclose(xr.open_zarr(path).load(), ds.load())
+    assert (path / ".write_status").read_text() == "10"
+
+
+def test_plan_time_slices(tmp_path):
+    ds = xr.Dataset({"tas": (("time", "cell"), np.zeros((30, 48), dtype="float32"))})
+    path = tmp_path / "out.zarr"
+    zarr_tools.create_zarr_structure(path=path, outds=ds, timechunk=4, order=1)
+    group = zarr_tools.open_group(path)
+
+    slices, stats = zarr_tools.plan_time_slices(group, ["tas"], 30, time_chunk=10)
+    assert [(s.start, s.stop) for s in slices][:2] == [(0, 8), (8, 16)]
+    assert slices[-1] == slice(24, 30)
+    assert stats["rewrites"] == 0
+    assert stats["rewrites_avoided"] == 1
+    with pytest.raises(ValueError):
+        zarr_tools.plan_time_slices(group, ["tas"], 30, time_chunk=10, strict=True)
+
+
+def test_write_region_fill_value(tmp_path):
+    ds = xr.Dataset(
+        {
+            "tas": (("time", "cell"), np.ones((4, 48), dtype="float32")),
+            "pr": (("time", "cell"), np.ones((4, 48), dtype="float32")),
+        }
+    )
+    ds["tas"][1, :3] = np.nan
+    ds["pr"][1, :3] = np.nan
+    path = tmp_path / "out.zarr"
+    ds.to_zarr(
+        path, zarr_format=2, compute=False, encoding={"pr": {"_FillValue": -999.0}}
+    )
+    group = zarr_tools.open_group(path)
+    assert zarr_tools.is_raw_writable(ds["tas"], group["tas"])
+    assert not zarr_tools.is_raw_writable(ds["pr"], group["pr"])
+
+    with ThreadPoolExecutor(2) as pool:
+        zarr_tools.write_region(ds, group, path, slice(0, 4), pool)
+    # NaNs are encoded as the declared fill value
+    assert (group["pr"][1, :3] == -999).all()
+    xr.testing.assert_equal(xr.open_zarr(path).load(), ds)
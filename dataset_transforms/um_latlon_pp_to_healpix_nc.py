@@ -14,11 +14,20 @@ import xarray as xr
 from cartopy.util import add_cyclic_point
 from loguru import logger
 
+import coarsen_tools
+import remap_tools
+import weight_cache
+import zarr_tools
+
 WEIGHTS_PATH = '/gws/nopw/j04/hrcm/mmuetz/weights/regrid_weights_N2560_hpz10.nc'
 
 
 def _xr_add_cyclic_point(da, lonname):
-    """Add a cyclic column to the longitude dim."""
+    """Add a cyclic column to the longitude dim (lazily for dask-backed data)."""
+    if da.chunks is not None:
+        lon = da[lonname].values
+        cyclic = da.isel({lonname: [0]}).assign_coords({lonname: lon[-1:] + (lon[1] - lon[0])})
+        return xr.concat([da, cyclic], dim=lonname)
 
     # Use add_cyclic_point to interpolate input data
     lon_idx = da.dims.index(lonname)
@@ -34,10 +43,16 @@ def _xr_add_cyclic_point(da, lonname):
     return daout
 
 
-def gen_weights(da, zoom=10, lonname='longitude', latname='latitude', add_cyclic=True, weights_path=WEIGHTS_PATH):
-    """Generate delaunay weights for regridding.
+def gen_weights(da, zoom=10, lonname='longitude', latname='latitude', add_cyclic=True, weights_path=WEIGHTS_PATH,
+                cache=None, tile_zoom=None, nprocs=None, interp='delaunay'):
+    """Generate delaunay (or bilinear) weights for regridding.
+
+    Can use quite a lot of RAM: 30-40G for a UM N2560 conversion. Pass tile_zoom to split the target into the
+    nested healpix pixels at that zoom, which are triangulated separately on nprocs processes. Memory is then bounded
+    by the source points around a single tile (see remap_tools.compute_weights_tiled).
 
-    Can use quite a lot of RAM: 30-40G for a UM N2560 conversion.
+    With interp='bilinear', the enclosing lat/lon cell of each healpix pixel is looked up directly on the regular
+    grid instead (see remap_tools.compute_weights_bilinear), which takes seconds and needs no cyclic point.
 
     Assumption is that da has lon: 0 to 360, lat: -90 to 90.
     It is important to make sure that the input domain contains the output domain, i.e. its convex hull is bigger.
@@ -52,11 +67,20 @@ def gen_weights(da, zoom=10, lonname='longitude', latname='latitude', add_cyclic
         lonname (str): name of longitude coord.
         latname (str): name of latitude coord.
         add_cyclic (bool): whether to add cyclic points.
-        weights_path (str): path to weights file.
+        weights_path (str | None): path to weights file, or None to not save the weights.
+        cache (weight_cache.WeightCache | None | False): weight cache to look the weights up in (the cache in
+            $HEALPIX_WEIGHT_CACHE_DIR if None, no caching if that is unset or cache is False).
+        tile_zoom (int | None): zoom level of the tiles for tiled weight generation, None for no tiling.
+        nprocs (int | None): number of processes for tiled weight generation.
+        interp (str): interpolation [delaunay, bilinear].
+
+    Returns:
+        xr.Dataset : the weights.
     """
-    weights_path = Path(weights_path)
-    assert not weights_path.exists(), f'Weights file {weights_path} already exists'
-    weights_path.parent.mkdir(parents=True, exist_ok=True)
+    if weights_path is not None:
+        weights_path = Path(weights_path)
+        assert not weights_path.exists(), f'Weights file {weights_path} already exists'
+        weights_path.parent.mkdir(parents=True, exist_ok=True)
 
     nside = hp.order2nside(zoom)
     npix = hp.nside2npix(nside)
@@ -77,12 +101,39 @@ def gen_weights(da, zoom=10, lonname='longitude', latname='latitude', add_cyclic
     # Apply a 360 degree offset. This ensures that all hp_lon are within da[lonname].
     hp_lon[hp_lon == 0] = 360
 
-    da_flat = da.stack(cell=(lonname, latname))
-
-    logger.info('computing weights')
-    weights = egr.compute_weights_delaunay((da_flat[lonname].values, da_flat[latname].values), (hp_lon, hp_lat))
-    weights.to_netcdf(weights_path)
-    logger.info(f'saved weights to {weights_path}')
+    if interp == 'bilinear':
+        # The weights only depend on the 1D coords of the regular grid.
+        src_lon = da[lonname].values
+        src_lat = da[latname].values
+    else:
+        da_flat = da.stack(cell=(lonname, latname))
+        src_lon = da_flat[lonname].values
+        src_lat = da_flat[latname].values
+
+    def compute():
+        logger.info('computing weights')
+        if interp == 'bilinear':
+            return remap_tools.compute_weights_bilinear(src_lon, src_lat, hp_lon, hp_lat)
+        if tile_zoom is not None:
+            return remap_tools.compute_weights_tiled(src_lon, src_lat, zoom, tile_order=tile_zoom, nprocs=nprocs)
+        return egr.compute_weights_delaunay((src_lon, src_lat), (hp_lon, hp_lat))
+
+    if cache is None:
+        cache = weight_cache.default_cache()
+    if cache is None or cache is False:
+        weights = compute()
+    else:
+        if interp == 'bilinear':
+            method = 'bilinear'
+        elif tile_zoom is None:
+            method = 'delaunay_lon0_360'
+        else:
+            method = f'delaunay_tiled{tile_zoom}'
+        weights = cache.get_or_compute(compute, src_lon, src_lat, order=zoom, method=method)
+    if weights_path is not None:
+        weights.to_netcdf(weights_path)
+        logger.info(f'saved weights to {weights_path}')
+    return weights
 
 
 def hp_coarsen(data):
@@ -117,26 +168,39 @@ def hp_coarsen_with_weights(data, nan_weights=None):
 class UMLatLon2HealpixRegridder:
     """Regrid UM lat/lon .pp files to healpix .nc"""
 
-    def __init__(self, method='easygems_delaunay', zoom_level=10, add_cyclic=True, weights_path=WEIGHTS_PATH):
+    def __init__(self, method='easygems_delaunay', zoom_level=10, add_cyclic=True, weights_path=WEIGHTS_PATH,
+                 cache=None, batch_bytes=2**30):
         """Initate a UM regridder for a particular method/zoom levels.
 
         Parameters:
-            method (str) : regridding method [easygems_delaunay, earth2grid].
+            method (str) : regridding method [easygems_delaunay, bilinear, earth2grid]. bilinear uses weights from
+                remap_tools.compute_weights_bilinear and does not need add_cyclic.
             zoom_level (int) : required healpix zoom level.
-            weights_path (pathlib.Path | str | None) : path to pre-computed weights (see gen_weights above).
+            weights_path (pathlib.Path | str | None) : path to pre-computed weights (see gen_weights above). If None,
+                weights are taken from the weight cache (or generated) on the first call to regrid.
+            cache (weight_cache.WeightCache | None | False) : weight cache used when weights_path is None.
+            batch_bytes (int) : size of the float32 input fields regridded at once.
         """
-        if method not in ['easygems_delaunay', 'earth2grid']:
-            raise ValueError('method must be either easygems_delaunay or earth2grid')
+        if method not in ['easygems_delaunay', 'bilinear', 'earth2grid']:
+            raise ValueError('method must be either easygems_delaunay, bilinear or earth2grid')
         self.method = method
         self.zoom_level = zoom_level
         self.add_cyclic = add_cyclic
         self.weights_path = weights_path
-        if method == 'easygems_delaunay':
+        self.cache = cache
+        self.batch_bytes = batch_bytes
+        self.weights = None
+        self._operator = None
+        self._operator_shape = None
+        if method in ['easygems_delaunay', 'bilinear'] and self.weights_path is not None:
             self.weights = xr.load_dataset(self.weights_path)
 
     def regrid(self, da, lonname, latname):
         """Do the regridding - set up common data to allow looping over all dims that are not lat/lon
 
+        For the weights based methods, all fields are regridded in batches of up to batch_bytes of float32 input, so
+        that the memory needed on top of the input and the float32 output is bounded.
+
         Parameters:
             da (xr.DataArray) : DataArray to be regridded
             lonname (str): name of longitude coord.
@@ -145,9 +209,12 @@ class UMLatLon2HealpixRegridder:
         Returns:
             xr.DataArray : regridded data
         """
-        if self.add_cyclic:
+        if self.method in ['easygems_delaunay', 'bilinear']:
+            self._ensure_weights(da, lonname, latname)
+        if self.add_cyclic and self.method == 'earth2grid':
             da = _xr_add_cyclic_point(da, lonname)
         reduced_dims = [d for d in da.dims if d not in [lonname, latname]]
+        da = da.transpose(*reduced_dims, latname, lonname)
         coords = {d: da[d] for d in reduced_dims}
 
         # This is the shape of the dataset without lat/lon.
@@ -156,11 +223,11 @@ class UMLatLon2HealpixRegridder:
         # any number of dims by passing to product as product(*dim_ranges).
         dim_ranges = [range(s) for s in dim_shape]
         ncell = 12 * 4 ** self.zoom_level
-        regridded_data = np.zeros(dim_shape + [ncell])
+        regridded_data = np.empty(dim_shape + [ncell], dtype=np.float32)
         dim_len = {c: len(da[c]) for c in coords.keys()}
         logger.trace(f'  - {dim_len}')
-        if self.method == 'easygems_delaunay':
-            self._regrid_easygems_delaunay(da, dim_ranges, regridded_data, lonname, latname)
+        if self.method in ['easygems_delaunay', 'bilinear']:
+            self._regrid_easygems_delaunay(da, regridded_data, lonname, latname)
         elif self.method == 'earth2grid':
             self._regrid_earth2grid(da, dim_ranges, regridded_data, lonname, latname)
         coords = {**coords, 'cell': np.arange(ncell)}
@@ -176,13 +243,105 @@ class UMLatLon2HealpixRegridder:
         daout.attrs['regrid_method'] = self.method
         return daout
 
-    def _regrid_easygems_delaunay(self, da, dim_ranges, regridded_data, lonname, latname):
-        """Use precomputed weights file to do Delaunay regridding."""
-        da_flat = da.stack(cell=(lonname, latname))
-        for idx in product(*dim_ranges):
-            logger.trace(f'    - {idx}')
-            # TODO: speed up with xr.apply_ufunc...
-            regridded_data[idx] = egr.apply_weights(da_flat[idx].values, **self.weights)
+    def _ensure_weights(self, da, lonname, latname):
+        """Take the weights from the cache (or generate them) if they were not loaded from weights_path."""
+        if self.weights is None:
+            # Only the lat/lon coords are needed to generate the weights.
+            field = da.isel({d: 0 for d in da.dims if d not in [lonname, latname]})
+            interp = 'bilinear' if self.method == 'bilinear' else 'delaunay'
+            self.weights = gen_weights(field, self.zoom_level, lonname, latname, add_cyclic=self.add_cyclic,
+                                       weights_path=None, cache=self.cache, interp=interp)
+
+    def operator(self, nlon, nlat):
+        """Sparse float32 operator of the weights, acting on a (lon, lat) flattened field of shape nlon * nlat.
+
+        Weights that were generated with a cyclic column refer to it by index nlon * nlat + ilat. These are folded
+        back onto the first column, so the data itself never needs the cyclic column.
+        """
+        if self._operator is not None and self._operator_shape != (nlon, nlat):
+            raise ValueError(f'Weights are for a {self._operator_shape} (lon, lat) grid, got {(nlon, nlat)}')
+        if self._operator is None:
+            nsrc = nlon * nlat
+            weights = self.weights.assign(src_idx=self.weights.src_idx % nsrc)
+            self._operator = remap_tools.weights_to_csr(weights, nsrc)
+            self._operator_shape = (nlon, nlat)
+        return self._operator
+
+    def _regrid_fields(self, fields):
+        """Regrid an array of shape (..., lat, lon) with the weights to shape (..., cell) in float32."""
+        nlat, nlon = fields.shape[-2:]
+        op, valid = self.operator(nlon, nlat)
+        # Flatten with lon as the outer dim, like da.stack(cell=(lonname, latname)).
+        block = fields.astype(np.float32).swapaxes(-1, -2).reshape(*fields.shape[:-2], nlon * nlat)
+        return remap_tools.apply_csr(block, op, valid)
+
+    def _regrid_easygems_delaunay(self, da, regridded_data, lonname, latname):
+        """Use precomputed weights file to do Delaunay (or bilinear) regridding."""
+        nlat, nlon = da.shape[-2:]
+        fields = da.values.reshape(-1, nlat, nlon)
+        out = regridded_data.reshape(-1, regridded_data.shape[-1])
+        batch = max(1, self.batch_bytes // (4 * nlat * nlon))
+        for start in range(0, len(fields), batch):
+            logger.trace(f'    - fields {start}:{start + batch}')
+            out[start:start + batch] = self._regrid_fields(fields[start:start + batch])
+
+    def regrid_lazy(self, da, lonname, latname):
+        """Regrid dask-backed data lazily, block by block.
+
+        Every dask block is regridded on its own, so memory is bounded by the chunking of the non lat/lon dims (the
+        lat/lon dims are merged into single chunks). Only supported for the weights based methods.
+
+        Parameters:
+            da (xr.DataArray) : DataArray to be regridded
+            lonname (str): name of longitude coord.
+            latname (str): name of latitude coord.
+
+        Returns:
+            xr.DataArray : lazily regridded float32 data
+        """
+        if self.method not in ['easygems_delaunay', 'bilinear']:
+            raise ValueError(f'Lazy regridding is not supported for {self.method}')
+        self._ensure_weights(da, lonname, latname)
+        ncell = 12 * 4 ** self.zoom_level
+        self.operator(len(da[lonname]), len(da[latname]))
+        da = da.chunk({lonname: -1, latname: -1})
+        daout = xr.apply_ufunc(
+            self._regrid_fields,
+            da,
+            input_core_dims=[[latname, lonname]],
+            output_core_dims=[['cell']],
+            output_dtypes=[np.float32],
+            dask='parallelized',
+            dask_gufunc_kwargs={'output_sizes': {'cell': ncell}},
+            keep_attrs=True,
+        )
+        daout = daout.assign_coords(cell=np.arange(ncell))
+        daout.attrs['grid_mapping'] = 'healpix_nested'
+        daout.attrs['healpix_zoom'] = self.zoom_level
+        daout.attrs['coarsened'] = False
+        daout.attrs['regrid_method'] = self.method
+        return daout
+
+    def regrid_to_zarr(self, da, lonname, latname, path, timechunk=24, write_chunk=None):
+        """Regrid lazily and stream the result into a chunked Zarr store (see zarr_tools).
+
+        The store is created on the first call. Writing can be resumed, zarr_tools keeps track of the time steps that
+        were written. At most write_chunk time steps are computed at a time.
+
+        Parameters:
+            da (xr.DataArray) : DataArray to be regridded, with a time dim.
+            lonname (str): name of longitude coord.
+            latname (str): name of latitude coord.
+            path (pathlib.Path | str) : path of the Zarr store.
+            timechunk (int) : chunk size of the time dim in the store.
+            write_chunk (int | None) : number of time steps computed and written at once, defaults to timechunk.
+        """
+        path = Path(path)
+        daout = self.regrid_lazy(da.chunk({'time': timechunk}), lonname, latname)
+        outds = daout.to_dataset(name=da.name or 'data')
+        if not path.exists():
+            zarr_tools.create_zarr_structure(path=path, outds=outds, timechunk=timechunk, order=self.zoom_level)
+        zarr_tools.write_parts(outds=outds, path=path, time_chunk=write_chunk or timechunk)
 
     def _regrid_earth2grid(self, da, dim_ranges, regridded_data, lonname, latname):
         """Use earth2grid (which uses torch) to do regridding."""
@@ -221,34 +380,19 @@ class UMLatLon2HealpixRegridder:
         zooms = list(zooms)
         assert len(da['cell']) == 12 * 4 ** zooms[0], f'cell has wrong number of points for {zooms[0]}'
 
-        dim_shape = list(da.shape[:-1])
-        # These are the ranges - can be used to iter over an idx that selects out each individual lat/lon field for
-        # any number of dims by passing to product as product(*dim_ranges).
-        dim_ranges = [range(s) for s in dim_shape]
+        da = da.transpose(..., 'cell')
         reduced_dims = [d for d in da.dims if d not in ['cell']]
+        # All levels in one vectorized pass; valid-counts are carried along, so coarse cells are exact means over
+        # all non-NaN fine cells. Works lazily on dask-backed arrays.
+        coarsened = coarsen_tools.coarsen_levels(da.data, [zooms[0] - zoom for zoom in zooms])
 
-        num_nans = np.isnan(da.values).sum()
-        logger.debug(f'  - {num_nans} NaNs in {da.name}')
-        if num_nans:
-            coarsen = 'with_weights'
-        else:
-            coarsen = 'without_weights'
-
-        timename = [c for c in da.coords if c.startswith('time')][0]
         das = {}
         for zoom in zooms:
             if zoom == zooms[0]:
-                regridded_data = da.values
                 daout = da
             else:
                 logger.debug(f'  - coarsen to {zoom}')
-                coarse_regridded_data = np.zeros(dim_shape + [12 * 4 ** zoom])
-                for idx in product(*dim_ranges):
-                    coarse_regridded_data[idx] = hp_coarsen(regridded_data[idx])
-                regridded_data = coarse_regridded_data
-
-                # 2d only.
-                # coords = {timename: da[timename], 'cell': np.arange(regridded_data.shape[1])}
+                regridded_data = coarsened[zooms[0] - zoom]
                 coords = {d: da.coords[d] for d in reduced_dims}
                 coords['cell'] = np.arange(regridded_data.shape[-1])
                 daout = xr.DataArray(regridded_data, dims=reduced_dims + ['cell'], coords=coords, attrs=da.attrs)
@@ -267,6 +411,15 @@ def main():
 
         gen_weights(da, zoom=10)
         return
+    if len(sys.argv) > 3 and sys.argv[1] == 'regrid_zarr':
+        # Stream the regridded data into a Zarr store: regrid_zarr <out.zarr> <in.pp> [<in.pp> ...]
+        outpath = Path(sys.argv[2])
+        cube = iris.load(sys.argv[3:]).concatenate_cube()
+        da = xr.DataArray.from_iris(cube)
+
+        regridder = UMLatLon2HealpixRegridder(weights_path=WEIGHTS_PATH)
+        regridder.regrid_to_zarr(da, 'longitude', 'latitude', outpath)
+        return
 
 
 if __name__ == '__main__':
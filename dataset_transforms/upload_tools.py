@@ -0,0 +1,272 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from pathlib import Path
+
+import s3fs
+
+logging.basicConfig()
+logger = logging.getLogger("upload_tools")
+logger.setLevel(logging.INFO)
+
+# S3 rejects parts smaller than this, except for the last one
+MIN_PART_SIZE = 5 * 2**20
+METADATA_FILES = (".zarray", ".zattrs", ".zgroup", ".zmetadata", "zarr.json")
+
+
+def is_metadata(key):
+    return key.rsplit("/", 1)[-1] in METADATA_FILES
+
+
+class _ByteLimit:
+    """Like a semaphore, but counting bytes."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, nbytes):
+        # an object larger than the limit takes all of it
+        nbytes = min(nbytes, self.limit)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + nbytes <= self.limit)
+            self.used += nbytes
+        return nbytes
+
+    async def release(self, nbytes):
+        async with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+
+class AsyncUploader:
+    """Upload local files to an S3 prefix from a single asyncio event loop.
+
+    All uploads share one client, and with it one connection pool of
+    `max_requests` connections. At most `max_inflight_bytes` are read into
+    memory at any time. Failed requests are retried `retries` times with
+    exponential backoff, and files larger than `multipart_threshold` are
+    uploaded in parts of `part_size`.
+
+    The loop runs in a background thread, so `submit` can be called from
+    ordinary code; it returns a `concurrent.futures.Future`.
+    """
+
+    def __init__(
+        self,
+        url,
+        storage_options=None,
+        max_requests=64,
+        max_inflight_bytes=2**30,
+        retries=5,
+        backoff=0.5,
+        multipart_threshold=2**26,
+        part_size=2**25,
+    ):
+        self.bucket, _, self.prefix = url.removeprefix("s3://").partition("/")
+        self.prefix = self.prefix.strip("/")
+        self.max_requests = max_requests
+        self.max_inflight_bytes = max_inflight_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.multipart_threshold = multipart_threshold
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.stats = dict(objects=0, bytes=0, requests=0, retries=0, failed=0)
+        self._start = None
+        self._end = None
+        self._futures = set()
+        self._lock = threading.Lock()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._call(self._connect(storage_options or {}))
+
+    async def _connect(self, storage_options):
+        storage_options = dict(storage_options)
+        config = storage_options.pop("config_kwargs", {})
+        self.fs = s3fs.S3FileSystem(
+            asynchronous=True,
+            loop=self._loop,
+            config_kwargs={"max_pool_connections": self.max_requests, **config},
+            **storage_options,
+        )
+        await self.fs.set_session()
+        self._requests = asyncio.Semaphore(self.max_requests)
+        self._inflight = _ByteLimit(self.max_inflight_bytes)
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    async def _request(self, method, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._requests:
+                    self.stats["requests"] += 1
+                    return await self.fs._call_s3(method, Bucket=self.bucket, **kwargs)
+            except (FileNotFoundError, PermissionError):
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                self.stats["retries"] += 1
+                delay = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+                logger.debug(
+                    f"{method} {kwargs.get('Key')} failed ({e}), "
+                    f"retrying in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+
+    async def _read_and_put(self, path, offset, size, method, **kwargs):
+        held = await self._inflight.acquire(size)
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                body = f.read(size)
+            return await self._request(method, Body=body, **kwargs)
+        finally:
+            await self._inflight.release(held)
+
+    async def _upload(self, key, path, delete):
+        try:
+            return await self._upload_file(key, path, delete)
+        except Exception:
+            # counted here, so it is included once the future is done
+            self.stats["failed"] += 1
+            raise
+
+    async def _upload_file(self, key, path, delete):
+        self._start = self._start or time.perf_counter()
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            # zarr does not write chunks that only hold the fill value
+            await self._request("delete_object", Key=self._key(key))
+            return 0
+        if size <= self.multipart_threshold:
+            await self._read_and_put(path, 0, size, "put_object", Key=self._key(key))
+        else:
+            await self._multipart(key, path, size)
+        if delete:
+            os.remove(path)
+        self.stats["objects"] += 1
+        self.stats["bytes"] += size
+        self._end = time.perf_counter()
+        return size
+
+    async def _multipart(self, key, path, size):
+        key = self._key(key)
+        mpu = await self._request("create_multipart_upload", Key=key)
+        upload_id = mpu["UploadId"]
+        try:
+            offsets = range(0, size, self.part_size)
+            parts = await asyncio.gather(
+                *(
+                    self._read_and_put(
+                        path,
+                        offset,
+                        min(self.part_size, size - offset),
+                        "upload_part",
+                        Key=key,
+                        UploadId=upload_id,
+                        PartNumber=number,
+                    )
+                    for number, offset in enumerate(offsets, start=1)
+                )
+            )
+            await self._request(
+                "complete_multipart_upload",
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={
+                    "Parts": [
+                        {"PartNumber": number, "ETag": part["ETag"]}
+                        for number, part in enumerate(parts, start=1)
+                    ]
+                },
+            )
+        except BaseException:
+            await self._request("abort_multipart_upload", Key=key, UploadId=upload_id)
+            raise
+
+    def submit(self, key, path, delete=False):
+        """Upload the file at `path` to `key` below the prefix.
+
+        If `delete`, the local file is removed once it is uploaded. A missing
+        file removes the object instead.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self._upload(key, path, delete), self._loop
+        )
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        if future.exception() is not None:
+            logger.warning(f"Upload failed: {future.exception()}")
+
+    def upload_files(self, root, keys, delete=False):
+        return [self.submit(key, Path(root) / key, delete) for key in keys]
+
+    def upload_tree(self, root, delete=False):
+        """Upload every file below `root`, keeping their relative paths.
+
+        With `delete`, uploaded files are removed, except for zarr metadata.
+        Returns the number of files that failed to upload.
+        """
+        root = Path(root)
+        futures = []
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                key = (Path(dirpath) / name).relative_to(root).as_posix()
+                futures.append(
+                    self.submit(key, root / key, delete and not is_metadata(key))
+                )
+        self.wait()
+        return sum(future.exception() is not None for future in futures)
+
+    def wait(self):
+        """Wait for all submitted uploads; returns the number that failed so far."""
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        return self.stats["failed"]
+
+    def report(self):
+        elapsed = (self._end or 0) - (self._start or 0)
+        stats = dict(self.stats, seconds=elapsed)
+        stats["mb_per_s"] = stats["bytes"] / elapsed / 1e6 if elapsed > 0 else 0.0
+        logger.info(
+            f"Uploaded {stats['objects']} objects, {stats['bytes'] / 1e9:.3g} GB "
+            f"in {elapsed:.1f}s ({stats['mb_per_s']:.1f} MB/s), "
+            f"{stats['requests']} requests, {stats['retries']} retries, "
+            f"{stats['failed']} failed"
+        )
+        return stats
+
+    def close(self):
+        self.wait()
+        self._call(self.fs.s3.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,127 @@
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+logging.basicConfig()
+logger = logging.getLogger("weight_cache")
+logger.setLevel(logging.INFO)
+
+DEFAULT_MAX_BYTES = 5 * 1024**3
+
+
+def hash_arrays(*arrays, **params):
+    """Content hash of the given coordinate arrays and (scalar) parameters."""
+    h = hashlib.blake2b(digest_size=20)
+    for a in arrays:
+        a = np.ascontiguousarray(np.asarray(a, dtype="float64"))
+        h.update(str(a.shape).encode())
+        h.update(memoryview(a).cast("B"))
+    for k in sorted(params):
+        h.update(f"{k}={params[k]!r};".encode())
+    return h.hexdigest()
+
+
+class WeightCache:
+    """On-disk cache of remapping weights with a size cap and LRU eviction.
+
+    Entries are NetCDF files named by a content hash of the source coordinates
+    and the remapping parameters. The modification time of an entry is bumped on
+    every hit, so eviction removes the least recently used entries first.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = float(
+                os.environ.get(
+                    "HEALPIX_WEIGHT_CACHE_MAX_GB", DEFAULT_MAX_BYTES / 1024**3
+                )
+            )
+            max_bytes = int(max_bytes * 1024**3)
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def key(self, lon, lat, order, method):
+        return hash_arrays(lon, lat, order=order, method=method)
+
+    def path(self, key):
+        return self.cache_dir / f"{key}.nc"
+
+    def get(self, key):
+        path = self.path(key)
+        if not path.exists():
+            return None
+        try:
+            weights = xr.load_dataset(path)
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            return None
+        os.utime(path)
+        logger.info(f"Loaded weights from cache {path}")
+        return weights
+
+    def put(self, key, weights):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        # write to a temporary file first, so concurrent readers never see a
+        # partially written entry.
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".nc.tmp")
+        os.close(fd)
+        try:
+            weights.to_netcdf(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        logger.info(f"Stored weights in cache {path}")
+        self.evict()
+
+    def get_or_compute(self, compute, lon, lat, order, method):
+        """Return cached weights or call `compute()` and store its result."""
+        key = self.key(lon, lat, order, method)
+        weights = self.get(key)
+        if weights is None:
+            weights = compute()
+            self.put(key, weights)
+        return weights
+
+    def entries(self):
+        """Cache entries as (path, size, mtime), least recently used first."""
+        entries = []
+        for path in self.cache_dir.glob("*.nc"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        # never evict the most recently used entry
+        for path, size, _ in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            logger.info(f"Evicting {path} from weight cache")
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            path.unlink(missing_ok=True)
+
+
+def default_cache():
+    """The cache in `$HEALPIX_WEIGHT_CACHE_DIR`, or None if it is not set.
+
+    Caching is opt-in, as weights of fine grids take several GB.
+    """
+    cache_dir = os.environ.get("HEALPIX_WEIGHT_CACHE_DIR")
+    if not cache_dir:
+        return None
+    return WeightCache(cache_dir)
@@ -1,4 +1,8 @@
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import dask
+import numpy as np
 import xarray as xr
 from pathlib import Path
 import chunk_tools
@@ -9,12 +13,19 @@ logger = logging.getLogger("zarr_tools")
 logger.setLevel(logging.INFO)
 
 
-def create_zarr_structure(path, outds, timechunk, order):
+def create_zarr_structure(
+    path, outds, timechunk, order, compressors=None, keepbits=None
+):
     store = create_store(path)
     outds.to_zarr(
         store,
+        zarr_format=2,
         encoding=chunk_tools.get_encodings(
-            outds=outds, timechunk=timechunk, order=order
+            outds=outds,
+            timechunk=timechunk,
+            order=order,
+            compressors=compressors,
+            keepbits=keepbits,
         ),
         compute=False,
     )
@@ -22,16 +33,17 @@ def create_zarr_structure(path, outds, timechunk, order):
 
 
 def create_store(path):
-    store = zarr.storage.DirectoryStore(
-        path, normalize_keys=False, dimension_separator="/"
-    )
+    # chunk keys use "/" as separator, see chunk_tools.CHUNK_KEY_ENCODING
+    store = zarr.storage.LocalStore(path)
     return store
 
 
-def write_parts(outds: xr.Dataset, path: Path, time_chunk: int):
+def write_parts(outds: xr.Dataset, path: Path, time_chunk: int, nthreads=None):
     status_filename, start = check_for_status(path)
     outds = handle_timeless_variables(outds, path, start)
-    handle_time_dependent_variables(outds, path, time_chunk, status_filename, start)
+    handle_time_dependent_variables(
+        outds, path, time_chunk, status_filename, start, nthreads=nthreads
+    )
 
 
 def check_for_status(path):
@@ -61,14 +73,170 @@ def handle_timeless_variables(outds, path, start):
     return outds
 
 
-def handle_time_dependent_variables(outds, path, time_chunk, status_filename, start):
-    for i in range(start, len(outds.time), time_chunk):
-        tslice = slice(i, i + time_chunk)
-        for var_name in outds:
-            write_variable_chunk(outds, var_name, path, tslice)
-        with open(status_filename, mode="w") as status:
-            status.write(str(i + time_chunk))
-        logger.info(f"Processed time steps starting at {i}")
+def handle_time_dependent_variables(
+    outds, path, time_chunk, status_filename, start, nthreads=None
+):
+    """Write all time-dependent variables block by block.
+
+    All variables of a time block are computed in a single dask graph, so inputs
+    shared between variables are only evaluated once, and are then written
+    concurrently into the already opened store. The blocks are aligned to the
+    time chunks of the store.
+    """
+    group = open_group(path)
+    slices, _ = plan_time_slices(
+        group, list(outds.data_vars), len(outds.time), time_chunk, start
+    )
+    with ThreadPoolExecutor(nthreads or os.cpu_count()) as pool:
+        for tslice in slices:
+            block = compute_block(outds.isel(time=tslice))
+            write_region(block, group, path, tslice, pool)
+            with open(status_filename, mode="w") as status:
+                status.write(str(tslice.stop))
+            logger.info(f"Processed time steps starting at {tslice.start}")
+
+
+def time_chunk_grid(group, names):
+    """Time chunk size of every variable in `names` that has a time dimension."""
+    grid = {}
+    for name in names:
+        array = group[name]
+        dims = array.attrs["_ARRAY_DIMENSIONS"]
+        if "time" not in dims:
+            continue
+        axis = dims.index("time")
+        other = [
+            -(-size // chunk)
+            for d, size, chunk in zip(dims, array.shape, array.chunks)
+            if d != "time"
+        ]
+        grid[name] = (array.chunks[axis], int(np.prod(other)))
+    return grid
+
+
+def count_partial_chunks(slices, chunk, ntime):
+    """Number of time chunks only partially covered by the writes in `slices`.
+
+    Every one of them is read, merged and recompressed again by the next write.
+    """
+    partial = set()
+    for s in slices:
+        if s.start % chunk:
+            partial.add(s.start // chunk)
+        stop = min(s.stop, ntime)
+        if stop % chunk and stop != ntime:
+            partial.add(stop // chunk)
+    return len(partial)
+
+
+def plan_time_slices(group, names, ntime, time_chunk=None, start=0, strict=False):
+    """Time slices for writing `names` into `group` that never split a chunk.
+
+    `time_chunk` is the requested number of time steps per write. If it is not
+    a multiple of the stores' time chunks, it is rounded down to one (and a
+    ValueError is raised instead if `strict`). Returns the slices and statistics
+    on the chunk rewrites avoided compared to the requested slicing.
+    """
+    grid = time_chunk_grid(group, names)
+    chunk = np.lcm.reduce([c for c, _ in grid.values()]) if grid else 1
+    chunk = int(chunk)
+    if time_chunk is None:
+        time_chunk = chunk
+    batch = time_chunk
+    if time_chunk % chunk:
+        msg = (
+            f"Writing {time_chunk} time steps at once does not align with the time "
+            f"chunks of {chunk} in the store"
+        )
+        if strict:
+            raise ValueError(msg)
+        batch = max(chunk, time_chunk // chunk * chunk)
+        logger.warning(f"{msg}, writing {batch} at once instead.")
+    if start % chunk:
+        if strict:
+            raise ValueError(f"Start {start} is not on a time chunk boundary")
+        logger.warning(f"Start {start} is not on a time chunk boundary")
+
+    slices = [slice(i, min(i + batch, ntime)) for i in range(start, ntime, batch)]
+    requested = [
+        slice(i, min(i + time_chunk, ntime)) for i in range(start, ntime, time_chunk)
+    ]
+    stats = dict(writes=len(slices), requested_rewrites=0, rewrites=0)
+    for c, nchunks in grid.values():
+        stats["requested_rewrites"] += (
+            count_partial_chunks(requested, c, ntime) * nchunks
+        )
+        stats["rewrites"] += count_partial_chunks(slices, c, ntime) * nchunks
+    stats["rewrites_avoided"] = stats["requested_rewrites"] - stats["rewrites"]
+    logger.info(f"Write plan: {stats}")
+    return slices, stats
+
+
+def open_group(path):
+    return zarr.open_group(create_store(path), mode="r+")
+
+
+def compute_block(ds):
+    """Load all variables of `ds` with one compute call."""
+    lazy = [v for v in ds.variables if ds[v].chunks is not None]
+    values = dask.compute(*[ds[v].data for v in lazy])
+    return ds.assign(
+        {v: (ds[v].dims, val, ds[v].attrs) for v, val in zip(lazy, values)}
+    )
+
+
+def is_raw_writable(var, array):
+    # Variables that need no CF encoding on the way into the store can be
+    # assigned directly; everything else goes through xarray. NaNs are only
+    # stored as they are if the declared fill value is NaN as well.
+    fill_values = [
+        array.attrs[k] for k in ("_FillValue", "missing_value") if k in array.attrs
+    ]
+    if array.fill_value is not None:
+        fill_values.append(array.fill_value)
+    return (
+        var.dtype.kind == "f"
+        and var.dtype == array.dtype
+        and not {"scale_factor", "add_offset"} & set(array.attrs)
+        and all(_is_nan(v) for v in fill_values)
+    )
+
+
+def _is_nan(value):
+    # xarray stores a NaN _FillValue as the string "NaN" in zarr 2 attributes
+    try:
+        return bool(np.isnan(float(value)))
+    except (TypeError, ValueError):
+        return False
+
+
+def write_region(block, group, path, tslice, pool):
+    """Write the in-memory `block` at time `tslice` into the opened `group`."""
+    direct, encoded = [], []
+    for name in block.variables:
+        if "time" not in block[name].dims:
+            continue
+        if name in block.data_vars and is_raw_writable(block[name], group[name]):
+            direct.append(name)
+        else:
+            encoded.append(name)
+
+    def write(name):
+        var = block[name]
+        array = group[name]
+        dims = array.attrs["_ARRAY_DIMENSIONS"]
+        region = tuple(tslice if d == "time" else slice(None) for d in dims)
+        array[region] = np.asarray(var.transpose(*dims).values)
+
+    futures = [pool.submit(write, name) for name in direct]
+    if encoded:
+        logger.debug(f"Writing {encoded} through xarray")
+        wds = xr.Dataset({v: block[v] for v in encoded}).drop_vars(
+            [v for v in block.coords if "time" not in block[v].dims], errors="ignore"
+        )
+        wds.to_zarr(path, region=dict(time=tslice))
+    for future in futures:
+        future.result()
 
 
 def write_variable_chunk(outds, var_name, path, tslice):
@@ -9,6 +9,10 @@ import cartopy.crs as ccrs
 import cartopy.feature as cf
 import matplotlib.pyplot as plt
 
+# from dataset_transforms, which has to be on the PYTHONPATH
+import remap_tools
+import weight_cache
+
 # converts X-SHiELD output that was interpolated to lat-lon to healpix
 # Tim Merlis, closely following on Lucas Kluft's https://easy.gems.dkrz.de/Processing/datasets/remapping.html
 # uses easy environment https://github.com/digital-earths-global-hackathon/tools/tree/main/python_envs
@@ -17,6 +21,7 @@ import matplotlib.pyplot as plt
 fn = '/scratch/cimes/GLOBALFV3/stellar_run/processed/20191020.00Z.C3072.L79x2_pire/pp/2020010800/uas_C3072_11520x5760.fre.nc' 
 ds = xr.open_dataset(fn)
 ds = ds.rename({'grid_yt': 'lat', 'grid_xt': 'lon'})                                                           
+grid_lon, grid_lat = ds.lon.values, ds.lat.values
 ds = ds.stack(xy=("lon", "lat"))
 
 order = zoom = 9
@@ -31,13 +36,25 @@ hp_lon += 360 / (4 * nside) / 4  # shift quarter-width
 
 # compute weights or load precomputed ones
 use_precomputed_weights = True
-if use_precomputed_weights:
+# bilinear weights on the regular lat-lon grid take seconds instead of a Delaunay triangulation of all points
+use_bilinear_weights = False
+if use_bilinear_weights:
+    weights = remap_tools.compute_weights_bilinear(grid_lon, grid_lat, hp_lon, hp_lat)
+elif use_precomputed_weights:
     weight_fn = '/scratch/cimes/tmerlis/healpix_weights_11520x5760_to_zoom' + str(zoom) + '.nc'
     weights = xr.open_dataset(weight_fn)
 else:
-    weights = egr.compute_weights_delaunay((ds.lon, ds.lat), (hp_lon, hp_lat))
-    # You can also save the calculated weights for future use
-    #weights.to_netcdf("healpix_weights.nc")\n')
+    def compute():
+        return egr.compute_weights_delaunay((ds.lon, ds.lat), (hp_lon, hp_lat))
+
+    # with $HEALPIX_WEIGHT_CACHE_DIR set, weights are only computed once per grid and zoom
+    cache = weight_cache.default_cache()
+    if cache is None:
+        weights = compute()
+    else:
+        weights = cache.get_or_compute(
+            compute, ds.lon, ds.lat, order=order, method='delaunay_quarter_shift',
+        )
 
 def worldmap(var, **kwargs):
     projection = ccrs.Robinson(central_longitude=-135.5808361)